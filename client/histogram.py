@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+__author__ = 'Jimmy John'
+
+__doc__ = ''' A small HDR style latency histogram, for the load generator in publisher.py.
+
+Values (microseconds) are counted in log-linear buckets: exact below 2 * 2^SUB_BUCKET_BITS,
+then 2^SUB_BUCKET_BITS buckets per power of two. So any value is off by less than
+1/2^SUB_BUCKET_BITS (under 1% with 7 bits) whatever its size, and the whole range
+from 1us to hours fits in a few thousand buckets.
+'''
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+def _index(value):
+    """Bucket of <value>"""
+
+    value = max(int(value), 0)
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - (SUB_BUCKET_BITS + 1)
+    return 2 * SUB_BUCKETS + (shift - 1) * SUB_BUCKETS + ((value >> shift) - SUB_BUCKETS)
+
+def _highest(index):
+    """Highest value counted in bucket <index>"""
+
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index - 2 * SUB_BUCKETS) // SUB_BUCKETS + 1
+    top = (index - 2 * SUB_BUCKETS) % SUB_BUCKETS + SUB_BUCKETS
+    return ((top + 1) << shift) - 1
+
+class Histogram(object):
+    """Counts of values by bucket"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.total = 0
+        self.max = 0
+
+    def record(self, value, count=1):
+        index = _index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        self.max = max(self.max, int(value))
+
+    def record_corrected(self, value, expected_interval):
+        """Records <value> from a closed loop that sends one request every
+        <expected_interval>: a stall of the system also held back the
+        requests that would have been sent meanwhile, so those are
+        backfilled with the latencies they would have seen (the coordinated
+        omission correction of HdrHistogram)"""
+
+        self.record(value)
+        if expected_interval > 0:
+            missing = value - expected_interval
+            while missing >= expected_interval:
+                self.record(missing)
+                missing -= expected_interval
+
+    def add(self, other):
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Value at or below which <percent>% of the values are"""
+
+        if not self.total:
+            return 0
+        wanted = max(percent / 100.0 * self.total, 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(_highest(index), self.max)
+        return self.max
+
+    def summary(self, percents=(50, 90, 99, 99.9)):
+        """'p50 1.2ms p90 ..' of the values, taken as microseconds"""
+
+        return ' '.join(['p{0} {1:.1f}ms'.format(percent, self.percentile(percent) / 1000.0) for percent in percents] +
+                        ['max {0:.1f}ms'.format(self.max / 1000.0)])
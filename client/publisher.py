@@ -1,27 +1,40 @@
 #!/usr/bin/env python
 #! -*- coding: utf-8 -*-
 
+#make the sockets of requests cooperative, so the greenlets send in parallel
+from gevent import monkey
+monkey.patch_all()
+
 from datetime import datetime
 import hashlib
 import hmac
-import random
+from optparse import OptionParser
+import os
+import sys
+import time
 
 import gevent
 from gevent.pool import Pool
+from gevent.queue import Queue
 import json
 import pytz
 import requests
 
-from latlng import LAT_LNG_DATA
+from histogram import Histogram
+
+#the fleet simulation is shared with the server's benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'geofencing'))
+from geofencing.dispatch import fleet, wire
 
 __author__ = 'Jimmy John'
 
 __doc__ = ''' The following is a client that simulates an event publishing channel.
 You can think of this as field mobile devices constantly sending messages to a server.
-It is done using gevents(an aynchronous framework). MAX_CLIENTS parallel greenlets(psudo threads)
-are created which constantly send updates about it's trip. Once it is done, it starts
-over again in a infinite loop, thus providing us with a continuous event publisher
-channel.
+It is done using gevents(an aynchronous framework). MAX_CLIENTS vehicles of a simulated
+fleet (see geofencing/dispatch/fleet.py) drive one trip after the other through the city,
+sending an update about their trip every second, thus providing us with a continuous
+event publisher channel. --vehicles and --seed change the fleet; the same seed always
+gives the same trips.
 
 In this code, we sent events directly to our server as the requirements state that
 a pub/sub channel is available to us. (If not we could just as easily send these
@@ -31,6 +44,30 @@ To use this, first ensure you are in the virtualenv python i.e. do:
 
     $source venv/bin/activate
     $(venv)python client/publisher.py
+
+Load generator
+--------------
+With --load it is a load generator instead:
+
+    $(venv)python client/publisher.py --load --url http://127.0.0.1:6789/trips/ --rate 200:60,1000:120
+
+It sends events at the target rate of each step of --rate (events per second, for
+that many seconds; a rate alone runs until interrupted), open loop: the send times are
+fixed by the schedule up front, not by when the previous response came back. The
+requests go out over --connections keep-alive sessions. If they are all busy the event
+waits for one, and that wait counts in its latency, since latencies are measured from
+when the event was due rather than from when it got sent. A closed loop (or timing only
+from the send) would instead quietly send less during a stall and miss exactly the slow
+requests (coordinated omission).
+
+Every --report seconds it prints the events/s achieved and the latency percentiles of
+that interval (see histogram.py), and the totals when it stops. The service time (from
+the actual send) is printed next to the response time to show the queueing.
+
+--batch N sends the events N at a time as a JSON array, for ingest endpoints taking
+batches. --url can point at any ingest endpoint (gunicorn, nginx, the standalone ingest
+server). --format packed sends packed binary events instead of JSON (33 bytes each, see
+geofencing/dispatch/wire.py).
 '''
 
 MAX_CLIENTS = 500
@@ -39,72 +76,186 @@ MAX_CLIENTS = 500
 #for prod use:
 POST_URL = 'http://ec2-50-18-87-192.us-west-1.compute.amazonaws.com/trips/'
 
-def _get_random_lat_long():
-    """Helper function to pick random lat/lng from seeded static data."""
-    point = random.choice(LAT_LNG_DATA)
-    return point[1], point[2]
-
-def create_event(client_number):
-    """Helper(generator function) to create publish messages for a trip.
-
-    We create a start event, then generate update messages for this event
-    and finally an end event. The only purpose of this helper is to create events
-    and return it.
-    """
-
-    message = {}
-
-    #first generate a start event
-    message['tripId'] = random.randrange(100, 1000000)
-    message['lat'], message['lng'] = _get_random_lat_long()
-    message['event'] = 'begin'
-    yield message
+def publish(event):
+    """Publishes one event to the central server"""
 
-    #even numbered clients will have 50 'events' in their trip and odd numbered
-    #clients will have 5 'events' in their trip (so we can see the data changing
-    #quickly in real-time)
-    if client_number % 2:
-        final_range = 5
+    r = requests.post(POST_URL, data = json.dumps(event))
+    if r.status_code == 200:
+        print 'published event {0} at approx {1}'.format(str(event), datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
     else:
-        final_range = 50
+        print '*** ERROR ***'
+        print str(r)
 
-    for i in range(random.randrange(1,final_range)):
-        message['event'] = 'update'
-        message['lat'], message['lng'] = _get_random_lat_long()
-        yield message
-
-    #finally the end event
-    message['event'] = 'end'
-    message['lat'], message['lng'] = _get_random_lat_long()
-    #assuming fare is b/w $3.00 and $100.00
-    message['fare'] = random.randrange(3, 100)
-
-    yield message
-
-def publish_events(client_number):
-    """Helper function that publishes events to a central server."""
+def publish_events(vehicles, seed):
+    """Drives a fleet of <vehicles> in real time, publishing every vehicle's
+    events once a second."""
 
+    p = Pool(vehicles)
+    vehicle_fleet = fleet.Fleet(vehicles, seed, start=time.time())
     while 1:
-
-        for event in create_event(client_number):
-
-            r = requests.post(POST_URL, data = json.dumps(event))
-            if r.status_code == 200:
-                print 'published event {0} at approx {1}'.format(str(event), datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
-            else:
-                print '*** ERROR ***'
-                print str(r)
-
-            gevent.sleep(1)
-
-        #ok, we are done with the first trip, now just keep going in an infinite
-        #loop to simulate another trip
+        for event in fleet.messages(vehicle_fleet.tick()):
+            p.spawn(publish, event)
+
+        #next tick when the clock catches up with the fleet
+        gevent.sleep(max(vehicle_fleet.now - time.time(), 0))
+
+def parse_schedule(spec):
+    """'200:60,1000:120' => [(200, 60), (1000, 120)]. A step with no duration
+    lasts forever."""
+
+    steps = []
+    for step in spec.split(','):
+        rate, _, seconds = step.partition(':')
+        steps.append((float(rate), float(seconds) if seconds else None))
+    return steps
+
+def encode_json(events):
+    """Body and content type of a request carrying <events>"""
+
+    if len(events) == 1:
+        return json.dumps(events[0]), 'application/json'
+    return json.dumps(events), 'application/json'
+
+def encode_packed(events):
+    """Body and content type of a request carrying <events>, packed"""
+
+    return wire.pack(events), wire.CONTENT_TYPE
+
+ENCODINGS = {'json': encode_json, 'packed': encode_packed}
+
+class LoadStats(object):
+    """Latencies and counts, for the interval being reported and in all"""
+
+    def __init__(self):
+        self.response = Histogram()
+        self.service = Histogram()
+        self.total_response = Histogram()
+        self.total_service = Histogram()
+        self.events = self.errors = self.total_events = self.total_errors = 0
+        self.pending = 0
+
+    def record(self, due, sent, done, events, ok):
+        for interval, total, value in ((self.response, self.total_response, (done - due) * 1e6),
+                                       (self.service, self.total_service, (done - sent) * 1e6)):
+            interval.record(value)
+            total.record(value)
+        self.events += events
+        self.total_events += events
+        if not ok:
+            self.errors += 1
+            self.total_errors += 1
+
+    def report(self, elapsed, seconds, target):
+        print '{0:7.0f}s target {1:6.0f}/s sent {2:7.0f}/s errors {3} pending {4}  response {5}  service {6}'.format(
+            elapsed, target, self.events / seconds, self.errors, self.pending,
+            self.response.summary(), self.service.summary())
+        self.response.reset()
+        self.service.reset()
+        self.events = self.errors = 0
+
+def load(url, schedule, connections, batch, report_every, max_pending, vehicles, seed, encode=encode_json):
+    """Sends the events of a fleet of <vehicles> to <url> open loop, following
+    <schedule> (see parse_schedule). The fleet is simulated as fast as the
+    schedule asks for events, not in real time."""
+
+    sessions = Queue()
+    for i in range(connections):
+        sessions.put(requests.Session())
+
+    stats = LoadStats()
+    events = fleet.events(vehicles, seed, start=time.time())
+
+    def send(due, batch_events):
+        body, content_type = encode(batch_events)
+        session = sessions.get()
+        try:
+            sent = time.time()
+            try:
+                ok = session.post(url, data=body, headers={'Content-Type': content_type}).status_code == 200
+            except requests.RequestException:
+                ok = False
+            stats.record(due, sent, time.time(), len(batch_events), ok)
+        finally:
+            sessions.put(session)
+            stats.pending -= 1
+
+    started = time.time()
+    target = [0]
+
+    def reporter():
+        last = started
+        while 1:
+            gevent.sleep(report_every)
+            now = time.time()
+            stats.report(now - started, now - last, target[0])
+            last = now
+
+    reporting = gevent.spawn(reporter)
+    dropped = 0
+    try:
+        step_start = started
+        for rate, seconds in schedule:
+            target[0] = rate
+            interval = batch / rate
+            i = 0
+            while seconds is None or i * interval < seconds:
+                due = step_start + i * interval
+                delay = due - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+                i += 1
+
+                batch_events = [next(events) for j in range(batch)]
+                if stats.pending >= max_pending:
+                    #the generator itself can't keep up, don't let it hide in the latencies
+                    dropped += len(batch_events)
+                    continue
+                stats.pending += 1
+                gevent.spawn(send, due, batch_events)
+            step_start += i * interval
+        while stats.pending:
+            gevent.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reporting.kill()
+
+    elapsed = time.time() - started
+    print 'total: {0} events in {1:.1f}s ({2:.0f}/s), {3} errors, {4} dropped by the generator'.format(
+        stats.total_events, elapsed, stats.total_events / elapsed, stats.total_errors, dropped)
+    print 'response time {0}'.format(stats.total_response.summary())
+    print 'service time  {0}'.format(stats.total_service.summary())
 
 def main():
-    p = Pool(MAX_CLIENTS)
-    for i in range(MAX_CLIENTS):
-        p.spawn(publish_events, i)
-    p.join()
+    parser = OptionParser()
+    parser.add_option('--load', dest='load', action='store_true', default=False,
+        help='run as an open loop load generator (see module doc)')
+    parser.add_option('--url', dest='url', default=POST_URL,
+        help='ingest endpoint to send to')
+    parser.add_option('--rate', dest='rate', default='100',
+        help='events per second schedule, e.g. 200:60,1000:120')
+    parser.add_option('--connections', dest='connections', type='int', default=64,
+        help='keep-alive connections')
+    parser.add_option('--batch', dest='batch', type='int', default=1,
+        help='events per request')
+    parser.add_option('--format', dest='format', choices=sorted(ENCODINGS), default='json',
+        help='json, or packed binary events')
+    parser.add_option('--report', dest='report', type='float', default=5,
+        help='seconds between summaries')
+    parser.add_option('--max-pending', dest='max_pending', type='int', default=10000,
+        help='requests waiting for a connection before events are dropped')
+    parser.add_option('--vehicles', dest='vehicles', type='int', default=MAX_CLIENTS,
+        help='vehicles in the fleet')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+        help='seed of the fleet')
+    options, args = parser.parse_args()
+
+    if options.load:
+        load(options.url, parse_schedule(options.rate), options.connections, max(options.batch, 1),
+             options.report, options.max_pending, options.vehicles, options.seed, ENCODINGS[options.format])
+        return
+
+    publish_events(options.vehicles, options.seed)
 
 if __name__ == '__main__':
     main()
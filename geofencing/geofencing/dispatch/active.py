@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from django.conf import settings
+import numpy
+
+from geofencing.dispatch.geo import cell_dimensions, cover_box, cover_box_count, ring_cells
+from geofencing.dispatch.polygons import decode_cells
+from geofencing.dispatch.scripts import script
+
+__doc__ = """
+        Index of where the active trips are right now.
+
+        redis schema
+        ============
+        active_trip:<tripId> => geohash of the trip's last position
+            expires ACTIVE_TRIP_TTL seconds after its last event
+
+        active_cell:<cell> => sorted set of tripId, scored by the epoch of the
+            trip's last event in <cell> (a ACTIVE_PRECISION chars geohash).
+            expires ACTIVE_TRIP_TTL seconds after its last write
+
+        Every 'begin'/'update' event moves the trip into the cell of its new
+        position (taking it out of its old one) and an 'end' event takes it out
+        altogether, each in one atomic lua script. Trips that go quiet without
+        an 'end' are stale after ACTIVE_TRIP_TTL: queries ignore them by score
+        and they are trimmed off a cell whenever the cell is written to.
+
+        A query covers the area with ACTIVE_PRECISION cells. Trips in the
+        cells entirely inside the area count as is, the trips in the cells on
+        its edge are checked against their exact positions.
+
+        Nearest trips
+        =============
+        The k nearest trips to a point are found by reading rings of cells
+        around the point's cell, closest rings first, until we have k trips
+        and no unread cell can hold anything closer than the k-th one. Rings
+        are read in batches that double in size (rings 0-1, 2-3, 4-7, 8-15..)
+        so a sparse area costs a few round trips rather than one per ring, and
+        the search gives up after MAX_RINGS rings (~15km at the default
+        precision).
+"""
+
+#~1.2km x 0.6km cells
+ACTIVE_PRECISION = 6
+
+#a trip with no event for this long is not active anymore
+ACTIVE_TRIP_TTL = getattr(settings, 'GEOFENCE_ACTIVE_TRIP_TTL', 5*60)
+
+#bigger areas are refused (that's ~ 60km x 60km with the default precision)
+MAX_QUERY_CELLS = 5000
+
+#how far out the nearest trips search goes, in rings of cells
+MAX_RINGS = 16
+
+#mean earth radius, in meters
+EARTH_RADIUS = 6371000.0
+
+_MOVE_SCRIPT = """
+local old = redis.call('GET', KEYS[1])
+if old and string.sub(old, 1, {precision}) ~= string.sub(ARGV[2], 1, {precision}) then
+    redis.call('ZREM', 'active_cell:' .. string.sub(old, 1, {precision}), ARGV[1])
+end
+redis.call('SETEX', KEYS[1], ARGV[4], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. (ARGV[3] - ARGV[4]))
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+""".format(precision=ACTIVE_PRECISION)
+
+_END_SCRIPT = """
+local old = redis.call('GET', KEYS[1])
+if old then
+    redis.call('ZREM', 'active_cell:' .. string.sub(old, 1, {precision}), ARGV[1])
+    redis.call('DEL', KEYS[1])
+end
+""".format(precision=ACTIVE_PRECISION)
+
+def record_event(pipe, message, geohash_string, now_seconds):
+    """Moves the trip to its new position, or drops it on an 'end' event.
+    Queued on the pipeline <pipe>."""
+
+    trip_key = 'active_trip:{0}'.format(message['tripId'])
+
+    if message['event'].lower() == 'end':
+        script(pipe, _END_SCRIPT)(keys=[trip_key], args=[message['tripId']], client=pipe)
+    else:
+        cell_key = 'active_cell:{0}'.format(geohash_string[:ACTIVE_PRECISION])
+        script(pipe, _MOVE_SCRIPT)(keys=[trip_key, cell_key],
+            args=[message['tripId'], geohash_string, now_seconds, ACTIVE_TRIP_TTL], client=pipe)
+
+def trips_in(redis_conn, polygon, now_seconds):
+    """Returns the ids of the active trips inside <polygon>.
+
+    Raises ValueError if the area needs more than MAX_QUERY_CELLS cells.
+    """
+
+    south, west, north, east = polygon.bbox
+    if cover_box_count(south, west, north, east, ACTIVE_PRECISION) > MAX_QUERY_CELLS:
+        raise ValueError('area too large')
+
+    interior, boundary = polygon.classify(cover_box(south, west, north, east, ACTIVE_PRECISION))
+    oldest = now_seconds - ACTIVE_TRIP_TTL
+
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for cell in interior + boundary:
+            pipe.zrangebyscore('active_cell:{0}'.format(cell), oldest, '+inf')
+        members = pipe.execute()
+
+    trip_ids = []
+    for trips in members[:len(interior)]:
+        trip_ids.extend(trips)
+
+    candidates = [trip_id for trips in members[len(interior):] for trip_id in trips]
+    if candidates:
+        positions = redis_conn.mget(['active_trip:{0}'.format(trip_id) for trip_id in candidates])
+        #the trip may have ended (or expired) since we read the cell
+        found = [(trip_id, position) for trip_id, position in zip(candidates, positions) if position]
+        if found:
+            lats, lngs = decode_cells([position for trip_id, position in found])
+            inside = polygon.contains(lats, lngs)
+            trip_ids.extend(trip_id for (trip_id, position), i in zip(found, inside) if i)
+
+    return trip_ids
+
+def distances(lat, lng, lats, lngs):
+    """Great circle distances in meters from (lat, lng) to each of the points"""
+
+    lat, lng, lats, lngs = [numpy.radians(v) for v in (lat, lng, lats, lngs)]
+    a = (numpy.sin((lats - lat) / 2) ** 2 +
+         numpy.cos(lat) * numpy.cos(lats) * numpy.sin((lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+def _unread_distance(lat, radius):
+    """Lower bound on the distance in meters from a point to any cell more than
+    <radius> rings away from its own cell"""
+
+    height, width = cell_dimensions(ACTIVE_PRECISION)
+    #the point can be anywhere in its cell, so only <radius> whole cells are
+    #sure to be in between. longitude degrees shrink towards the poles, take
+    #the worst case over the rings read
+    widest_lat = min(abs(lat) + (radius + 1) * height, 90.0)
+    degrees = numpy.radians(min(height, width * numpy.cos(numpy.radians(widest_lat))))
+    return radius * EARTH_RADIUS * degrees
+
+def nearest_trips(redis_conn, lat, lng, k, now_seconds):
+    """Returns up to <k> (tripId, lat, lng, distance in meters) of the active
+    trips nearest to (lat, lng), nearest first. See module doc.
+    """
+
+    oldest = now_seconds - ACTIVE_TRIP_TTL
+    found = {}
+    first, last = 0, 1
+
+    while first <= MAX_RINGS:
+        last = min(last, MAX_RINGS)
+
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for radius in range(first, last + 1):
+                for cell in ring_cells(lat, lng, ACTIVE_PRECISION, radius):
+                    pipe.zrangebyscore('active_cell:{0}'.format(cell), oldest, '+inf')
+            candidates = [trip_id for trips in pipe.execute() for trip_id in trips
+                          if trip_id not in found]
+
+        if candidates:
+            positions = redis_conn.mget(['active_trip:{0}'.format(trip_id) for trip_id in candidates])
+            #the trip may have ended (or expired) since we read the cell
+            current = [(trip_id, position) for trip_id, position in zip(candidates, positions) if position]
+            if current:
+                lats, lngs = decode_cells([position for trip_id, position in current])
+                for (trip_id, position), trip_lat, trip_lng, distance in zip(current, lats, lngs,
+                        distances(lat, lng, lats, lngs)):
+                    found[trip_id] = (trip_id, float(trip_lat), float(trip_lng), float(distance))
+
+        if len(found) >= k:
+            kth = sorted(trip[3] for trip in found.itervalues())[k - 1]
+            if kth <= _unread_distance(lat, last):
+                break
+
+        first, last = last + 1, 2 * last + 1
+
+    return sorted(found.itervalues(), key=lambda trip: trip[3])[:k]
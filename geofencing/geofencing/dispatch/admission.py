@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import threading
+import time
+
+from django.conf import settings
+
+from geofencing.dispatch import metrics
+from geofencing.dispatch.heatmap import HEATMAP_PRECISIONS
+
+__doc__ = """
+        Admission control for the box queries (trips_passed_through,
+        trips_start_stop). What a query costs is known before any counter is
+        read: it reads cells x buckets keys (per counter), the active cells
+        under the box times the time buckets of days_back. So once the cells
+        are listed:
+
+        - a query costing more than BUDGET is not run as is. With
+          OVER_BUDGET = 'coarse' it is answered from the heatmap rollups
+          (see heatmap.py) at the finest precision whose cells fit in the
+          budget, and the page says the answer is approximate: the coarse
+          cells count whole, so the totals can take in events just outside
+          the box, and the trips are the distinct trips of each coarse cell
+          (HyperLogLog), without the fare percentiles. With 'reject', or
+          when there are no rollups to answer from (no redis, or
+          GEOFENCE_HEATMAP_PRECISIONS empty), it is turned down (400).
+
+        - a query costing HEAVY_COST or more is heavy: a worker runs at most
+          HEAVY_PER_WORKER of them at a time (gevent workers run many
+          requests at once, /trips/ among them), the others are turned down
+          with a 503 and a Retry-After. A heavy query reads its keys CHUNK
+          at a time, and is cancelled (503) if it is still running DEADLINE
+          seconds after it started: the chunk in flight completes, no more
+          are sent. The same goes for a coarse answer, priced at its coarse
+          cells x buckets, which reads the rollups CHUNK keys at a time too.
+
+        The rollups are written by ingest, load_events and replay_journal
+        alike, so every bucket the box counters have, the rollups have too.
+
+        The heatmap and od_matrix queries go through the same checks, priced
+        at cells (origins) x buckets, but have no coarse answer: over budget
+        they are turned down.
+
+        The outcomes are counted in geofence_query_admission_total (see
+        metrics.py).
+"""
+
+#most cells x buckets a query may read
+BUDGET = getattr(settings, 'GEOFENCE_QUERY_BUDGET', 200000)
+
+#'coarse' or 'reject'
+OVER_BUDGET = getattr(settings, 'GEOFENCE_QUERY_OVER_BUDGET', 'coarse')
+
+#cost from which a query counts as heavy
+HEAVY_COST = getattr(settings, 'GEOFENCE_QUERY_HEAVY_COST', 20000)
+
+HEAVY_PER_WORKER = getattr(settings, 'GEOFENCE_QUERY_HEAVY_PER_WORKER', 2)
+
+#seconds a heavy query may run
+DEADLINE = getattr(settings, 'GEOFENCE_QUERY_DEADLINE', 10.0)
+
+#keys read between two deadline checks
+CHUNK = 5000
+
+#seconds to wait before trying a turned down heavy query again
+RETRY_AFTER = 1
+
+class Rejected(Exception):
+    """A query turned down (or cancelled), the message says why"""
+
+    def __init__(self, message, status=400):
+        super(Rejected, self).__init__(message)
+        self.status = status
+
+_state = {
+    #heavy queries running in this worker
+    'heavy': 0,
+}
+
+_lock = threading.Lock()
+
+def cost(cells, candidate_sub_keys):
+    """What a query over <cells> and <candidate_sub_keys> costs"""
+
+    return len(cells) * len(candidate_sub_keys)
+
+def _coarse_cells(cells, buckets, budget):
+    """(precision, cells) of the finest rollups <cells> fit in <budget> at, or None"""
+
+    for precision in sorted(HEATMAP_PRECISIONS, reverse=True):
+        coarse = sorted(set(cell[:precision] for cell in cells))
+        if len(coarse) * buckets <= budget:
+            return (precision, coarse)
+    return None
+
+def check(cells, candidate_sub_keys, rollups=True):
+    """Checks the query over <cells> and <candidate_sub_keys> against the
+    budget. Returns None to run it as is, or the (precision, cells) of the
+    heatmap rollups to answer it from instead. <rollups> says whether there
+    are any. Raises Rejected if it can't be run."""
+
+    query_cost = cost(cells, candidate_sub_keys)
+    if query_cost <= BUDGET:
+        return None
+
+    if OVER_BUDGET == 'coarse' and rollups:
+        coarse = _coarse_cells(cells, len(candidate_sub_keys), BUDGET)
+        if coarse is not None:
+            metrics.inc('geofence_query_admission_total', outcome='coarse')
+            return coarse
+
+    metrics.inc('geofence_query_admission_total', outcome='over_budget')
+    raise Rejected('This query would read {0} cells over {1} time buckets, more than the {2} allowed: '
+                   'please try a smaller area or a shorter time range'.format(
+                   len(cells), len(candidate_sub_keys), BUDGET))
+
+class Deadline(object):
+    """When a heavy query has to be done by"""
+
+    def __init__(self, seconds):
+        self.at = time.time() + seconds
+
+    def check(self):
+        """Raises Rejected if the deadline passed"""
+
+        if time.time() > self.at:
+            metrics.inc('geofence_query_admission_total', outcome='cancelled')
+            raise Rejected('This query took too long and was cancelled, please try again later', status=503)
+
+    def chunks(self, keys, keys_each=1):
+        """<keys>, CHUNK at a time, checking the deadline before each chunk.
+        With <keys_each>, each of <keys> stands for that many keys read."""
+
+        size = max(CHUNK // keys_each, 1)
+        for start in xrange(0, len(keys), size):
+            self.check()
+            yield keys[start:start + size]
+
+@contextmanager
+def running(query_cost):
+    """Runs a query of <query_cost>. A heavy one takes one of this worker's
+    slots, or raises Rejected if they are all taken, and gets a Deadline
+    (None for the others)."""
+
+    if query_cost < HEAVY_COST:
+        metrics.inc('geofence_query_admission_total', outcome='admitted')
+        yield None
+        return
+
+    with _lock:
+        admitted = _state['heavy'] < HEAVY_PER_WORKER
+        if admitted:
+            _state['heavy'] += 1
+    if not admitted:
+        metrics.inc('geofence_query_admission_total', outcome='busy')
+        raise Rejected('Too many large queries running, please try again in a moment', status=503)
+
+    metrics.inc('geofence_query_admission_total', outcome='heavy')
+    try:
+        yield Deadline(DEADLINE)
+    finally:
+        with _lock:
+            _state['heavy'] -= 1
+
+def read_many(read, keys, deadline=None):
+    """read(keys), in chunks checking <deadline> when there is one"""
+
+    if deadline is None:
+        return read(keys)
+
+    values = []
+    for chunk in deadline.chunks(keys):
+        values.extend(read(chunk))
+    return values
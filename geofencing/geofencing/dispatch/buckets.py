@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import calendar
+from datetime import timedelta
+
+__doc__ = """
+        The time buckets of the geohash:<gh>:<days|weeks>:<bucket>:* keys a
+        days_back query ('3d', '2w', '0d' for today..) has to look at. Shared
+        by the live views and the offline snapshots.
+"""
+
+#the keys are kept 90 days, so there is nothing to look at further back than
+#13 weeks
+MAX_DAYS_BACK = 13*7
+
+def valid(days_back):
+    """Whether <days_back> is a '<n>d' or '<n>w' of at most MAX_DAYS_BACK days"""
+
+    if not (days_back[-1:] in ('d', 'w') and days_back[:-1].isdigit()):
+        return False
+    return int(days_back[:-1]) * (7 if days_back.endswith('w') else 1) <= MAX_DAYS_BACK
+
+def sub_keys(days_back, now):
+    """Returns (candidate_sub_keys, since) where candidate_sub_keys are the
+    days:<date>/weeks:<week> parts of the keys and <since> is the epoch before
+    which cells are known to be of no interest. <now> is a utc datetime.
+    """
+
+    candidate_sub_keys = []
+
+    #we need to know how far back in time we need to go
+    current_date = '{0}-{1}-{2}'.format(now.year, now.month, now.day)
+    current_week = now.strftime('%U')
+
+    duration = int(days_back[:-1])
+
+    if days_back.endswith('d'):
+        if not duration:
+            candidate_sub_keys.append('days:{0}'.format(current_date))
+        else:
+            #accumulate the info from now until the 'days_back'
+            for i in range(duration):
+                new_date = now - timedelta(days=i)
+                new_date_str = '{0}-{1}-{2}'.format(new_date.year, new_date.month, new_date.day)
+                candidate_sub_keys.append('days:{0}'.format(new_date_str))
+
+    elif days_back.endswith('w'):
+        if not duration:
+            candidate_sub_keys.append('weeks:{0}'.format(current_week))
+        else:
+            #accumulate the info from now until the 'weeks_back'
+            for i in range(duration):
+                new_date = now - timedelta(days=i*7)
+                new_week_str = new_date.strftime('%U')
+                candidate_sub_keys.append('weeks:{0}'.format(new_week_str))
+
+    #cells not seen since the oldest bucket began can't have data in it, so
+    #they can be skipped. (we stay conservative and go back a whole day/week
+    #rather than work out exactly when that bucket started)
+    if days_back.endswith('w'):
+        since = now - timedelta(days=max(duration, 1)*7)
+    else:
+        since = now - timedelta(days=max(duration, 1))
+
+    return (candidate_sub_keys, calendar.timegm(since.timetuple()))
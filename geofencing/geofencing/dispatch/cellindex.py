@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left
+import threading
+
+from geofencing.dispatch import changefeed
+from geofencing.dispatch.geo import BASE32, cell_to_int, int_to_cell, prefix_range, PRECISION
+
+__doc__ = """
+        Worker-local index of the active geohash cells.
+
+        Every box query needs to know which cells exist under the common prefix
+        of its corners. The source of truth is the geohash_prefixes:<prefix>
+        sorted sets (see README), but asking redis costs a round trip on every
+        query. Instead each worker keeps a copy of the cells and the last time
+        each one was seen:
+
+            cells     => array of 60 bit cell values (see geo.py), sorted
+            last_seen => array of epoch seconds, parallel to cells
+
+        All cells under a prefix form a contiguous run of the sorted array, so
+        enumerating them is two binary searches.
+
+        Memory footprint: both arrays are flat C longs, i.e. 16 bytes per cell
+        (8 + 8 on a 64 bit box) plus the usual array slack of up to ~12%. A
+        million active cells is ~16MB per worker. A new cell is an O(n) insert
+        (a memmove), seeing a known cell again is an O(log n) in-place update.
+
+        The index is loaded from the 32 one-char geohash_prefixes sets at
+        startup and then kept in sync from the CELL_FEED_CHANNEL change feed
+        of its db, which trips() publishes to on every event.
+"""
+
+CELL_FEED_CHANNEL = 'geohash_cells'
+
+def feed_channel(redis_conn):
+    """The cell change feed of <redis_conn>'s db"""
+
+    return changefeed.channel(redis_conn, CELL_FEED_CHANNEL)
+
+def feed_message(geohash_string, seen):
+    """The message trips() publishes for a cell seen at epoch <seen>"""
+
+    return '{0}:{1}'.format(geohash_string, seen)
+
+class CellIndex(object):
+    """Sorted, array backed set of active cells with their last-seen times."""
+
+    def __init__(self):
+        self.cells = array('l')
+        self.last_seen = array('l')
+        #the change feed listener and the request handlers both touch the arrays
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cells)
+
+    def load(self, pairs):
+        """Replaces the contents with the (geohash, last seen) pairs given"""
+
+        merged = {}
+        for geohash_string, seen in pairs:
+            value = cell_to_int(geohash_string)
+            seen = int(seen)
+            if seen > merged.get(value, 0):
+                merged[value] = seen
+
+        values = sorted(merged)
+        cells = array('l', values)
+        last_seen = array('l', [merged[v] for v in values])
+
+        with self.lock:
+            self.cells, self.last_seen = cells, last_seen
+
+    def touch(self, geohash_string, seen):
+        """Records that <geohash_string> was seen at epoch <seen>"""
+
+        value = cell_to_int(geohash_string)
+        seen = int(seen)
+
+        with self.lock:
+            i = bisect_left(self.cells, value)
+            if i < len(self.cells) and self.cells[i] == value:
+                if seen > self.last_seen[i]:
+                    self.last_seen[i] = seen
+            else:
+                self.cells.insert(i, value)
+                self.last_seen.insert(i, seen)
+
+    def cells_with_prefix(self, prefix, since=0):
+        """Returns the geohashes under <prefix> last seen at or after <since>.
+
+        Mirrors the geohash_prefixes:<prefix> sets, which only exist for
+        prefixes of 1 to 11 chars. Any other prefix gives no cells.
+        """
+
+        if not 0 < len(prefix) < PRECISION:
+            return []
+
+        lo, hi = prefix_range(prefix)
+
+        with self.lock:
+            i = bisect_left(self.cells, lo)
+            j = bisect_left(self.cells, hi, i)
+            return [int_to_cell(self.cells[k]) for k in xrange(i, j)
+                    if self.last_seen[k] >= since]
+
+def _snapshot(redis_conn):
+    """Reads every active cell from the one-char prefix sets in one round trip"""
+
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for c in BASE32:
+            pipe.zrange('geohash_prefixes:{0}'.format(c), 0, -1, withscores=True)
+        for members in pipe.execute():
+            for pair in members:
+                yield pair
+
+def start(redis_conn):
+    """Builds a CellIndex from redis and keeps it in sync in the background."""
+
+    index = CellIndex()
+
+    def on_message(data):
+        geohash_string, seen = data.rsplit(':', 1)
+        index.touch(geohash_string, seen)
+
+    def on_resync():
+        index.load(_snapshot(redis_conn))
+
+    changefeed.follow(redis_conn, feed_channel(redis_conn), on_message, on_resync)
+    return index
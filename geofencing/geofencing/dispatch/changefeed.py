@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+__doc__ = """
+        Keeps worker-local state in sync with what the ingest path writes to redis.
+
+        Ingest PUBLISHes a small message on a channel every time it changes
+        something a worker caches locally. Each worker runs one background
+        listener per channel. Whenever the listener (re)subscribes it first
+        reloads a full snapshot, as messages published while we were not
+        subscribed are lost, and then applies the messages as they come in.
+        Handlers must therefore be idempotent.
+
+        PUBLISH is server wide, not per db, so the channels are named after the
+        db they are about (see channel()): a test run or a benchmark in
+        another db doesn't reach the workers of this one.
+
+        With gevent workers the thread below is monkey patched into a greenlet.
+"""
+
+logger = logging.getLogger(__name__)
+
+#how long to wait before re-subscribing after the connection drops
+RETRY_INTERVAL = 1
+
+def channel(redis_conn, name):
+    """The channel <name> of <redis_conn>'s db"""
+
+    return '{0}:{1}'.format(name, redis_conn.connection_pool.connection_kwargs.get('db', 0))
+
+def _listen(redis_conn, channel, on_message, on_resync):
+    """Subscribes to <channel> forever, re-syncing after every (re)subscribe."""
+
+    while 1:
+        try:
+            pubsub = redis_conn.pubsub()
+            pubsub.subscribe(channel)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    #from here on we don't miss anything, so take the snapshot
+                    on_resync()
+                elif message['type'] == 'message':
+                    on_message(message['data'])
+        except Exception:
+            logger.exception('change feed {0} dropped, re-subscribing'.format(channel))
+            time.sleep(RETRY_INTERVAL)
+
+def follow(redis_conn, channel, on_message, on_resync):
+    """Loads the initial snapshot and starts following <channel> in the background.
+
+    on_resync() is called right away (so the caller has data before the first
+    request is served) and again on every re-subscribe. on_message(data) is
+    called for every message published on the channel.
+    """
+
+    on_resync()
+
+    thread = threading.Thread(target=_listen,
+                              args=(redis_conn, channel, on_message, on_resync))
+    thread.daemon = True
+    thread.start()
+    return thread
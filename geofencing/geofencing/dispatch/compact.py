@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from django.conf import settings
+
+from geofencing.dispatch.geo import PRECISION
+
+__doc__ = """
+        The compact layout of the per-cell counters.
+
+        In the classic layout (see the README schema) every cell has up to
+        three counter keys per time bucket,
+
+            geohash:<gh>:days:YYYY-M-D:tot_start_counter
+            geohash:<gh>:days:YYYY-M-D:tot_stop_counter
+            geohash:<gh>:days:YYYY-M-D:tot_fare_counter
+
+        each paying redis' per key overhead (dict entry, robj, the 40+ bytes of
+        name, expiry slot..) for a value of a few bytes. The compact layout
+        packs the counters of all the cells sharing a CELL_PREFIX long prefix
+        into one small hash per bucket:
+
+        redis schema
+        ============
+        cells:days:YYYY-M-D:<prefix> => hash of
+        cells:weeks:WW:<prefix>             <rest of gh>:s => trips started in gh
+                                            <rest of gh>:e => trips ended in gh
+                                            <rest of gh>:f => sum of their fares
+
+        Such hashes hold a handful of cells, so redis keeps them in its
+        ziplist (listpack from redis 7) encoding as long as they stay under
+        hash-max-ziplist-entries fields. 8 chars of prefix are cells of about
+        38m x 19m, well under the default 512 fields even downtown.
+
+        The views keep using the classic key names: with GEOFENCE_KEY_LAYOUT
+        = 'compact' the storage (see storage.py) maps them onto hash fields
+        with locate(). The tripids sorted sets and the fare histograms are the
+        same in both layouts.
+
+        Move the counters of a running redis over with the migrate_layout
+        command, and compare the memory used by both layouts with
+        layout_report.
+"""
+
+#'classic' or 'compact'
+LAYOUT = getattr(settings, 'GEOFENCE_KEY_LAYOUT', 'classic')
+
+#length of the geohash prefix cells are grouped by
+CELL_PREFIX = getattr(settings, 'GEOFENCE_COMPACT_CELL_PREFIX', 8)
+
+#counter name => field suffix
+FIELDS = {'tot_start_counter': 's', 'tot_stop_counter': 'e', 'tot_fare_counter': 'f'}
+
+_NAMES = dict((suffix, name) for name, suffix in FIELDS.iteritems())
+
+#what to SCAN for to find the hashes
+PATTERN = 'cells:*'
+
+def locate(key):
+    """(hash, field) of the classic counter <key>, or None if it is not a
+    per-cell counter"""
+
+    parts = key.split(':')
+    if len(parts) != 5 or parts[0] != 'geohash' or parts[4] not in FIELDS or len(parts[1]) != PRECISION:
+        return None
+
+    prefix, gh, kind, bucket, name = parts
+    return ('cells:{0}:{1}:{2}'.format(kind, bucket, gh[:CELL_PREFIX]),
+            '{0}:{1}'.format(gh[CELL_PREFIX:], FIELDS[name]))
+
+def classic_key(hash_key, field):
+    """The classic key of a <field> of the compact <hash_key>, the reverse of
+    locate()"""
+
+    prefix, kind, bucket, cell_prefix = hash_key.split(':')
+    rest, suffix = field.split(':')
+    return 'geohash:{0}{1}:{2}:{3}:{4}'.format(cell_prefix, rest, kind, bucket, _NAMES[suffix])
+
+#counter command => the same on a hash field
+_HASH_COMMANDS = {'INCRBY': 'HINCRBY', 'INCRBYFLOAT': 'HINCRBYFLOAT', 'SET': 'HSET', 'GET': 'HGET'}
+
+def translate(command):
+    """The redis <command> (a tuple, as in rebuild.py) on a classic counter
+    key, rewritten for the compact layout. Other commands are left alone."""
+
+    if command[0] in _HASH_COMMANDS:
+        located = locate(command[1])
+        if located is not None:
+            return (_HASH_COMMANDS[command[0]],) + located + tuple(command[2:])
+    return command
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import math
+
+import numpy
+
+__doc__ = """
+        Fare distributions, to answer "what is the median/p95 fare around here?".
+
+        redis schema
+        ============
+        geohash:<geohash>:days:YYYY-M-D:fare_histogram => hash of bin => count
+        geohash:<geohash>:weeks:WW:fare_histogram
+
+        (the day and week buckets of buckets.sub_keys(): the month and day
+        are not zero padded)
+
+        Fares are counted in fixed, logarithmically spaced bins: bin i holds
+        the fares in [MIN_FARE * GAMMA**i, MIN_FARE * GAMMA**(i + 1)). As every
+        histogram uses the same bins, merging any number of cells and time
+        buckets is just adding the counts up, and a percentile read off the
+        merged bins is within (GAMMA - 1) / 2 (i.e. 1%) of the real fare.
+        A cell/bucket only stores the bins it has seen, a few dozen at most.
+"""
+
+GAMMA = 1.02
+
+#fares below this (free rides..) are counted in the first bin
+MIN_FARE = 0.01
+
+_LOG_GAMMA = math.log(GAMMA)
+
+def fare_bin(fare):
+    """The bin <fare> is counted in"""
+
+    return int(math.floor(math.log(max(float(fare), MIN_FARE) / MIN_FARE) / _LOG_GAMMA))
+
+def fare_bins(fares):
+    """fare_bin() of a whole NumPy array of fares"""
+
+    fares = numpy.maximum(numpy.asarray(fares, dtype=numpy.float64), MIN_FARE)
+    return numpy.floor(numpy.log(fares / MIN_FARE) / _LOG_GAMMA).astype(numpy.int64)
+
+def record_fare(pipe, histogram_keys, fare):
+    """Counts <fare> in each of the histograms given. Queued on the pipeline <pipe>."""
+
+    fare_bin_field = fare_bin(fare)
+    for key in histogram_keys:
+        pipe.hincrby(key, fare_bin_field, 1)
+
+def percentiles(redis_conn, histogram_keys, percents, deadline=None):
+    """Merges the histograms given (in one round trip) and returns the fare at
+    each of the <percents>, or Nones if there are no fares at all.
+
+    With an admission.Deadline, in one round trip per chunk of histograms,
+    checking it before each one.
+    """
+
+    histograms = []
+    for chunk in (deadline.chunks(histogram_keys) if deadline is not None else [histogram_keys]):
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for key in chunk:
+                pipe.hgetall(key)
+            histograms.extend(pipe.execute())
+
+    bins = []
+    counts = []
+    for histogram in histograms:
+        bins.extend(int(fare_bin_field) for fare_bin_field in histogram.iterkeys())
+        counts.extend(float(count) for count in histogram.itervalues())
+    if not bins:
+        return [None for percent in percents]
+
+    merged = numpy.bincount(numpy.array(bins, dtype=numpy.int64),
+                            weights=numpy.array(counts, dtype=numpy.float64))
+    cumulative = numpy.cumsum(merged)
+
+    #the first bin whose running count reaches the percentile's rank
+    ranks = numpy.array(percents, dtype=numpy.float64) / 100.0 * cumulative[-1]
+    found = numpy.searchsorted(cumulative, numpy.maximum(ranks, 1), side='left')
+
+    #report the middle of the bin
+    return [round(MIN_FARE * GAMMA ** (i + 0.5), 2) for i in found]
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import json
+import threading
+
+from geofencing.dispatch import changefeed
+from geofencing.dispatch.geo import cover_box, cover_box_count
+
+__doc__ = """
+        Named rectangular geofences and enter/exit notifications.
+
+        redis schema
+        ============
+        fences => hash of <fence name> => json [south, west, north, east]
+
+        trip_fences:<tripId> => set of the fences the trip is currently inside
+
+        fence_events:<fence name> => pub/sub channel. A json message is published
+            every time a trip enters or exits the fence:
+
+                {"fence": .., "tripId": .., "transition": "enter"|"exit",
+                 "lat": .., "lng": .., "time": <epoch seconds>}
+
+            PSUBSCRIBE fence_events:* to follow all the fences.
+
+        Matching
+        ========
+        Every worker keeps all the fences in a FenceIndex, a geohash bucket map.
+        A fence is put in the buckets of the cells covering it, at the finest
+        precision where it needs no more than MAX_CELLS_PER_FENCE cells. Small
+        fences go in fine buckets, big ones in coarse buckets. To match an event
+        we look up the event's geohash prefix in each precision that is in use
+        (at most MAX_PRECISION dict lookups) and only test the handful of fences
+        found there, so the cost does not grow with the number of fences.
+
+        Memory is one bucket entry per covering cell, i.e. at most
+        MAX_CELLS_PER_FENCE entries per fence. Tens of thousands of fences are a
+        few tens of MB per worker.
+
+        Fences are added/removed through the fences view and the workers pick
+        up the change from the FENCE_FEED_CHANNEL change feed of their db. A
+        deleted fence is dropped from the trip_fences:* sets as the trips
+        move, without an exit event.
+"""
+
+FENCES_KEY = 'fences'
+FENCE_FEED_CHANNEL = 'fence_changes'
+FENCE_EVENTS_CHANNEL = 'fence_events:{0}'
+
+#finest bucket precision, ~38m x 19m cells
+MAX_PRECISION = 8
+MAX_CELLS_PER_FENCE = 16
+
+#trips that go quiet without an 'end' event don't keep their state forever
+TRIP_FENCES_EXPIRY = 24*60*60
+
+def _bucket_cells(box):
+    """Returns (precision, covering cells) for the buckets of the fence <box>"""
+
+    for precision in range(MAX_PRECISION, 1, -1):
+        if cover_box_count(*box + (precision,)) <= MAX_CELLS_PER_FENCE:
+            break
+    else:
+        #precision 1 cells are 45x45 degrees, the whole world is 32 of them
+        precision = 1
+
+    return precision, cover_box(*box + (precision,))
+
+class FenceIndex(object):
+    """Geohash bucket map of fence name => box, see module doc."""
+
+    def __init__(self):
+        self.fences = {}   # name => (south, west, north, east)
+        self.buckets = {}  # precision => {cell => set of fence names}
+        self.covers = {}   # name => (precision, cells) so we can take it out again
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.fences)
+
+    def _remove(self, name):
+        if name not in self.fences:
+            return
+
+        precision, cells = self.covers.pop(name)
+        del self.fences[name]
+
+        bucket = self.buckets[precision]
+        for cell in cells:
+            bucket[cell].discard(name)
+            if not bucket[cell]:
+                del bucket[cell]
+        if not bucket:
+            del self.buckets[precision]
+
+    def add(self, name, box):
+        """Adds (or replaces) the fence <name> covering <box>"""
+
+        box = tuple(box)
+        precision, cells = _bucket_cells(box)
+
+        with self.lock:
+            self._remove(name)
+            self.fences[name] = box
+            self.covers[name] = (precision, cells)
+            bucket = self.buckets.setdefault(precision, {})
+            for cell in cells:
+                bucket.setdefault(cell, set()).add(name)
+
+    def remove(self, name):
+        with self.lock:
+            self._remove(name)
+
+    def load(self, fences):
+        """Replaces the contents with the {name: box} given"""
+
+        #built aside and swapped in, so a match never sees it half loaded
+        fresh = FenceIndex()
+        for name, box in fences.iteritems():
+            fresh.add(name, box)
+
+        with self.lock:
+            self.fences, self.buckets, self.covers = fresh.fences, fresh.buckets, fresh.covers
+
+    def known(self, names):
+        """The fences of <names> that are in the index"""
+
+        with self.lock:
+            return set(name for name in names if name in self.fences)
+
+    def containing(self, lat, lng, geohash_string):
+        """Returns the set of fence names containing the point"""
+
+        found = set()
+        with self.lock:
+            for precision, bucket in self.buckets.iteritems():
+                for name in bucket.get(geohash_string[:precision], ()):
+                    south, west, north, east = self.fences[name]
+                    if south <= lat <= north and west <= lng <= east:
+                        found.add(name)
+        return found
+
+def make_box(lat1, lng1, lat2, lng2):
+    """(south, west, north, east) of the box with the two corners given"""
+
+    return (min(lat1, lat2), min(lng1, lng2), max(lat1, lat2), max(lng1, lng2))
+
+def get_fences(redis_conn):
+    """Returns all the registered fences as {name: box}"""
+
+    return dict((name, tuple(json.loads(box)))
+                for name, box in redis_conn.hgetall(FENCES_KEY).iteritems())
+
+def save_fence(redis_conn, name, box):
+    """Registers (or replaces) a fence and tells all the workers about it"""
+
+    redis_conn.hset(FENCES_KEY, name, json.dumps(box))
+    redis_conn.publish(changefeed.channel(redis_conn, FENCE_FEED_CHANNEL), name)
+
+def delete_fence(redis_conn, name):
+    """Removes a fence, returns False if there was no such fence"""
+
+    if not redis_conn.hdel(FENCES_KEY, name):
+        return False
+    redis_conn.publish(changefeed.channel(redis_conn, FENCE_FEED_CHANNEL), name)
+    return True
+
+def start(redis_conn):
+    """Builds a FenceIndex from redis and keeps it in sync in the background."""
+
+    index = FenceIndex()
+
+    def on_message(name):
+        #the message only names the fence, redis has the current state
+        box = redis_conn.hget(FENCES_KEY, name)
+        if box is None:
+            index.remove(name)
+        else:
+            index.add(name, json.loads(box))
+
+    def on_resync():
+        index.load(get_fences(redis_conn))
+
+    changefeed.follow(redis_conn, changefeed.channel(redis_conn, FENCE_FEED_CHANNEL), on_message, on_resync)
+    return index
+
+def match_events(redis_conn, pipe, index, events, now_seconds):
+    """Works out which fences the trips entered/exited with the (message,
+    geohash) <events> of a request and queues the transitions on the pipeline
+    <pipe>. An 'end' event exits all the trip's fences.
+
+    The fences of all the trips are read in one round trip, and followed
+    from event to event, so a trip can move several times in one batch.
+    """
+
+    trip_ids = sorted(set(message['tripId'] for message, geohash_string in events))
+    with redis_conn.pipeline(transaction=False) as read:
+        for trip_id in trip_ids:
+            read.smembers('trip_fences:{0}'.format(trip_id))
+        trip_fences = dict(zip(trip_ids, read.execute()))
+
+    for message, geohash_string in events:
+        if message['event'].lower() == 'end':
+            inside = set()
+        else:
+            inside = index.containing(message['lat'], message['lng'], geohash_string)
+
+        trip_fences_key = 'trip_fences:{0}'.format(message['tripId'])
+        previous = trip_fences[message['tripId']]
+
+        entered = inside - previous
+        left = previous - inside
+        if not (entered or left):
+            continue
+        trip_fences[message['tripId']] = inside
+
+        #a fence deleted since the trip entered it has no exit to tell, it just
+        #leaves the trip's set
+        exited = index.known(left)
+
+        for transition, names in (('enter', entered), ('exit', exited)):
+            for name in names:
+                pipe.publish(FENCE_EVENTS_CHANNEL.format(name), json.dumps({
+                    'fence': name,
+                    'tripId': message['tripId'],
+                    'transition': transition,
+                    'lat': message['lat'],
+                    'lng': message['lng'],
+                    'time': now_seconds,
+                    }))
+
+        if left:
+            pipe.srem(trip_fences_key, *left)
+        if entered:
+            pipe.sadd(trip_fences_key, *entered)
+            pipe.expire(trip_fences_key, TRIP_FENCES_EXPIRY)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import math
+
+import numpy
+
+__doc__ = """
+        Deterministic synthetic fleets, for benchmarks, load generation and
+        bulk loads: the same seed always gives the same events, so runs on two
+        commits see exactly the same traffic.
+
+        The vehicles drive continuous trips, the way the real ones do, so
+        consecutive updates of a trip are a few meters apart in neighbouring
+        cells (which caching and dedupe depend on):
+
+        - an idle vehicle picks up a fare after an exponential wait, shorter
+          at busy hours (DEMAND, one multiplier per hour of the day, utc)
+        - trips begin around the HOT_SPOTS, weighted by HOT_SPOT_WEIGHTS, and
+          go either to another hot spot or a few km away in any direction
+        - the route is an L along the street grid (lat first or lng first),
+          driven at a per trip speed (~30 km/h, slower at busy hours), with
+          an update every tick
+        - the fare is a flag fall plus distance and time
+
+        It is a pure numpy simulation of all the vehicles at once (no django,
+        so client/publisher.py can use it too): Fleet.tick() moves the whole
+        fleet one tick and returns the events of that tick as an EVENT_DTYPE
+        array, which is fast enough for 100k vehicles.
+"""
+
+#where trips happen in SF, (lat, lng, spread in degrees)
+HOT_SPOTS = ((37.7897, -122.4011, 0.01),   #financial district
+             (37.7765, -122.4167, 0.015),  #soma/civic center
+             (37.7599, -122.4148, 0.01),   #mission
+             (37.6213, -122.3790, 0.005),  #sfo
+             (37.7749, -122.4194, 0.04),   #the rest of the city
+             (37.8025, -122.4058, 0.005),  #north beach
+             (37.7763, -122.3942, 0.004))  #caltrain
+
+HOT_SPOT_WEIGHTS = (0.25, 0.2, 0.12, 0.08, 0.2, 0.08, 0.07)
+
+#share of the fleet out on trips by hour of the day (utc, so SF's early
+#morning lull is around 10-13h)
+DEMAND = (0.85, 0.9, 0.95, 1.0, 1.0, 0.95, 0.9, 0.8, 0.7, 0.6, 0.45, 0.3,
+          0.25, 0.35, 0.55, 0.75, 0.85, 0.8, 0.75, 0.8, 0.85, 0.8, 0.8, 0.85)
+
+#same codes as journal.EVENTS
+EVENTS = ('begin', 'update', 'end')
+
+EVENT_DTYPE = numpy.dtype([('time', '<f8'), ('trip', '<i8'), ('lat', '<f8'), ('lng', '<f8'),
+                           ('event', 'u1'), ('fare', '<f8')])
+
+METERS_PER_DEGREE = 111320.0
+
+#mean wait for a fare at the busiest hour, in seconds
+IDLE_SECONDS = 300
+
+#trip speed, meters per second
+SPEED = 8.5
+
+#fare: flag fall, per km, per minute
+FARE = (3.5, 1.7, 0.3)
+
+def demand(seconds):
+    """DEMAND at epoch <seconds>, interpolated between the hours"""
+
+    hours = (numpy.asarray(seconds, dtype=numpy.float64) / 3600.0) % 24
+    return numpy.interp(hours, numpy.arange(25), DEMAND + DEMAND[:1])
+
+def points(count, random):
+    """<count> (lats, lngs) around the hot spots, drawn from the numpy
+    RandomState <random>"""
+
+    weights = numpy.array(HOT_SPOT_WEIGHTS) / sum(HOT_SPOT_WEIGHTS)
+    spots = numpy.array(HOT_SPOTS)[random.choice(len(HOT_SPOTS), size=count, p=weights)]
+    return random.normal(spots[:, 0], spots[:, 2]), random.normal(spots[:, 1], spots[:, 2])
+
+class Fleet(object):
+    """<vehicles> vehicles from epoch <start>, moved <tick> seconds at a time"""
+
+    def __init__(self, vehicles, seed=0, start=0.0, tick=1.0):
+        self.random = numpy.random.RandomState(seed)
+        self.now = float(start)
+        self.tick_seconds = float(tick)
+        self.next_trip = 1
+
+        count = vehicles
+        self.trip = numpy.zeros(count, dtype=numpy.int64)
+        self.driving = numpy.zeros(count, dtype=bool)
+        #the share of the fleet that would be out on trips at <start> gets a
+        #fare within the first minute, the rest after the usual wait
+        self.idle_until = self.now + numpy.where(self.random.uniform(size=count) < demand(self.now),
+                                                 self.random.uniform(0, 60, count),
+                                                 self.random.exponential(IDLE_SECONDS / demand(self.now), count))
+        #events of a tick are spread over it, each vehicle at its own phase
+        self.phase = self.random.uniform(0, self.tick_seconds, count)
+
+        #route: origin, corner, destination, and how far along it we are
+        self.origin = numpy.zeros((count, 2))
+        self.corner = numpy.zeros((count, 2))
+        self.destination = numpy.zeros((count, 2))
+        self.first_leg = numpy.zeros(count)
+        self.length = numpy.zeros(count)
+        self.travelled = numpy.zeros(count)
+        self.speed = numpy.zeros(count)
+        self.began = numpy.zeros(count)
+
+    def __len__(self):
+        return len(self.trip)
+
+    def _begin(self, vehicles):
+        """Starts a trip for each of <vehicles>"""
+
+        count = len(vehicles)
+        random = self.random
+
+        self.trip[vehicles] = numpy.arange(self.next_trip, self.next_trip + count)
+        self.next_trip += count
+
+        lats, lngs = points(count, random)
+        self.origin[vehicles] = numpy.c_[lats, lngs]
+
+        #to another hot spot, or some km away
+        to_spot = random.uniform(size=count) < 0.4
+        spot_lats, spot_lngs = points(count, random)
+        distance = numpy.clip(random.lognormal(math.log(2500), 0.6, count), 200, 25000)
+        bearing = random.uniform(0, 2 * math.pi, count)
+        away_lats = lats + distance * numpy.cos(bearing) / METERS_PER_DEGREE
+        away_lngs = lngs + distance * numpy.sin(bearing) / (METERS_PER_DEGREE * numpy.cos(numpy.radians(lats)))
+        destination = numpy.c_[numpy.where(to_spot, spot_lats, away_lats), numpy.where(to_spot, spot_lngs, away_lngs)]
+        self.destination[vehicles] = destination
+
+        #along the street grid: lat first or lng first
+        lat_first = random.uniform(size=count) < 0.5
+        self.corner[vehicles] = numpy.c_[numpy.where(lat_first, destination[:, 0], lats),
+                                         numpy.where(lat_first, lngs, destination[:, 1])]
+
+        first, second = self._leg_lengths(vehicles)
+        self.first_leg[vehicles] = first
+        self.length[vehicles] = first + second
+        self.travelled[vehicles] = 0
+        self.speed[vehicles] = numpy.clip(random.lognormal(math.log(SPEED), 0.25, count), 3, 20)
+        self.began[vehicles] = self.now
+        self.driving[vehicles] = True
+
+    def _meters(self, a, b):
+        """Street grid distance between the points of the rows of <a> and <b>"""
+
+        scale = numpy.cos(numpy.radians(a[:, 0])) * METERS_PER_DEGREE
+        return numpy.abs(a[:, 0] - b[:, 0]) * METERS_PER_DEGREE + numpy.abs(a[:, 1] - b[:, 1]) * scale
+
+    def _leg_lengths(self, vehicles):
+        return (self._meters(self.origin[vehicles], self.corner[vehicles]),
+                self._meters(self.corner[vehicles], self.destination[vehicles]))
+
+    def _positions(self, vehicles):
+        """Where <vehicles> are along their route"""
+
+        travelled = self.travelled[vehicles]
+        first = self.first_leg[vehicles]
+        second = self.length[vehicles] - first
+
+        on_first = travelled < first
+        along_first = numpy.clip(travelled / numpy.maximum(first, 1e-9), 0, 1)[:, None]
+        along_second = numpy.clip((travelled - first) / numpy.maximum(second, 1e-9), 0, 1)[:, None]
+
+        origin, corner, destination = self.origin[vehicles], self.corner[vehicles], self.destination[vehicles]
+        return numpy.where(on_first[:, None], origin + (corner - origin) * along_first,
+                           corner + (destination - corner) * along_second)
+
+    def tick(self):
+        """Moves the fleet one tick. Returns the events of the tick as an
+        EVENT_DTYPE array, in vehicle order."""
+
+        self.now += self.tick_seconds
+        busy = demand(self.now)
+
+        #drive on, busy hours are slower
+        driving = numpy.flatnonzero(self.driving)
+        self.travelled[driving] += self.speed[driving] * self.tick_seconds * (1.3 - 0.5 * busy)
+        arrived = driving[self.travelled[driving] >= self.length[driving]]
+        moving = driving[self.travelled[driving] < self.length[driving]]
+
+        #new fares
+        starting = numpy.flatnonzero(~self.driving & (self.idle_until <= self.now))
+        self._begin(starting)
+
+        events = numpy.zeros(len(arrived) + len(moving) + len(starting), dtype=EVENT_DTYPE)
+        parts = ((arrived, 2, self.destination[arrived]),
+                 (moving, 1, self._positions(moving)),
+                 (starting, 0, self.origin[starting]))
+        at = 0
+        for vehicles, code, position in parts:
+            part = events[at:at + len(vehicles)]
+            part['time'] = self.now - self.tick_seconds + self.phase[vehicles]
+            part['trip'] = self.trip[vehicles]
+            part['lat'] = position[:, 0]
+            part['lng'] = position[:, 1]
+            part['event'] = code
+            at += len(vehicles)
+
+        #the fares, and back to waiting
+        ended = events[:len(arrived)]
+        minutes = (self.now - self.began[arrived]) / 60
+        ended['fare'] = numpy.round(FARE[0] + FARE[1] * self.length[arrived] / 1000 + FARE[2] * minutes, 2)
+        self.driving[arrived] = False
+        self.idle_until[arrived] = self.now + self.random.exponential(IDLE_SECONDS / busy, len(arrived))
+
+        return events[numpy.argsort(events['time'], kind='mergesort')]
+
+def messages(events):
+    """The /trips/ payloads of an EVENT_DTYPE array"""
+
+    for event in events:
+        message = {'event': EVENTS[event['event']], 'tripId': int(event['trip']),
+                   'lat': round(float(event['lat']), 6), 'lng': round(float(event['lng']), 6)}
+        if message['event'] == 'end':
+            message['fare'] = float(event['fare'])
+        yield message
+
+def events(vehicles, seed=0, start=0.0):
+    """Generates the /trips/ payloads of a Fleet, tick after tick"""
+
+    fleet = Fleet(vehicles, seed, start)
+    while True:
+        for message in messages(fleet.tick()):
+            yield message
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import numpy
+
+__doc__ = """
+        Small geohash helpers that the python-geohash module does not give us.
+
+        All the geohashes we store are full precision (12 chars, the default of
+        geohash.encode). 12 base32 chars are 60 bits, so a cell fits in a single
+        machine long and sorts in the same order as its string. That lets the
+        worker-local indexes keep cells in flat arrays instead of lists of strings.
+"""
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_BASE32_VALUES = dict((c, i) for i, c in enumerate(BASE32))
+_BASE32_BYTES = numpy.frombuffer(BASE32, dtype=numpy.uint8)
+
+#geohash.encode() default, i.e. the length of every geohash we store
+PRECISION = 12
+
+def cell_to_int(cell):
+    """Converts a geohash (or a geohash prefix) into its 60 bit integer value.
+
+    A prefix is padded on the right, so it maps to the smallest full precision
+    cell that starts with it.
+    """
+
+    value = 0
+    for c in cell:
+        value = (value << 5) | _BASE32_VALUES[c]
+    return value << (5 * (PRECISION - len(cell)))
+
+def int_to_cell(value, precision=PRECISION):
+    """Inverse of cell_to_int(), truncated to <precision> chars."""
+
+    chars = []
+    for i in range(PRECISION):
+        chars.append(BASE32[value & 31])
+        value >>= 5
+    chars.reverse()
+    return ''.join(chars[:precision])
+
+def prefix_range(prefix):
+    """Returns the half open [lo, hi) integer range of all cells under <prefix>"""
+
+    lo = cell_to_int(prefix)
+    return lo, lo + (1 << (5 * (PRECISION - len(prefix))))
+
+def common_prefix(first, second):
+    """The longest prefix the two geohashes share, i.e. the smallest cell
+    holding both"""
+
+    for i in range(min(len(first), len(second))):
+        if first[i] != second[i]:
+            return first[:i]
+    return first[:min(len(first), len(second))]
+
+def _bits(precision):
+    """(lat bits, lng bits) of a cell of <precision> chars. lng gets the odd bit"""
+
+    bits = 5 * precision
+    return bits // 2, (bits + 1) // 2
+
+def cell_dimensions(precision):
+    """(height, width) in degrees of a cell of <precision> chars"""
+
+    lat_bits, lng_bits = _bits(precision)
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+def _grid_index(value, lower, size, bits):
+    """Row/column of the grid cell holding <value>, clamped to the grid"""
+
+    return max(0, min(int((value - lower) / size), (1 << bits) - 1))
+
+def _cell_from_grid(lat_index, lng_index, precision):
+    """Geohash of the cell at row <lat_index>, column <lng_index> of the grid"""
+
+    lat_bits, lng_bits = _bits(precision)
+
+    #geohash bits alternate lng, lat, lng, ... starting with the most significant
+    value = 0
+    for i in range(5 * precision):
+        if i % 2:
+            bit = (lat_index >> (lat_bits - 1 - i // 2)) & 1
+        else:
+            bit = (lng_index >> (lng_bits - 1 - i // 2)) & 1
+        value = (value << 1) | bit
+
+    return int_to_cell(value << (5 * (PRECISION - precision)), precision)
+
+def _box_grid(south, west, north, east, precision):
+    """Row and column ranges of the cells of <precision> that overlap the box"""
+
+    height, width = cell_dimensions(precision)
+    lat_bits, lng_bits = _bits(precision)
+
+    rows = xrange(_grid_index(south, -90.0, height, lat_bits),
+                 _grid_index(north, -90.0, height, lat_bits) + 1)
+    columns = xrange(_grid_index(west, -180.0, width, lng_bits),
+                    _grid_index(east, -180.0, width, lng_bits) + 1)
+    return rows, columns
+
+def cover_box_count(south, west, north, east, precision):
+    """How many cells cover_box() would return, without building them"""
+
+    rows, columns = _box_grid(south, west, north, east, precision)
+    return len(rows) * len(columns)
+
+def cover_box(south, west, north, east, precision):
+    """Returns the geohashes of <precision> chars of all cells overlapping the box"""
+
+    rows, columns = _box_grid(south, west, north, east, precision)
+    return [_cell_from_grid(row, column, precision) for row in rows for column in columns]
+
+def _grid_from_cell(cell):
+    """Inverse of _cell_from_grid(), (lat_index, lng_index) of <cell>"""
+
+    value = 0
+    for c in cell:
+        value = (value << 5) | _BASE32_VALUES[c]
+
+    bits = 5 * len(cell)
+    lat_index = lng_index = 0
+    for i in range(bits):
+        bit = (value >> (bits - 1 - i)) & 1
+        if i % 2:
+            lat_index = (lat_index << 1) | bit
+        else:
+            lng_index = (lng_index << 1) | bit
+    return lat_index, lng_index
+
+def cell_bbox(cell):
+    """(south, west, north, east) of the geohash <cell>"""
+
+    height, width = cell_dimensions(len(cell))
+    lat_index, lng_index = _grid_from_cell(cell)
+    south = -90.0 + lat_index * height
+    west = -180.0 + lng_index * width
+    return south, west, south + height, west + width
+
+def ring_cells(lat, lng, precision, radius):
+    """Returns the ring of cells of <precision> chars exactly <radius> steps
+    away (up, down, sideways or diagonally) from the cell of (lat, lng).
+
+    Wraps around the antimeridian, stops at the poles.
+    """
+
+    height, width = cell_dimensions(precision)
+    lat_bits, lng_bits = _bits(precision)
+    row = _grid_index(lat, -90.0, height, lat_bits)
+    column = _grid_index(lng, -180.0, width, lng_bits)
+
+    if not radius:
+        return [_cell_from_grid(row, column, precision)]
+
+    positions = []
+    for offset in range(-radius, radius + 1):
+        positions.append((row - radius, column + offset))
+        positions.append((row + radius, column + offset))
+    for offset in range(-radius + 1, radius):
+        positions.append((row + offset, column - radius))
+        positions.append((row + offset, column + radius))
+
+    columns = 1 << lng_bits
+    cells = set()
+    for r, c in positions:
+        if 0 <= r < (1 << lat_bits):
+            cells.add(_cell_from_grid(r, c % columns, precision))
+    return list(cells)
+
+def _spread_bits(values):
+    """Spreads the low 30 bits of each value out to the even bits of a uint64"""
+
+    values = values & numpy.uint64((1 << 30) - 1)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+    return values
+
+def encode_many(lats, lngs):
+    """geohash.encode() of many points at once, as an array of 12 char strings.
+
+    Same cells as geohash.encode() (longitudes wrap around, latitudes are
+    clamped to the grid), but a whole NumPy array at a time.
+    """
+
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lngs = (numpy.asarray(lngs, dtype=numpy.float64) + 180.0) % 360.0 - 180.0
+
+    lat_bits, lng_bits = _bits(PRECISION)
+    rows = numpy.clip(numpy.floor((lats / 180.0 + 0.5) * (1 << lat_bits)), 0, (1 << lat_bits) - 1)
+    columns = numpy.clip(numpy.floor((lngs / 360.0 + 0.5) * (1 << lng_bits)), 0, (1 << lng_bits) - 1)
+
+    #lng takes the first (odd) bit of each pair
+    values = ((_spread_bits(columns.astype(numpy.uint64)) << numpy.uint64(1)) |
+              _spread_bits(rows.astype(numpy.uint64)))
+
+    shifts = numpy.arange(5 * (PRECISION - 1), -1, -5, dtype=numpy.uint64)
+    chars = _BASE32_BYTES[((values[:, None] >> shifts) & numpy.uint64(31)).astype(numpy.intp)]
+    return chars.view('S{0}'.format(PRECISION)).ravel()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from itertools import product
+
+from django.conf import settings
+import numpy
+
+from geofencing.dispatch.geo import BASE32, cover_box, cover_box_count
+from geofencing.dispatch.scripts import script
+
+__doc__ = """
+        Per-cell trip density for map tiles and viewports.
+
+        The geohash:* keys are per full precision geohash, so adding up a
+        coarse cell from them means reading every active cell under it. Instead
+        ingest also rolls each event up into the coarser cells the map shows,
+        one hash per precision and time bucket:
+
+        redis schema
+        ============
+        heatmap:<precision>:days:YYYY-M-D => hash of
+        heatmap:<precision>:weeks:WW          <cell>:s => trips started in <cell>
+                                              <cell>:e => trips ended in <cell>
+                                              <cell>:f => sum of their fares
+
+        heatmap:<precision>:days:YYYY-M-D:<cell> => HyperLogLog of the tripIds
+        heatmap:<precision>:weeks:WW:<cell>          seen in <cell> (needs redis >= 2.8.9)
+
+        heatmap_trip:<tripId> => days:YYYY-M-D|<geohash> of the trip's last
+            event, expires TRIP_TTL seconds after it
+
+        (the day and week buckets of buckets.sub_keys(): the month and day
+        are not zero padded)
+
+        Most events are updates of a trip staying in the same coarse cells, so
+        the HyperLogLogs of a cell are only added to when a trip begins or
+        ends in it, or enters it (or a new day starts) since its last event,
+        as heatmap_trip:<tripId> tells. That is one script call per event, and
+        the counters only change on begin/end. Each worker sets the expiry of
+        the bucket hashes once.
+
+        for each precision in HEATMAP_PRECISIONS. A viewport of N cells over B
+        buckets is then B HMGETs plus N PFCOUNTs (which merge the buckets'
+        HyperLogLogs for us), all in one pipeline.
+"""
+
+#precisions we keep rollups for, i.e. the ones a map can ask for. empty turns
+#the rollups (and the heatmap) off
+HEATMAP_PRECISIONS = getattr(settings, 'GEOFENCE_HEATMAP_PRECISIONS', (4, 5, 6, 7))
+
+#biggest grid a single request can ask for
+MAX_CELLS = 4096
+
+#same as the trips_counter keys
+EXPIRY = 90*24*60*60
+
+#how long browsers/nginx may cache a heatmap response, in seconds
+MAX_AGE = getattr(settings, 'GEOFENCE_HEATMAP_MAX_AGE', 60)
+
+#how long a trip's last cell is kept, a trip quiet for longer is added again
+TRIP_TTL = 60*60
+
+#dtype of the binary format, one record per cell
+RECORD_DTYPE = numpy.dtype([('cell', 'S12'), ('start', '<i4'), ('stop', '<i4'),
+                            ('fare', '<f8'), ('trips', '<i4')])
+
+#KEYS[1] heatmap_trip:<tripId>, ARGV tripId, geohash, event, EXPIRY, TRIP_TTL,
+#the sub keys (the day's first)
+_TRIPS_SCRIPT = """
+local last_cell = ''
+local last = redis.call('GET', KEYS[1])
+if last then
+    local sep = string.find(last, '|', 1, true)
+    if string.sub(last, 1, sep - 1) == ARGV[6] then
+        last_cell = string.sub(last, sep + 1)
+    end
+end
+for _, precision in ipairs({{{precisions}}}) do
+    local cell = string.sub(ARGV[2], 1, precision)
+    if ARGV[3] ~= 'update' or string.sub(last_cell, 1, precision) ~= cell then
+        for i = 6, #ARGV do
+            local key = 'heatmap:' .. precision .. ':' .. ARGV[i] .. ':' .. cell
+            redis.call('PFADD', key, ARGV[1])
+            if redis.call('TTL', key) < 0 then
+                redis.call('EXPIRE', key, ARGV[4])
+            end
+        end
+    end
+end
+if ARGV[3] == 'end' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SETEX', KEYS[1], ARGV[5], ARGV[6] .. '|' .. ARGV[2])
+end
+""".format(precisions=', '.join(str(precision) for precision in HEATMAP_PRECISIONS))
+
+#the bucket hashes this worker has set the expiry of
+_expiring = set()
+
+def record_event(pipe, message, geohash_string, candidate_sub_keys):
+    """Rolls the event up into the heatmap of every precision, for each of the
+    days:<date>/weeks:<week> buckets given (the day's first). Queued on the
+    pipeline <pipe>."""
+
+    if not HEATMAP_PRECISIONS:
+        return
+
+    event = message['event'].lower()
+    if event not in ('begin', 'end'):
+        event = 'update'
+
+    for precision in HEATMAP_PRECISIONS:
+        cell = geohash_string[:precision]
+        for sub_key in candidate_sub_keys:
+            key = 'heatmap:{0}:{1}'.format(precision, sub_key)
+            if event == 'begin':
+                pipe.hincrby(key, cell + ':s', 1)
+            elif event == 'end':
+                pipe.hincrby(key, cell + ':e', 1)
+                pipe.hincrbyfloat(key, cell + ':f', float(message['fare']))
+            else:
+                continue
+            if key not in _expiring:
+                #the buckets change daily, forget yesterday's
+                if len(_expiring) > 4 * len(HEATMAP_PRECISIONS) * len(candidate_sub_keys):
+                    _expiring.clear()
+                _expiring.add(key)
+                pipe.expire(key, EXPIRY)
+
+    script(pipe, _TRIPS_SCRIPT)(keys=['heatmap_trip:{0}'.format(message['tripId'])],
+        args=[message['tripId'], geohash_string, event, EXPIRY, TRIP_TTL] + list(candidate_sub_keys), client=pipe)
+
+def tile_cells(tile, precision):
+    """All the cells of <precision> chars under the geohash prefix <tile>
+
+    Raises ValueError if that is more than MAX_CELLS cells.
+    """
+
+    depth = precision - len(tile)
+    if depth < 0 or 32 ** depth > MAX_CELLS:
+        raise ValueError('precision out of range for this tile')
+    return [tile + ''.join(suffix) for suffix in product(BASE32, repeat=depth)]
+
+def viewport_cells(south, west, north, east, precision):
+    """All the cells of <precision> chars overlapping the viewport
+
+    Raises ValueError if that is more than MAX_CELLS cells.
+    """
+
+    if cover_box_count(south, west, north, east, precision) > MAX_CELLS:
+        raise ValueError('too many cells for this viewport')
+    return cover_box(south, west, north, east, precision)
+
+def grid(redis_conn, cells, precision, candidate_sub_keys, deadline=None):
+    """Returns the non-empty cells as a RECORD_DTYPE array, in <cells> order
+
+    With an admission.Deadline, in one round trip per chunk of cells,
+    checking it before each one.
+    """
+
+    if not (cells and candidate_sub_keys):
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+
+    if deadline is not None:
+        return numpy.concatenate([_grid(redis_conn, chunk, precision, candidate_sub_keys)
+                                  for chunk in deadline.chunks(cells, len(candidate_sub_keys))])
+    return _grid(redis_conn, cells, precision, candidate_sub_keys)
+
+def _grid(redis_conn, cells, precision, candidate_sub_keys):
+    """grid() of <cells>, in one round trip"""
+
+    fields = []
+    for cell in cells:
+        fields.extend((cell + ':s', cell + ':e', cell + ':f'))
+
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for sub_key in candidate_sub_keys:
+            pipe.hmget('heatmap:{0}:{1}'.format(precision, sub_key), fields)
+        for cell in cells:
+            pipe.execute_command('PFCOUNT', *['heatmap:{0}:{1}:{2}'.format(precision, sub_key, cell)
+                                              for sub_key in candidate_sub_keys])
+        results = pipe.execute()
+
+    #one row of [start, stop, fare] per cell, added up over the buckets
+    totals = numpy.zeros(3 * len(cells))
+    for values in results[:len(candidate_sub_keys)]:
+        totals += numpy.array([float(v) if v is not None else 0.0 for v in values])
+    totals = totals.reshape(len(cells), 3)
+    trips = numpy.array(results[len(candidate_sub_keys):], dtype=numpy.int64)
+
+    records = numpy.zeros(len(cells), dtype=RECORD_DTYPE)
+    records['cell'] = cells
+    records['start'] = totals[:, 0]
+    records['stop'] = totals[:, 1]
+    records['fare'] = totals[:, 2]
+    records['trips'] = trips
+
+    return records[(trips > 0) | (totals != 0).any(axis=1)]
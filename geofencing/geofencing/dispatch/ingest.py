@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import calendar
+import json
+import math
+
+import geohash
+import numpy
+
+from geofencing.dispatch import active, fares, fences as geofences, geo, heatmap as heatmaps, journal, leaderboard, od, wire
+
+__doc__ = """
+        What /trips/ does with the events it is sent: checking them and
+        writing them into the schema of the README. Shared by the trips()
+        view and the standalone ingest server (ingest_server.py, next to
+        manage.py), so both answer and write exactly the same.
+
+        A body is one json event, or a json array of events (a batch), or
+        with the Content-Type wire.CONTENT_TYPE packed binary events (see
+        wire.py). The events of a batch are geohashed all at once. Packed
+        events stay a record array: they are journaled and their core
+        counters added up per cell with NumPy, as rebuild.py does, and only
+        the per trip features go through them one by one. The core
+        schema writes of a whole body go out in one pipeline (see batch() in
+        storage.py), then the writes of the redis-only features (heatmap, OD
+        matrix, leaderboards, active trips, fare histograms, geofences) in
+        another, so a body costs a handful of round trips however many
+        events it has.
+"""
+
+class InvalidEvent(ValueError):
+    """An event not in the format of publisher.py, the message says why"""
+
+def parse(body, content_type=None):
+    """The events of a /trips/ body, as a list (a wire.WIRE_DTYPE array if
+    packed). Raises InvalidEvent if one of them is not well formed, and
+    ValueError if the body is not json."""
+
+    if content_type and content_type.split(';')[0].strip().lower() == wire.CONTENT_TYPE:
+        try:
+            return wire.unpack(body)
+        except wire.WireError, e:
+            raise InvalidEvent(str(e))
+
+    messages = json.loads(body)
+    if not isinstance(messages, list):
+        messages = [messages]
+
+    for message in messages:
+        #basic sanity checking...
+        if not (isinstance(message, dict) and message.has_key('event') and message.has_key('tripId') and
+           message.has_key('lat') and message.has_key('lng')):
+            raise InvalidEvent('Input json is not in correct format')
+        if message['event'] == 'end' and not message.has_key('fare'):
+            raise InvalidEvent('Input json is not in correct format (fare missing in "end" event)')
+        #json takes NaN and Infinity, which no histogram bin holds
+        if str(message['event']).lower() == 'end' and not _finite(message.get('fare')):
+            raise InvalidEvent('Input json is not in correct format (fare of "end" event is not a number)')
+    return messages
+
+def _finite(value):
+    """Whether <value> is a finite number"""
+
+    try:
+        return not (math.isnan(float(value)) or math.isinf(float(value)))
+    except (TypeError, ValueError):
+        return False
+
+def record(store, messages, now, fence_index=None):
+    """Writes the events <messages> (as parse() returns them) into <store>,
+    as arrived at <now> (utc). <fence_index> is the worker's FenceIndex, for
+    the geofence transitions."""
+
+    now_seconds = calendar.timegm(now.timetuple())
+
+    #extract the date this timestamp corresponds to
+    current_date = '{0}-{1}-{2}'.format(now.year, now.month, now.day)
+    current_week = now.strftime('%U')
+
+    if isinstance(messages, numpy.ndarray):
+        records = messages
+        cells = geo.encode_many(records['lat'], records['lng'])
+        with store.batch() as writer:
+            journal.append_records(now, records)
+            _record_core_many(writer, records, cells, now_seconds, current_date, current_week)
+        messages = wire.messages(records)
+        geohash_strings = cells.tolist()
+
+    else:
+        if len(messages) == 1:
+            geohash_strings = [geohash.encode(messages[0]['lat'], messages[0]['lng'])]
+        else:
+            geohash_strings = geo.encode_many([message['lat'] for message in messages],
+                                              [message['lng'] for message in messages]).tolist()
+
+        with store.batch() as writer:
+            for message, geohash_string in zip(messages, geohash_strings):
+                #keep the raw event, so the aggregates below can be rebuilt from it
+                journal.append(now, message)
+                _record_core(writer, message, geohash_string, now_seconds, current_date, current_week)
+
+    #the rest are the redis-only features
+    if store.redis_conn is None:
+        return
+
+    candidate_sub_keys = ['days:{0}'.format(current_date), 'weeks:{0}'.format(current_week)]
+
+    with store.redis_conn.pipeline(transaction=False) as pipe:
+        for message, geohash_string in zip(messages, geohash_strings):
+            #roll the event up into the coarser cells of the heatmap
+            heatmaps.record_event(pipe, message, geohash_string, candidate_sub_keys)
+
+            #remember where the trip began, so its end can go in the OD matrix
+            od.record_event(pipe, message, geohash_string, candidate_sub_keys)
+
+            #count it in the busiest cells leaderboards of this hour
+            leaderboard.record_event(pipe, message, geohash_string, now)
+
+            #keep track of where the active trips are right now
+            active.record_event(pipe, message, geohash_string, now_seconds)
+
+            #and the fare distribution of the cell, for the percentiles
+            if message['event'].lower() == 'end':
+                fares.record_fare(pipe, [
+                    'geohash:{0}:{1}:fare_histogram'.format(geohash_string, sub_key) for sub_key in candidate_sub_keys
+                    ], message['fare'])
+
+        #tell the subscribers of any geofence these trips entered/exited
+        if fence_index is not None and len(fence_index):
+            geofences.match_events(store.redis_conn, pipe, fence_index, zip(messages, geohash_strings), now_seconds)
+
+        pipe.execute()
+
+def _record_core(writer, message, geohash_string, now_seconds, current_date, current_week):
+    """The core schema writes of one event, through the batch <writer>"""
+
+    #keys for counters for the geohash, by day
+    geohash_day_tripset_key = 'geohash:{0}:days:{1}:tripids'.format(geohash_string, current_date)
+    geohash_day_startcounter_key = 'geohash:{0}:days:{1}:tot_start_counter'.format(geohash_string, current_date)
+    geohash_day_stopcounter_key = 'geohash:{0}:days:{1}:tot_stop_counter'.format(geohash_string, current_date)
+    geohash_day_farecounter_key = 'geohash:{0}:days:{1}:tot_fare_counter'.format(geohash_string, current_date)
+
+    #keys for counters for the geohash, by week
+    geohash_week_tripset_key = 'geohash:{0}:weeks:{1}:tripids'.format(geohash_string, current_week)
+    geohash_week_startcounter_key = 'geohash:{0}:weeks:{1}:tot_start_counter'.format(geohash_string, current_week)
+    geohash_week_stopcounter_key = 'geohash:{0}:weeks:{1}:tot_stop_counter'.format(geohash_string, current_week)
+    geohash_week_farecounter_key = 'geohash:{0}:weeks:{1}:tot_fare_counter'.format(geohash_string, current_week)
+
+    #we are passing thorugh this geohash, so update the sorted set
+    #NOTE that it should be a set so that if there are multiple updates
+    #within a geohash, only one tripid is added into the set.
+    writer.zadd(geohash_day_tripset_key, 0, message['tripId'])
+    writer.zadd(geohash_week_tripset_key, 0, message['tripId'])
+
+    #are we an event that impacts start/stop counts?
+    if message['event'].lower() in ['begin', 'end']:
+
+        if message['event'].lower() == 'begin':
+
+            #one more trip under way, at this point in time
+            writer.update_trips(1, now_seconds, message['tripId'])
+
+            #begin event within a geohash, update it's counter
+            writer.incr(geohash_day_startcounter_key)
+            writer.incr(geohash_week_startcounter_key)
+
+        elif message['event'].lower() == 'end':
+
+            writer.update_trips(-1, now_seconds, message['tripId'])
+
+            #end event within a geohash, update it's counter
+            writer.incr(geohash_day_stopcounter_key)
+            writer.incr(geohash_week_stopcounter_key)
+            writer.incrbyfloat(geohash_day_farecounter_key, float(message['fare']))
+            writer.incrbyfloat(geohash_week_farecounter_key, float(message['fare']))
+
+    #we now have to store the geohash_string for this lat/lng in such a
+    #way, so that it is quickly retrivable during search. But the user
+    #can type in any bounding box. The property of geohashes is that if
+    #they are close together they will share the same prefix. Also as you
+    #move left in the geohash, you loose accuracy i.e. the bounding box becomes bigger.
+    #Thus we need an efficient way, once given the bounding box, find the common
+    #prefix of the two edges and then use this common prefix for all the
+    #geohashes that share the same prefix. Here's a solution using
+    #sorted sets (see storage.py)
+
+    #the score is the timestamp, value is the actual geohash
+    #done it this way caus we can then expire elements after a period
+    #of time. I'm not going to implement that here, but using this pattern you
+    #can. See https://groups.google.com/forum/#!topic/redis-db/rXXMCLNkNSs
+    writer.index_cell(geohash_string, now_seconds)
+
+def _record_core_many(writer, records, cells, now_seconds, current_date, current_week):
+    """The core schema writes of the packed events <records>, in <cells>,
+    added up per cell: the same as _record_core() of each of them"""
+
+    begins = records['event'] == wire.EVENTS.index('begin')
+    ends = records['event'] == wire.EVENTS.index('end')
+
+    pairs = numpy.empty(len(records), dtype=[('cell', cells.dtype), ('trip', records['trip'].dtype)])
+    pairs['cell'] = cells
+    pairs['trip'] = records['trip']
+    pairs = numpy.unique(pairs)
+
+    started, start_counts = numpy.unique(cells[begins], return_counts=True)
+    stopped, index = numpy.unique(cells[ends], return_inverse=True)
+    stop_counts = numpy.bincount(index, minlength=len(stopped))
+    stop_fares = numpy.bincount(index, weights=records['fare'][ends], minlength=len(stopped))
+
+    for bucket in ('days:{0}'.format(current_date), 'weeks:{0}'.format(current_week)):
+        for cell, trip in pairs.tolist():
+            writer.zadd('geohash:{0}:{1}:tripids'.format(cell, bucket), 0, trip)
+        for cell, count in zip(started.tolist(), start_counts.tolist()):
+            writer.incr('geohash:{0}:{1}:tot_start_counter'.format(cell, bucket), count)
+        for cell, count, fare in zip(stopped.tolist(), stop_counts.tolist(), stop_fares.tolist()):
+            writer.incr('geohash:{0}:{1}:tot_stop_counter'.format(cell, bucket), count)
+            writer.incrbyfloat('geohash:{0}:{1}:tot_fare_counter'.format(cell, bucket), fare)
+
+    for event, trip in zip(records['event'][begins | ends].tolist(), records['trip'][begins | ends].tolist()):
+        writer.update_trips(1 if event == wire.EVENTS.index('begin') else -1, now_seconds, trip)
+
+    for cell in numpy.unique(cells).tolist():
+        writer.index_cell(cell, now_seconds)
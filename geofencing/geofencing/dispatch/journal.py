@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import atexit
+from datetime import datetime
+import glob
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+import numpy
+
+__doc__ = """
+        Append-only journal of the raw events trips() accepted, so the redis
+        aggregates can be rebuilt from scratch (after a schema change, or
+        losing redis).
+
+        Turned on by pointing GEOFENCE_JOURNAL_DIR at a directory.
+
+        Format
+        ======
+        One fixed width, little endian record per event (RECORD_DTYPE, 57
+        bytes, no padding):
+
+            time    float64   epoch seconds (utc) the event was received
+            trip    char[24]  tripId, as a string (longer ids are truncated)
+            lat     float64
+            lng     float64
+            event   uint8     index in EVENTS ('begin', 'update', 'end')
+            fare    float64   0 unless an 'end' event
+
+        Segments are per hour and per writing process (gunicorn workers never
+        share a file, so there is no locking between them):
+
+            <GEOFENCE_JOURNAL_DIR>/events-YYYYMMDDHH-<pid>.bin
+
+        Records are packed into an in-memory buffer and written out with a
+        single os.write() once it holds FLUSH_BYTES, on the first event more
+        than FLUSH_SECONDS after the last write, when the hour turns, or when
+        the process exits. So the hot path is one struct.pack, and a crash
+        loses at most the buffer.
+
+        A segment is read back with read_segment(), a numpy.memmap of the file
+        as a RECORD_DTYPE array: nothing is copied until you touch it.
+"""
+
+JOURNAL_DIR = getattr(settings, 'GEOFENCE_JOURNAL_DIR', None)
+
+FLUSH_BYTES = 64*1024
+FLUSH_SECONDS = 1.0
+
+EVENTS = ('begin', 'update', 'end')
+
+RECORD_DTYPE = numpy.dtype([('time', '<f8'), ('trip', 'S24'), ('lat', '<f8'), ('lng', '<f8'),
+                            ('event', 'u1'), ('fare', '<f8')])
+
+_RECORD = struct.Struct('<d24sddBd')
+
+SEGMENT_HOUR_FORMAT = '%Y%m%d%H'
+
+def event_code(event):
+    """The EVENTS index of <event>. Anything but begin/end is stored as an
+    'update', as that is how the aggregates treat it."""
+
+    event = event.lower()
+    return EVENTS.index(event) if event in ('begin', 'end') else 1
+
+def pack(event_time, message):
+    """One journal record for <message>, received at epoch <event_time>"""
+
+    return _RECORD.pack(event_time, str(message['tripId']), float(message['lat']),
+                        float(message['lng']), event_code(message['event']),
+                        float(message.get('fare') or 0))
+
+def pack_records(event_time, records):
+    """The journal records of the packed events <records> (see wire.py),
+    received at epoch <event_time>, all at once"""
+
+    packed = numpy.zeros(len(records), dtype=RECORD_DTYPE)
+    packed['time'] = event_time
+    packed['trip'] = records['trip'].astype(RECORD_DTYPE['trip'])
+    packed['lat'] = records['lat']
+    packed['lng'] = records['lng']
+    #both have EVENTS in the same order
+    packed['event'] = records['event']
+    packed['fare'] = numpy.where(records['event'] == EVENTS.index('end'), records['fare'], 0)
+    return packed.tostring()
+
+class Journal(object):
+    """Buffered writer of this process's segments. Thread (and greenlet) safe."""
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.hour = None
+        self.fd = None
+        self.flushed_at = time.time()
+
+    def segment_path(self, hour):
+        return os.path.join(self.journal_dir, 'events-{0}-{1}.bin'.format(hour, os.getpid()))
+
+    def append(self, now, message):
+        """Journals <message>, received at the (utc) datetime <now>"""
+
+        self._append(now, pack((now - datetime(1970, 1, 1)).total_seconds(), message))
+
+    def append_records(self, now, records):
+        """Journals the packed events <records> (see wire.py), received at <now>"""
+
+        self._append(now, pack_records((now - datetime(1970, 1, 1)).total_seconds(), records))
+
+    def _append(self, now, record):
+        hour = now.strftime(SEGMENT_HOUR_FORMAT)
+
+        with self.lock:
+            if hour != self.hour:
+                self._flush()
+                self._open(hour)
+            self.buffer.append(record)
+            self.buffered += len(record)
+            if self.buffered >= FLUSH_BYTES or time.time() - self.flushed_at >= FLUSH_SECONDS:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _open(self, hour):
+        if self.fd is not None:
+            os.close(self.fd)
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        self.fd = os.open(self.segment_path(hour), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.hour = hour
+
+    def _flush(self):
+        if self.buffer:
+            os.write(self.fd, ''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.flushed_at = time.time()
+
+#this process's journal, opened on first use (i.e. after gunicorn forks)
+_journal = None
+
+def _get_journal():
+    """This process's journal, None if the journal is turned off in settings"""
+
+    global _journal
+
+    if not JOURNAL_DIR:
+        return None
+    if _journal is None or _journal.journal_dir != JOURNAL_DIR:
+        _journal = Journal(JOURNAL_DIR)
+        atexit.register(_journal.close)
+    return _journal
+
+def append(now, message):
+    """Journals an accepted event, if the journal is turned on in settings"""
+
+    journal = _get_journal()
+    if journal is not None:
+        journal.append(now, message)
+
+def append_records(now, records):
+    """Journals a batch of packed events, if the journal is turned on"""
+
+    journal = _get_journal()
+    if journal is not None:
+        journal.append_records(now, records)
+
+def flush():
+    """Writes out whatever this process has buffered"""
+
+    if _journal is not None:
+        _journal.flush()
+
+def segment_hour(path):
+    """The (utc) datetime of the hour a segment file holds"""
+
+    return datetime.strptime(os.path.basename(path).split('-')[1], SEGMENT_HOUR_FORMAT)
+
+def segments(journal_dir, start=None, end=None):
+    """The segment files in <journal_dir>, oldest hour first, optionally only
+    those of the hours in [start, end)"""
+
+    paths = sorted(glob.glob(os.path.join(journal_dir, 'events-*-*.bin')),
+                   key=lambda path: (segment_hour(path), path))
+    return [path for path in paths
+            if (start is None or segment_hour(path) >= start.replace(minute=0, second=0, microsecond=0)) and
+               (end is None or segment_hour(path) < end)]
+
+def read_segment(path):
+    """The records of a segment as a read-only memory mapped RECORD_DTYPE array.
+
+    A record still being written (a process died halfway through a write)
+    is left out.
+    """
+
+    count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    if not count:
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+    return numpy.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import uuid
+
+from django.conf import settings
+
+from geofencing.dispatch.scripts import script
+
+__doc__ = """
+        Leaderboards of the busiest cells ("where are the hotspots this hour?").
+
+        redis schema
+        ============
+        leaderboard:<precision>:events:<YYYY-M-D-H> => sorted set of cell,
+            scored by the number of events in the cell during that hour
+        leaderboard:<precision>:starts:<YYYY-M-D-H> => same, counting 'begin' events
+
+        for each precision in LEADERBOARD_PRECISIONS, kept for RETENTION_HOURS.
+
+        Each board is bounded: once it holds more than 2 * LEADERBOARD_SIZE
+        cells it is trimmed back to the top LEADERBOARD_SIZE. (trimming only
+        every so often leaves new cells room to climb before the next trim.)
+        So the boards are approximate for the tail, but a cell busy enough to
+        matter is never trimmed.
+
+        A query for the top k cells over a range of hours ZUNIONSTOREs the
+        hourly boards in redis and reads the top of the result.
+"""
+
+LEADERBOARD_PRECISIONS = getattr(settings, 'GEOFENCE_LEADERBOARD_PRECISIONS', (5, 6, 7))
+
+METRICS = ('events', 'starts')
+
+#cells kept per board, also the biggest k a query can ask for
+LEADERBOARD_SIZE = 1000
+
+RETENTION_HOURS = 7*24
+
+_INCREMENT_SCRIPT = """
+redis.call('ZINCRBY', KEYS[1], 1, ARGV[1])
+if redis.call('ZCARD', KEYS[1]) > 2 * tonumber(ARGV[2]) then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+"""
+
+def hour_bucket(moment):
+    """The YYYY-M-D-H bucket of a datetime"""
+
+    return '{0}-{1}-{2}-{3}'.format(moment.year, moment.month, moment.day, moment.hour)
+
+def record_event(pipe, message, geohash_string, now):
+    """Counts the event in the boards of its cell for the hour of <now>.
+    Queued on the pipeline <pipe>."""
+
+    if not LEADERBOARD_PRECISIONS:
+        return
+
+    metrics = ['events']
+    if message['event'].lower() == 'begin':
+        metrics.append('starts')
+
+    increment = script(pipe, _INCREMENT_SCRIPT)
+    hour = hour_bucket(now)
+
+    for precision in LEADERBOARD_PRECISIONS:
+        for metric in metrics:
+            increment(keys=['leaderboard:{0}:{1}:{2}'.format(precision, metric, hour)],
+                      args=[geohash_string[:precision], LEADERBOARD_SIZE, RETENTION_HOURS*60*60],
+                      client=pipe)
+
+def top_cells(redis_conn, precision, metric, now, hours_back, k):
+    """Returns the top <k> (cell, score) over the last <hours_back> hours,
+    the current one included."""
+
+    keys = ['leaderboard:{0}:{1}:{2}'.format(precision, metric, hour_bucket(now - timedelta(hours=i)))
+            for i in range(hours_back)]
+
+    if len(keys) == 1:
+        return [(cell, int(score)) for cell, score in
+                redis_conn.zrevrange(keys[0], 0, k - 1, withscores=True)]
+
+    #merge the hourly boards server side, into a throw-away key
+    merged_key = 'leaderboard:merged:{0}'.format(uuid.uuid4().hex)
+    with redis_conn.pipeline() as pipe:
+        pipe.zunionstore(merged_key, keys)
+        pipe.zrevrange(merged_key, 0, k - 1, withscores=True)
+        pipe.delete(merged_key)
+        top = pipe.execute()[1]
+
+    return [(cell, int(score)) for cell, score in top]
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+import json
+import math
+from optparse import make_option
+import os
+import platform
+import subprocess
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+import numpy
+import redis
+import requests
+
+from geofencing.dispatch import compact, fleet, storage, wire
+from geofencing.dispatch.geo import BASE32
+
+__doc__ = """
+        Benchmarks the ingest and query hot paths, with the same synthetic
+        fleet (see dispatch/fleet.py) every run so runs on two commits can be
+        compared.
+
+            (venv)$ python manage.py benchmark --events 1000,5000 --output before.json
+            (venv)$ git checkout <other commit>
+            (venv)$ python manage.py benchmark --events 1000,5000 --compare before.json
+
+        For each --events scale, the fleet's events are POSTed to /trips/
+        until that many have been sent in all (so the cells grow from one
+        scale to the next) and the events/s recorded, then every combination
+        of box size, days_back and concurrency is queried --requests times on
+        trips_passed_through and trips_start_stop, and time_t_trip_count at
+        random times of the run, recording the latency distribution.
+
+        By default the requests go through the whole django stack in this
+        process (middleware, url resolving, templates), with the storage of
+        --storage: 'redis' writes to the empty scratch db --db of the
+        configured redis (flushed at the end), 'memory' needs no redis at all
+        (the redis-only features are then off, see storage.py). With --url
+        they go over http to a running server instead, and land in whatever
+        redis it uses.
+
+        --ingest-url sends the /trips/ requests to another server than the
+        queries, e.g. the standalone ingest server (ingest_server.py), and
+        --batch posts the events as json arrays of that many, and --format
+        packed as packed binary events (see dispatch/wire.py).
+
+            (venv)$ python manage.py benchmark --url http://127.0.0.1:6789 --ingest-url http://127.0.0.1:6790 --batch 50
+
+        Results are written as JSON to --output (var/bench/<commit>-<time>.json
+        by default). --compare prints the ratios to an older result file.
+"""
+
+PERCENTILES = (50, 90, 99)
+
+#where the results go by default
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..', '..', 'var', 'bench')
+
+#meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+class _InProcess(object):
+    """Sends requests through the django test client, in this process"""
+
+    def __init__(self):
+        self.client = Client()
+
+    def post(self, path, data, content_type=None):
+        if content_type:
+            return self.client.post(path, data, content_type=content_type).status_code
+        return self.client.post(path, data).status_code
+
+class _Remote(object):
+    """Sends requests to a server, over a keep-alive session"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def post(self, path, data, content_type=None):
+        if content_type:
+            return self.session.post(self.url + path, data=data, headers={'Content-Type': content_type}).status_code
+        return self.session.post(self.url + path, data=data).status_code
+
+def _summary(latencies, seconds):
+    """The latency distribution (in ms) of requests that took <seconds> in all"""
+
+    latencies = numpy.array(latencies) * 1000
+    summary = {'requests': len(latencies), 'per_second': len(latencies) / max(seconds, 1e-9)}
+    if len(latencies):
+        summary['latency_ms'] = dict([('p{0}'.format(p), float(numpy.percentile(latencies, p))) for p in PERCENTILES] +
+                                     [('mean', float(latencies.mean())), ('max', float(latencies.max()))])
+    return summary
+
+def _run(make_client, concurrency, requests_per_thread):
+    """Runs <requests_per_thread(i)> (a list of (path, data, content_type)) on
+    <concurrency> threads, one client each. Returns (latencies, seconds, errors)."""
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(i):
+        client = make_client()
+        mine = []
+        failed = 0
+        for path, data, content_type in requests_per_thread(i):
+            started = time.time()
+            if client.post(path, data, content_type) != 200:
+                failed += 1
+            mine.append(time.time() - started)
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.time() - started, errors[0]
+
+def _rate(run):
+    """Events/s of an ingest run, requests/s of the rest"""
+
+    return run.get('events_per_second', run['per_second'])
+
+def _box(lat, lng, meters):
+    """Corners (lat1, lng1, lat2, lng2) of a box <meters> wide centered on lat/lng"""
+
+    half_lat = meters / 2 / METERS_PER_DEGREE
+    half_lng = meters / 2 / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return lat + half_lat, lng - half_lng, lat - half_lat, lng + half_lng
+
+def _commit():
+    """The commit benchmarked, if this is a git checkout"""
+
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def _list(option, cast=str):
+    return [cast(value) for value in option.split(',') if value]
+
+class Command(BaseCommand):
+
+    help = 'Benchmarks the ingest and query hot paths'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--storage', dest='storage', choices=('redis', 'memory'), default='redis',
+            help='storage to benchmark in process (see dispatch/storage.py)'),
+        make_option('--db', dest='db', type='int', default=15,
+            help='scratch redis db for --storage redis, must be empty'),
+        make_option('--url', dest='url', default=None,
+            help='benchmark the server at this url instead, e.g. http://127.0.0.1:6789'),
+        make_option('--ingest-url', dest='ingest_url', default=None,
+            help='send the /trips/ requests to this server instead (needs --url)'),
+        make_option('--batch', dest='batch', type='int', default=1,
+            help='events per /trips/ request, as a json array when more than 1'),
+        make_option('--format', dest='wire_format', choices=('json', 'packed'), default='json',
+            help='encoding of the /trips/ bodies'),
+        make_option('--events', dest='events', default='1000,5000',
+            help='total events ingested before each round of queries, comma separated'),
+        make_option('--vehicles', dest='vehicles', type='int', default=500,
+            help='vehicles in the synthetic fleet'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='seed of the fleet and of the queries'),
+        make_option('--boxes', dest='boxes', default='250,1000,5000',
+            help='box sizes to query, in meters, comma separated'),
+        make_option('--days-back', dest='days_back', default='0d,7d,4w',
+            help='days_back values to query, comma separated'),
+        make_option('--concurrency', dest='concurrency', default='1,4',
+            help='concurrent clients, comma separated'),
+        make_option('--requests', dest='requests', type='int', default=20,
+            help='requests per query combination'),
+        make_option('--output', dest='output', default=None,
+            help='JSON file to write the results to'),
+        make_option('--compare', dest='compare', default=None,
+            help='JSON results of an earlier run to compare with'),
+    )
+
+    def handle(self, *args, **options):
+        from geofencing.dispatch import views
+
+        scales = sorted(_list(options['events'], int))
+        boxes = _list(options['boxes'], float)
+        days_backs = _list(options['days_back'])
+        concurrencies = _list(options['concurrency'], int)
+        if not (scales and boxes and days_backs and concurrencies):
+            raise CommandError('Nothing to benchmark')
+
+        results = {
+            'commit': _commit(),
+            'started': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'target': options['url'] or 'in-process',
+            'storage': None if options['url'] else options['storage'],
+            'layout': None if options['url'] else compact.LAYOUT,
+            'seed': options['seed'],
+            'vehicles': options['vehicles'],
+            'ingest_target': options['ingest_url'],
+            'runs': [],
+        }
+
+        if options['ingest_url'] and not options['url']:
+            raise CommandError('--ingest-url needs --url, for the queries to see what it ingests')
+        batch = max(options['batch'], 1)
+
+        scratch = None
+        if options['url']:
+            make_client = lambda: _Remote(options['url'])
+        else:
+            make_client = _InProcess
+            live_store = views.store
+            if options['storage'] == 'memory':
+                views.store = storage.MemoryStorage()
+            else:
+                scratch = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+                    **dict(views.redis_conn.connection_pool.connection_kwargs, db=options['db'])))
+                if scratch.dbsize():
+                    raise CommandError('db {0} is not empty'.format(options['db']))
+                results['redis'] = scratch.info()['redis_version']
+                views.store = storage.RedisStorage(scratch)
+
+        make_ingest_client = (lambda: _Remote(options['ingest_url'])) if options['ingest_url'] else make_client
+
+        events = fleet.events(options['vehicles'], options['seed'])
+        random = numpy.random.RandomState(options['seed'])
+        ingested = 0
+        ingest_started = datetime.utcnow()
+
+        try:
+            for scale in scales:
+                #ingest up to <scale> events, split between the clients
+                todo = [next(events) for i in range(scale - ingested)]
+                if options['wire_format'] == 'packed':
+                    todo = [wire.pack(todo[i:i + batch]) for i in range(0, len(todo), batch)]
+                    content_type = wire.CONTENT_TYPE
+                else:
+                    todo = [json.dumps(todo[i] if batch == 1 else todo[i:i + batch]) for i in range(0, len(todo), batch)]
+                    content_type = 'application/json'
+                concurrency = max(concurrencies)
+                latencies, seconds, errors = _run(make_ingest_client, concurrency,
+                    lambda i: [('/trips/', body, content_type) for body in todo[i::concurrency]])
+
+                run = dict(_summary(latencies, seconds), benchmark='trips', events=scale,
+                           concurrency=concurrency, errors=errors,
+                           events_per_second=(scale - ingested) / max(seconds, 1e-9))
+                if batch > 1:
+                    run['batch'] = batch
+                if options['wire_format'] != 'json':
+                    run['format'] = options['wire_format']
+                ingested = scale
+                if not options['url']:
+                    run['cells'] = sum(len(cells) for cells in views.store.cells_under(list(BASE32), 0))
+                results['runs'].append(run)
+                self._report(run)
+
+                #then the queries
+                for meters in boxes:
+                    for days_back in days_backs:
+                        for concurrency in concurrencies:
+                            for view in ('trips_passed_through', 'trips_start_stop'):
+                                queries = []
+                                for lat, lng in zip(*fleet.points(options['requests'], random)):
+                                    lat1, lng1, lat2, lng2 = _box(lat, lng, meters)
+                                    queries.append(('/query/{0}/'.format(view), {'lat1': lat1, 'lng1': lng1,
+                                                    'lat2': lat2, 'lng2': lng2, 'days_back': days_back}, None))
+                                run = self._queries(make_client, concurrency, queries,
+                                                    benchmark=view, events=scale, box_m=meters, days_back=days_back)
+                                results['runs'].append(run)
+
+                for concurrency in concurrencies:
+                    span = max((datetime.utcnow() - ingest_started).total_seconds(), 1)
+                    queries = [('/query/trip_count_at_time_t/', {'time_instant': (ingest_started +
+                                timedelta(seconds=float(offset))).strftime('%Y-%m-%d %H:%M:%S')}, None)
+                               for offset in random.uniform(0, span, options['requests'])]
+                    run = self._queries(make_client, concurrency, queries,
+                                        benchmark='time_t_trip_count', events=scale)
+                    results['runs'].append(run)
+
+        finally:
+            if not options['url']:
+                views.store = live_store
+            if scratch is not None:
+                scratch.flushdb()
+
+        output = options['output']
+        if not output:
+            output = os.path.join(BENCH_DIR, '{0}-{1}.json'.format(
+                results['commit'] or 'unknown', datetime.utcnow().strftime('%Y%m%d%H%M%S')))
+        if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        self.stdout.write('results in {0}\n'.format(output))
+
+        if options['compare']:
+            self._compare(options['compare'], results)
+
+    def _queries(self, make_client, concurrency, queries, **run):
+        """Runs the <queries> split between <concurrency> clients"""
+
+        latencies, seconds, errors = _run(make_client, concurrency, lambda i: queries[i::concurrency])
+        run = dict(_summary(latencies, seconds), concurrency=concurrency, errors=errors, **run)
+        self._report(run)
+        return run
+
+    def _report(self, run):
+        self.stdout.write('{0:22} {1:>7} events {2:>7} {3:>4} x{4:<3} {5:8.0f}/s  {6}{7}\n'.format(
+            run['benchmark'], run['events'], '{0:.0f}m'.format(run['box_m']) if 'box_m' in run else '',
+            run.get('days_back', ''), run['concurrency'], _rate(run),
+            '  '.join('{0} {1:.1f}ms'.format(name, run['latency_ms'][name]) for name in ('p50', 'p99'))
+                if 'latency_ms' in run else '',
+            '  {0} errors'.format(run['errors']) if run['errors'] else ''))
+
+    def _compare(self, path, results):
+        """Prints the rate and p99 ratios of the runs also in the results at <path>"""
+
+        with open(path) as f:
+            before = json.load(f)
+
+        def name(run):
+            return tuple(run.get(field) for field in ('benchmark', 'events', 'box_m', 'days_back', 'concurrency', 'batch',
+                                                      'format'))
+
+        old_runs = dict((name(run), run) for run in before['runs'])
+        self.stdout.write('compared with {0} ({1})\n'.format(before.get('commit'), path))
+        for run in results['runs']:
+            old = old_runs.get(name(run))
+            if old is None or not old.get('per_second') or 'latency_ms' not in old or 'latency_ms' not in run:
+                continue
+            self.stdout.write('{0:60} rate x{1:.2f}  p99 x{2:.2f}\n'.format(
+                ' '.join(str(field) for field in name(run) if field is not None),
+                _rate(run) / _rate(old),
+                run['latency_ms']['p99'] / max(old['latency_ms']['p99'], 1e-9)))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geofencing.dispatch import snapshot
+
+__doc__ = """
+        Exports the per-cell counters to an offline snapshot (see
+        dispatch/snapshot.py), e.g. nightly from a replica:
+
+            (venv)$ python manage.py export_snapshot /data/snapshots/latest
+"""
+
+class Command(BaseCommand):
+
+    args = '<snapshot dir>'
+    help = 'Exports the per-cell, per-bucket counters to an offline snapshot'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scan-count', dest='scan_count', type='int', default=10000,
+            help='keys per SCAN call'),
+    )
+
+    def handle(self, *args, **options):
+        from geofencing.dispatch.views import redis_conn
+
+        if len(args) != 1:
+            raise CommandError('Give the snapshot directory')
+
+        started = time.time()
+        counts = snapshot.export(redis_conn, args[0], options['scan_count'])
+        self.stdout.write('exported {0} day rows, {1} week rows in {2:.1f}s\n'.format(
+            counts['days'], counts['weeks'], time.time() - started))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from geofencing.dispatch import storage
+
+__doc__ = """
+        Adds the stripes of the current trips counter back into the single
+        current_trips_counter key, before GEOFENCE_TRIPS_COUNTER_STRIPES is
+        turned off (or lowered): stop the ingest first, then
+
+            (venv)$ python manage.py fold_trips_counter --stripes 16
+
+        The stripes are read and deleted in one script, so it can be rerun.
+"""
+
+class Command(BaseCommand):
+
+    help = 'Folds the stripes of the current trips counter into current_trips_counter'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--stripes', dest='stripes', type='int',
+            default=getattr(settings, 'GEOFENCE_TRIPS_COUNTER_STRIPES', 0),
+            help='stripes to fold (default: GEOFENCE_TRIPS_COUNTER_STRIPES)'),
+    )
+
+    def handle(self, *args, **options):
+        from geofencing.dispatch.views import redis_conn
+
+        count = storage.fold_trips_stripes(redis_conn, options['stripes'])
+        self.stdout.write('current_trips_counter: {0}\n'.format(count))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime
+import json
+from optparse import make_option
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+import numpy
+
+from geofencing.dispatch import fleet, journal
+
+__doc__ = """
+        Writes the events of a synthetic fleet (see dispatch/fleet.py) to
+        files, for bulk loads:
+
+            (venv)$ python manage.py generate_fleet --vehicles 100000 --start "2013-09-01 00" --hours 24 --format journal var/fleet
+            (venv)$ python manage.py replay_journal --journal-dir var/fleet
+
+            (venv)$ python manage.py generate_fleet --vehicles 1000 --hours 1 --format csv events.csv
+            (venv)$ python manage.py load_events events.csv
+
+        csv and ndjson are the formats of load_events, journal writes journal
+        segments (one per hour) into a directory, for replay_journal. The
+        journal is by far the fastest to write and to load at this scale.
+"""
+
+HOUR_FORMAT = '%Y-%m-%d %H'
+
+#ticks simulated between two writes
+CHUNK_TICKS = 60
+
+def _csv_lines(events):
+    for event in events:
+        yield '{0:.3f},{1},{2},{3:.6f},{4:.6f},{5}\n'.format(
+            event['time'], fleet.EVENTS[event['event']], event['trip'], event['lat'], event['lng'],
+            repr(float(event['fare'])) if event['event'] == 2 else '')
+
+def _ndjson_lines(events):
+    for event, message in zip(events, fleet.messages(events)):
+        message['time'] = round(float(event['time']), 3)
+        yield json.dumps(message) + '\n'
+
+def _records(events):
+    """<events> as journal records"""
+
+    records = numpy.zeros(len(events), dtype=journal.RECORD_DTYPE)
+    for name in ('time', 'lat', 'lng', 'event', 'fare'):
+        records[name] = events[name]
+    records['trip'] = events['trip'].astype('S24')
+    return records
+
+class Command(BaseCommand):
+
+    args = '<file or journal dir>'
+    help = 'Writes the events of a synthetic fleet to files for load_events/replay_journal'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--vehicles', dest='vehicles', type='int', default=1000,
+            help='vehicles in the fleet'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='seed of the fleet'),
+        make_option('--start', dest='start', default=None,
+            help='first hour, "YYYY-MM-DD HH" (utc, default: the current hour)'),
+        make_option('--hours', dest='hours', type='float', default=1,
+            help='hours of events'),
+        make_option('--format', dest='file_format', choices=('csv', 'ndjson', 'journal'), default=None,
+            help='csv, ndjson or journal (default: from the file extension, journal for a directory)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give one file or directory to write to')
+        path = args[0]
+
+        try:
+            start = (datetime.strptime(options['start'], HOUR_FORMAT) if options['start'] else
+                     datetime.utcnow().replace(minute=0, second=0, microsecond=0))
+        except ValueError:
+            raise CommandError('--start must be "YYYY-MM-DD HH"')
+        start_seconds = (start - datetime(1970, 1, 1)).total_seconds()
+
+        file_format = options['file_format']
+        if not file_format:
+            file_format = ('csv' if path.endswith('.csv') else 'ndjson' if path.endswith('.ndjson') else 'journal')
+
+        vehicle_fleet = fleet.Fleet(options['vehicles'], options['seed'], start=start_seconds)
+        ticks = int(options['hours'] * 60 * 60 / vehicle_fleet.tick_seconds)
+
+        started = time.time()
+        written = 0
+        if file_format == 'journal':
+            #only for the names of its segments
+            segments = journal.Journal(path)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            out = None
+        else:
+            out = open(path, 'wb')
+            if file_format == 'csv':
+                out.write('time,event,tripId,lat,lng,fare\n')
+
+        try:
+            for tick in range(0, ticks, CHUNK_TICKS):
+                events = numpy.concatenate([vehicle_fleet.tick() for i in range(min(CHUNK_TICKS, ticks - tick))])
+
+                if out is None:
+                    #one segment per hour, as the journal of a live worker
+                    hours = (events['time'] // 3600).astype(numpy.int64)
+                    for hour in numpy.unique(hours):
+                        label = datetime.utcfromtimestamp(hour * 3600).strftime(journal.SEGMENT_HOUR_FORMAT)
+                        with open(segments.segment_path(label), 'ab') as f:
+                            _records(events[hours == hour]).tofile(f)
+                elif file_format == 'csv':
+                    out.writelines(_csv_lines(events))
+                else:
+                    out.writelines(_ndjson_lines(events))
+
+                written += len(events)
+                elapsed = max(time.time() - started, 1e-6)
+                self.stdout.write('{0} events up to {1} ({2:.0f} events/s)\n'.format(
+                    written, datetime.utcfromtimestamp(vehicle_fleet.now).strftime('%Y-%m-%d %H:%M:%S'),
+                    written / elapsed))
+        finally:
+            if out is not None:
+                out.close()
+
+        self.stdout.write('wrote {0} events of {1} vehicles to {2} in {3:.1f}s\n'.format(
+            written, options['vehicles'], path, time.time() - started))
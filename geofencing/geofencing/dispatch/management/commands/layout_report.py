@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+import numpy
+import redis
+
+from geofencing.dispatch import compact, fleet, rebuild
+from geofencing.dispatch.geo import encode_many
+
+__doc__ = """
+        Compares the redis memory the per-cell counters take in the classic
+        and the compact key layouts (see dispatch/compact.py).
+
+            (venv)$ python manage.py layout_report --cells 100000 --days 7
+
+        Writes the same synthetic counters (<cells> cells around a few hot
+        spots of SF, each with a start, stop and fare counter for every day
+        and the weeks they fall in) to an empty scratch db in each layout in
+        turn, and reports the used_memory each took, per cell and bucket. The
+        scratch db is flushed afterwards.
+"""
+
+class Command(BaseCommand):
+
+    help = 'Reports the redis memory per cell of the classic and compact key layouts'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--cells', dest='cells', type='int', default=100000,
+            help='synthetic cells to write'),
+        make_option('--days', dest='days', type='int', default=7,
+            help='day buckets per cell'),
+        make_option('--db', dest='db', type='int', default=15,
+            help='scratch redis db, must be empty'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='seed of the synthetic cells'),
+    )
+
+    def handle(self, *args, **options):
+        from geofencing.dispatch.views import redis_conn
+
+        scratch = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+            **dict(redis_conn.connection_pool.connection_kwargs, db=options['db'])))
+        if scratch.dbsize():
+            raise CommandError('db {0} is not empty'.format(options['db']))
+
+        random = numpy.random.RandomState(options['seed'])
+        cells = numpy.unique(encode_many(*fleet.points(options['cells'], random)))
+
+        #one counter command of each kind per cell and bucket
+        days = [(1378000000 + day * 24*60*60) for day in range(options['days'])]
+        labels = rebuild._labels(numpy.array(days, dtype=numpy.float64))
+        buckets = (['days:{0}'.format(label) for label in labels[1]] +
+                   ['weeks:{0}'.format(label) for label in labels[3]])
+
+        def counters():
+            for bucket in buckets:
+                for cell in cells:
+                    key = 'geohash:{0}:{1}:'.format(cell, bucket)
+                    yield ('INCRBY', key + 'tot_start_counter', random.randint(1, 50))
+                    yield ('INCRBY', key + 'tot_stop_counter', random.randint(1, 50))
+                    yield ('INCRBYFLOAT', key + 'tot_fare_counter', repr(round(random.uniform(5, 80), 2)))
+
+        self.stdout.write('{0} cells x {1} buckets\n'.format(len(cells), len(buckets)))
+
+        used = {}
+        try:
+            for layout in ('classic', 'compact'):
+                before = int(scratch.info()['used_memory'])
+                rebuild.write(scratch, counters(), layout=layout)
+                used[layout] = int(scratch.info()['used_memory']) - before
+                keys = scratch.dbsize()
+
+                encodings = {}
+                if layout == 'compact':
+                    for key in [scratch.randomkey() for i in range(min(keys, 1000))]:
+                        encoding = scratch.object('encoding', key)
+                        encodings[encoding] = encodings.get(encoding, 0) + 1
+
+                self.stdout.write('{0:8} {1:10} keys {2:12} bytes {3:8.1f} bytes per cell and bucket{4}\n'.format(
+                    layout, keys, used[layout], float(used[layout]) / (len(cells) * len(buckets)),
+                    ''.join('  {0}: {1}'.format(encoding, count) for encoding, count in sorted(encodings.items()))))
+                scratch.flushdb()
+        finally:
+            scratch.flushdb()
+
+        if used['compact']:
+            self.stdout.write('compact takes {0:.1%} of the classic layout\n'.format(
+                float(used['compact']) / used['classic']))
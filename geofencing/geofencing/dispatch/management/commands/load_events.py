@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import csv
+from itertools import islice
+import json
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import numpy
+
+from geofencing.dispatch import cellindex, journal, rebuild, storage
+
+__doc__ = """
+        Loads historical events from CSV or NDJSON files, bucketed by the time
+        of each event rather than by when it is loaded.
+
+            (venv)$ python manage.py load_events --format csv events-2013-09.csv
+
+        Each event has the fields of the /trips/ payload plus its time:
+
+            time,event,tripId,lat,lng,fare
+            2013-09-01 00:00:04,begin,123,37.8025,-122.4058,
+            2013-09-01 00:17:41,end,123,37.790789,-122.431812,20
+
+        (in NDJSON, one such object per line). time is epoch seconds or an ISO
+        8601 utc time. Events that trips() would turn down are skipped.
+
+        The files are read in chunks of --chunk events. Each chunk is
+        geohashed in one go, aggregated per key in memory and written out in
+        pipelines (see dispatch/rebuild.py), heatmap rollups included, adding
+        to what is already in redis. So loading the same file twice counts it
+        twice.
+
+        The files should be in time order (within a chunk is enough for the
+        per-cell counters, but current_trips_counter is carried from one chunk
+        to the next to rebuild the trips_counter:<epoch> keys).
+
+        With GEOFENCE_CELL_INDEX on, the cells of each chunk are published on
+        the cell change feed as they are written, so the running workers'
+        indexes see them and their box queries find the loaded events without
+        a restart.
+"""
+
+def _time(value):
+    """Epoch seconds of a time, epoch seconds or ISO 8601"""
+
+    try:
+        return float(value)
+    except ValueError:
+        return numpy.datetime64(value.rstrip('Z'), 'us').astype(numpy.int64) / 1e6
+
+def _times(values):
+    """Epoch seconds of a column of times, epoch seconds or ISO 8601"""
+
+    try:
+        return numpy.array(values, dtype=numpy.float64)
+    except ValueError:
+        return numpy.array([_time(value) for value in values])
+
+def _valid(row):
+    """Same checks as trips(), plus a time. The row converts as _records()
+    converts it, so a bad row is skipped rather than failing its chunk (the
+    chunks before it being written already)."""
+
+    if not (row.get('time') and row.get('event') and row.get('tripId') not in (None, '') and
+            row.get('lat') not in (None, '') and row.get('lng') not in (None, '')):
+        return False
+    if row['event'] == 'end' and row.get('fare') in (None, ''):
+        return False
+
+    try:
+        values = (_time(row['time']), float(row['lat']), float(row['lng']), float(row.get('fare') or 0))
+        journal.event_code(row['event'])
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return numpy.isfinite(values).all() and abs(values[1]) <= 90 and abs(values[2]) <= 180
+
+def _records(rows):
+    """The rows as a journal RECORD_DTYPE array, sorted by time"""
+
+    records = numpy.zeros(len(rows), dtype=journal.RECORD_DTYPE)
+    records['time'] = _times([row['time'] for row in rows])
+    records['trip'] = [str(row['tripId']) for row in rows]
+    records['lat'] = [float(row['lat']) for row in rows]
+    records['lng'] = [float(row['lng']) for row in rows]
+    records['event'] = [journal.event_code(row['event']) for row in rows]
+    records['fare'] = [float(row.get('fare') or 0) for row in rows]
+    return records[numpy.argsort(records['time'], kind='mergesort')]
+
+def _read(path, file_format):
+    """Generates the rows of a file as dicts"""
+
+    with open(path, 'rb') as f:
+        if file_format == 'csv':
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield {}
+
+class Command(BaseCommand):
+
+    args = '<file> [<file> ...]'
+    help = 'Loads historical events from CSV/NDJSON files into redis'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='file_format', choices=('csv', 'ndjson'), default=None,
+            help='csv or ndjson (default: from the file extension)'),
+        make_option('--chunk', dest='chunk', type='int', default=100000,
+            help='events aggregated at a time'),
+        make_option('--budget', dest='budget', type='int',
+            default=getattr(settings, 'GEOFENCE_REPLAY_WRITE_BUDGET', 0),
+            help='redis commands per second (0: no limit)'),
+        make_option('--pipeline', dest='pipeline_size', type='int', default=10000,
+            help='commands per pipeline'),
+    )
+
+    def handle(self, *paths, **options):
+        from geofencing.dispatch.views import redis_conn
+
+        if not paths:
+            raise CommandError('No files to load')
+
+        started = time.time()
+        trips = int(storage.get_current_trips(redis_conn) or 0)
+        feed = cellindex.feed_channel(redis_conn) if getattr(settings, 'GEOFENCE_CELL_INDEX', False) else None
+        total_events = total_skipped = total_sent = 0
+
+        for path in paths:
+            file_format = options['file_format'] or ('csv' if path.endswith('.csv') else 'ndjson')
+            rows = _read(path, file_format)
+
+            while True:
+                chunk = list(islice(rows, options['chunk']))
+                if not chunk:
+                    break
+
+                valid = [row for row in chunk if _valid(row)]
+                records = _records(valid)
+
+                trip_counts = trips + numpy.cumsum(rebuild.trips_delta(records['event']))
+                if len(trip_counts):
+                    trips = int(trip_counts[-1])
+
+                total_sent += rebuild.write(redis_conn, rebuild.commands(records, trip_counts, additive=True,
+                                                                         publish=feed),
+                                            pipeline_size=options['pipeline_size'],
+                                            budget=options['budget'] or None)
+                total_events += len(records)
+                total_skipped += len(chunk) - len(valid)
+
+                elapsed = max(time.time() - started, 1e-6)
+                self.stdout.write('{0}: {1} events loaded, {2} skipped, {3:.0f} events/s {4:.0f} commands/s\n'.format(
+                    path, total_events, total_skipped, total_events / elapsed, total_sent / elapsed))
+
+        storage.set_current_trips(redis_conn, trips)
+        self.stdout.write('loaded {0} events ({1} skipped), {2} commands in {3:.1f}s\n'.format(
+            total_events, total_skipped, total_sent, time.time() - started))
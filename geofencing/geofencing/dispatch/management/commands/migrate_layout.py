@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from geofencing.dispatch import compact
+from geofencing.dispatch.scripts import script
+
+__doc__ = """
+        Moves the per-cell counters from one key layout to the other (see
+        dispatch/compact.py).
+
+            (venv)$ python manage.py migrate_layout --to compact
+
+        Each counter is moved by a lua script that adds its value to the new
+        place and deletes the old one, so counts are never lost or doubled,
+        and the command can be stopped and run again. Switch
+        GEOFENCE_KEY_LAYOUT and restart the workers first, so nothing writes
+        to the old layout any more, then migrate: until it is done the
+        queries miss the counts not moved yet.
+"""
+
+#KEYS[1] classic counter, KEYS[2] hash, ARGV[1] field
+_TO_COMPACT_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return 0
+end
+if string.sub(ARGV[1], -1) == 'f' then
+    redis.call('HINCRBYFLOAT', KEYS[2], ARGV[1], value)
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[1], value)
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+#KEYS[1] hash, KEYS[2] classic counter, ARGV[1] field
+_TO_CLASSIC_SCRIPT = """
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if not value then
+    return 0
+end
+if string.sub(ARGV[1], -1) == 'f' then
+    redis.call('INCRBYFLOAT', KEYS[2], value)
+else
+    redis.call('INCRBY', KEYS[2], value)
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+return 1
+"""
+
+class Command(BaseCommand):
+
+    help = 'Moves the per-cell counters to the compact (or back to the classic) key layout'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--to', dest='to', choices=('compact', 'classic'), default='compact',
+            help='layout to move the counters to'),
+        make_option('--scan-count', dest='scan_count', type='int', default=10000,
+            help='keys per SCAN call'),
+        make_option('--budget', dest='budget', type='int',
+            default=getattr(settings, 'GEOFENCE_REPLAY_WRITE_BUDGET', 0),
+            help='counters moved per second (0: no limit)'),
+    )
+
+    def handle(self, *args, **options):
+        from geofencing.dispatch.views import redis_conn
+
+        if compact.LAYOUT != options['to']:
+            raise CommandError('GEOFENCE_KEY_LAYOUT is {0!r}, switch it to {1!r} (and restart the workers) '
+                               'before migrating'.format(compact.LAYOUT, options['to']))
+
+        if options['to'] == 'compact':
+            move = script(redis_conn, _TO_COMPACT_SCRIPT)
+            pattern = 'geohash:*'
+        else:
+            move = script(redis_conn, _TO_CLASSIC_SCRIPT)
+            pattern = compact.PATTERN
+
+        started = time.time()
+        moved = 0
+        cursor = 0
+        while True:
+            cursor, keys = redis_conn.execute_command('SCAN', cursor, 'MATCH', pattern,
+                                                      'COUNT', options['scan_count'])
+            cursor = int(cursor)
+
+            with redis_conn.pipeline(transaction=False) as pipe:
+                if options['to'] == 'compact':
+                    for key in keys:
+                        located = compact.locate(key)
+                        if located is not None:
+                            move(keys=[key, located[0]], args=[located[1]], client=pipe)
+                else:
+                    for hash_key in keys:
+                        for field in redis_conn.hkeys(hash_key):
+                            move(keys=[hash_key, compact.classic_key(hash_key, field)], args=[field], client=pipe)
+                moved += sum(pipe.execute())
+
+            if options['budget']:
+                ahead = float(moved) / options['budget'] - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+            if not cursor:
+                break
+
+        self.stdout.write('moved {0} counters to the {1} layout in {2:.1f}s\n'.format(
+            moved, options['to'], time.time() - started))
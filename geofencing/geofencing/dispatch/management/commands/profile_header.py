@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from geofencing.dispatch import profiling
+
+__doc__ = """
+        Prints a signed header that has the request profiled (see
+        dispatch/profiling.py), whether profiling is on or not:
+
+            (venv)$ curl -H "$(python manage.py profile_header)" -d "lat1=..&days_back=12w" http://127.0.0.1/query/trips_start_stop/
+"""
+
+class Command(BaseCommand):
+
+    help = 'Prints a signed header that has the request profiled'
+
+    def handle(self, *args, **options):
+        self.stdout.write('{0}: {1}\n'.format(profiling.HEADER, profiling.header_value()))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from geofencing.dispatch import polygons, snapshot
+
+__doc__ = """
+        Answers trips_passed_through/trips_start_stop from an offline
+        snapshot, without going near redis:
+
+            (venv)$ python manage.py query_snapshot /data/snapshots/latest \\
+                        --box 37.81,-122.44,37.78,-122.40 --days-back 52w --now 2013-12-31
+            (venv)$ python manage.py query_snapshot /data/snapshots/latest \\
+                        --polygon mission.geojson --days-back 365d
+"""
+
+class Command(BaseCommand):
+
+    args = '<snapshot dir>'
+    help = 'Runs the box queries against an offline snapshot'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--box', dest='box', default=None,
+            help='lat1,lng1,lat2,lng2 of the top left and bottom right corners'),
+        make_option('--polygon', dest='polygon', default=None,
+            help='file holding a GeoJSON polygon, instead of --box'),
+        make_option('--days-back', dest='days_back', default='0d',
+            help='as in the views: 0d, 7d, 2w..'),
+        make_option('--now', dest='now', default=None,
+            help='count back from this day (YYYY-MM-DD) instead of today'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the snapshot directory')
+
+        lat1 = lng1 = lat2 = lng2 = polygon = None
+        try:
+            if options['polygon']:
+                with open(options['polygon']) as f:
+                    polygon = polygons.parse_geojson(f.read())
+            elif options['box']:
+                lat1, lng1, lat2, lng2 = [float(value) for value in options['box'].split(',')]
+            else:
+                raise CommandError('Give --box or --polygon')
+            now = datetime.strptime(options['now'], '%Y-%m-%d') if options['now'] else None
+            int(options['days_back'][:-1])
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        started = time.time()
+        engine = snapshot.Snapshot(args[0])
+        count = engine.trips_passed_through(lat1, lng1, lat2, lng2, options['days_back'], now, polygon)
+        start_count, stop_count, fare_count = engine.trips_start_stop(lat1, lng1, lat2, lng2,
+                                                                      options['days_back'], now, polygon)
+
+        self.stdout.write('trips passed through: {0}\ntrips started: {1}\ntrips stopped: {2}\n'
+                          'total fare: {3}\nquery time: {4:.3f}s\n'.format(
+            count, start_count, stop_count, fare_count, time.time() - started))
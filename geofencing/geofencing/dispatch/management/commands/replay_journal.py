@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime
+import json
+import multiprocessing
+from optparse import make_option
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import numpy
+
+from geofencing.dispatch import journal, rebuild, storage
+
+__doc__ = """
+        Rebuilds the geohash:*, geohash_prefixes:*, heatmap:*, trips_counter:*
+        and event_times:* keys from the event journal (see dispatch/journal.py).
+
+            (venv)$ python manage.py replay_journal --processes 8 --budget 100000
+
+        The journal is split in partitions of one week (as in the weeks:<WW>
+        keys, so a partition holds every event of its day and week buckets),
+        labelled <year>-<WW>, which a pool of processes aggregate in memory
+        and write out with rebuild.write(). The counters are SET, not
+        incremented, so a partition can be replayed again safely: the
+        partitions done are recorded in a checkpoint file and a rerun picks up
+        where the last one stopped.
+
+        --start/--end are rounded out to whole partitions, since replaying
+        part of a week would SET its day and week counters to part of their
+        counts. The trips under way at the start of the first one are counted
+        from the segments before it.
+
+        Replay into a redis that is not taking live events, and restart the
+        gunicorn workers afterwards so their cell indexes reload.
+"""
+
+HOUR_FORMAT = '%Y-%m-%d %H'
+
+#label of the partition of an hour, the weeks:<WW> bucket of its year
+PARTITION_FORMAT = '%Y-%U'
+
+def _hour_start(seconds):
+    return int(seconds) // (60*60) * (60*60)
+
+def _replay_partition(args):
+    """Aggregates and writes one partition. Runs in the pool processes."""
+
+    from geofencing.dispatch.views import redis_conn
+
+    label, paths, hour_offsets, pipeline_size, budget = args
+    started = time.time()
+
+    records = numpy.concatenate([journal.read_segment(path) for path in paths])
+    records = records[numpy.argsort(records['time'], kind='mergesort')]
+
+    #current_trips_counter after each event: the count before the event's hour
+    #plus the running count within the hour
+    delta = rebuild.trips_delta(records['event'])
+    running = numpy.cumsum(delta)
+    hours, first, index = numpy.unique((records['time'] // (60*60)).astype(numpy.int64) * (60*60),
+                                       return_index=True, return_inverse=True)
+    before_hour = numpy.array([hour_offsets[hour] for hour in hours], dtype=numpy.int64)
+    trip_counts = running - (running[first] - delta[first])[index] + before_hour[index]
+
+    sent = rebuild.write(redis_conn, rebuild.commands(records, trip_counts),
+                         pipeline_size=pipeline_size, budget=budget)
+
+    return label, len(records), sent, time.time() - started
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds the redis aggregates from the event journal'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--journal-dir', dest='journal_dir', default=None,
+            help='journal to replay (default: GEOFENCE_JOURNAL_DIR)'),
+        make_option('--start', dest='start', default=None,
+            help='first hour to replay, "YYYY-MM-DD HH" (utc)'),
+        make_option('--end', dest='end', default=None,
+            help='replay up to, not including, this hour'),
+        make_option('--processes', dest='processes', type='int', default=multiprocessing.cpu_count(),
+            help='partitions replayed in parallel'),
+        make_option('--budget', dest='budget', type='int',
+            default=getattr(settings, 'GEOFENCE_REPLAY_WRITE_BUDGET', 0),
+            help='redis commands per second, for all processes together (0: no limit)'),
+        make_option('--pipeline', dest='pipeline_size', type='int', default=10000,
+            help='commands per pipeline'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='checkpoint file (default: replay.checkpoint in the journal dir)'),
+        make_option('--fresh', dest='fresh', action='store_true', default=False,
+            help='ignore the checkpoint and replay everything'),
+        make_option('--current', dest='current', action='store_true', default=False,
+            help='also set current_trips_counter to the count at the end of the journal'),
+    )
+
+    def handle(self, *args, **options):
+        journal_dir = options['journal_dir'] or getattr(settings, 'GEOFENCE_JOURNAL_DIR', None)
+        if not journal_dir:
+            raise CommandError('No journal, give --journal-dir or set GEOFENCE_JOURNAL_DIR')
+
+        try:
+            start, end = [datetime.strptime(options[name], HOUR_FORMAT) if options[name] else None
+                          for name in ('start', 'end')]
+        except ValueError:
+            raise CommandError('--start/--end must be "YYYY-MM-DD HH"')
+
+        checkpoint = options['checkpoint'] or os.path.join(journal_dir, 'replay.checkpoint')
+        done = set()
+        if os.path.exists(checkpoint) and not options['fresh']:
+            with open(checkpoint) as f:
+                done = set(json.load(f)['done'])
+
+        #segments by hour, the ones before --start too, for the trips under way
+        hours = {}
+        for path in journal.segments(journal_dir):
+            hours.setdefault(journal.segment_hour(path), []).append(path)
+
+        #whole partitions only: those with an hour in [start, end)
+        labels = set(hour.strftime(PARTITION_FORMAT) for hour in hours
+                     if (start is None or hour >= start) and (end is None or hour < end))
+        partitions = {}
+        for hour, paths in hours.iteritems():
+            if hour.strftime(PARTITION_FORMAT) in labels:
+                partitions.setdefault(hour.strftime(PARTITION_FORMAT), []).extend(paths)
+        if (start or end) and partitions:
+            self.stdout.write('replaying whole weeks, {0} to {1}\n'.format(min(partitions), max(partitions)))
+
+        #the trips under way at the start of each hour, up to the end of the
+        #last partition replayed
+        last = max(hour for hour in hours if hour.strftime(PARTITION_FORMAT) in labels) if labels else None
+        hour_offsets = {}
+        trips = 0
+        for hour in sorted(hours):
+            if last is not None and hour > last:
+                break
+            hour_offsets[_hour_start((hour - datetime(1970, 1, 1)).total_seconds())] = trips
+            trips += sum(int(rebuild.trips_delta(journal.read_segment(path)['event']).sum())
+                         for path in hours[hour])
+
+        processes = max(options['processes'], 1)
+        budget = float(options['budget']) / processes if options['budget'] else None
+        todo = [(label, sorted(paths), hour_offsets, options['pipeline_size'], budget)
+                for label, paths in sorted(partitions.iteritems()) if label not in done]
+
+        self.stdout.write('{0} partitions to replay ({1} already done), {2} processes\n'.format(
+            len(todo), len(partitions) - len(todo), processes))
+
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_replay_partition, todo)
+        else:
+            pool = None
+            results = (_replay_partition(partition) for partition in todo)
+
+        started = time.time()
+        total_events = total_sent = 0
+        try:
+            for i, (label, events, sent, seconds) in enumerate(results):
+                done.add(label)
+                self._save_checkpoint(checkpoint, done)
+
+                total_events += events
+                total_sent += sent
+                elapsed = max(time.time() - started, 1e-6)
+                self.stdout.write('[{0}/{1}] week {2} {3} events {4} commands in {5:.1f}s, '
+                                  'overall {6:.0f} events/s {7:.0f} commands/s\n'.format(
+                    i + 1, len(todo), label, events, sent, seconds,
+                    total_events / elapsed, total_sent / elapsed))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        if options['current']:
+            from geofencing.dispatch.views import redis_conn
+            storage.set_current_trips(redis_conn, trips)
+
+        self.stdout.write('replayed {0} events, {1} commands in {2:.1f}s\n'.format(
+            total_events, total_sent, time.time() - started))
+
+    def _save_checkpoint(self, checkpoint, done):
+        with open(checkpoint + '.tmp', 'w') as f:
+            json.dump({'done': sorted(done)}, f)
+        os.rename(checkpoint + '.tmp', checkpoint)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+import threading
+import time
+
+from django.conf import settings
+import redis
+
+__doc__ = """
+        Request and redis metrics, served on /metrics in the prometheus text
+        format.
+
+        Each worker counts in its own memory, and every FLUSH_SECONDS (at the
+        end of a request) adds what it counted since the last flush to the
+        METRICS_KEY hash in redis, in one pipeline. /metrics reads that hash,
+        so it shows the sum over all the gunicorn workers whichever worker
+        answers. With no redis (the 'memory' storage, a single worker) the
+        worker's own counts are served.
+
+        metrics
+        =======
+        geofence_request_seconds                  histogram  per endpoint
+        geofence_redis_commands_per_request       histogram  per endpoint
+        geofence_redis_roundtrips_per_request     histogram  per endpoint
+        geofence_query_cells                      histogram  cells a box query looked at, per endpoint
+        geofence_query_buckets                    histogram  time buckets a box query looked at, per endpoint
+        geofence_redis_watch_retries_total        counter    WatchError retries updating the trips counter,
+                                                             per endpoint
+        geofence_cell_lookups_total               counter    cells under a prefix lookups, by source: the
+                                                             worker's cell index (a hit) or redis (a miss),
+                                                             per endpoint
+        geofence_query_admission_total            counter    queries by admission outcome: admitted,
+                                                             heavy, coarse, over_budget, busy or cancelled
+                                                             (see admission.py), per endpoint
+
+        Outside of a request (the ingest server, a management command) the
+        endpoint is 'none'.
+
+        The redis commands and round trips are counted by CountingConnection,
+        the connection class of the views' redis connection pool: a pipeline
+        is one round trip for all its commands.
+
+        Turned off by setting GEOFENCE_METRICS to False.
+"""
+
+ENABLED = getattr(settings, 'GEOFENCE_METRICS', True)
+
+METRICS_KEY = 'metrics'
+
+FLUSH_SECONDS = 1.0
+
+_COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+#name => (type, help, histogram buckets)
+METRICS = {
+    'geofence_request_seconds': ('histogram', 'Time to answer a request',
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    'geofence_redis_commands_per_request': ('histogram', 'Redis commands sent by a request', _COUNTS),
+    'geofence_redis_roundtrips_per_request': ('histogram', 'Redis round trips of a request', _COUNTS),
+    'geofence_query_cells': ('histogram', 'Cells a box query looked at', (1, 10, 100, 1000, 10000, 100000)),
+    'geofence_query_buckets': ('histogram', 'Time buckets a box query looked at', (1, 2, 4, 8, 16, 32, 64)),
+    'geofence_redis_watch_retries_total': ('counter', 'WatchError retries updating the trips counter', None),
+    'geofence_cell_lookups_total': ('counter', 'Lookups of the cells under a prefix, by source', None),
+    'geofence_query_admission_total': ('counter', 'Box queries by admission outcome', None),
+}
+
+class _Registry(object):
+    """What this worker counted since the last flush"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flushed_at = time.time()
+
+    def inc(self, name, amount, labels):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        buckets = METRICS[name][2]
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                #a count per bucket (and +Inf), the sum, the count
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def take(self):
+        """The series counted since the last take, as {series: increment}"""
+
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            self.flushed_at = time.time()
+
+        series = {}
+        for (name, labels), value in counters.iteritems():
+            series[_series(name, labels)] = value
+        for (name, labels), (counts, total, count) in histograms.iteritems():
+            cumulative = 0
+            for le, bucket_count in zip(METRICS[name][2] + ('+Inf',), counts):
+                cumulative += bucket_count
+                series[_series(name + '_bucket', labels + (('le', str(le)),))] = cumulative
+            series[_series(name + '_sum', labels)] = total
+            series[_series(name + '_count', labels)] = count
+        return series
+
+def _series(name, labels):
+    """'name{label="value",..}'"""
+
+    if not labels:
+        return name
+    return '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(label, value) for label, value in labels))
+
+_registry = _Registry()
+
+#series not flushed yet when there is no redis to flush to
+_local = {}
+
+#what the current request did, per thread (greenlet, under gunicorn's gevent workers)
+_request = threading.local()
+
+def _labels(labels):
+    if 'endpoint' not in labels:
+        labels['endpoint'] = getattr(_request, 'endpoint', None) or 'none'
+    return tuple(sorted(labels.iteritems()))
+
+def inc(name, amount=1, **labels):
+    """Adds <amount> to the counter <name>, by default labelled with the
+    endpoint of the current request"""
+
+    if ENABLED:
+        _registry.inc(name, amount, _labels(labels))
+
+def observe(name, value, **labels):
+    """Observes <value> in the histogram <name>, by default labelled with the
+    endpoint of the current request"""
+
+    if ENABLED:
+        _registry.observe(name, value, _labels(labels))
+
+def flush(redis_conn, force=False):
+    """Adds this worker's counts to the shared ones, at most every
+    FLUSH_SECONDS unless <force>"""
+
+    if not ENABLED or (not force and time.time() - _registry.flushed_at < FLUSH_SECONDS):
+        return
+
+    series = _registry.take()
+    if redis_conn is None:
+        for name, value in series.iteritems():
+            _local[name] = _local.get(name, 0) + value
+        return
+
+    if series:
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for name, value in series.iteritems():
+                pipe.hincrbyfloat(METRICS_KEY, name, value)
+            pipe.execute()
+
+def _number(value):
+    value = float(value)
+    return str(int(value)) if value == int(value) else repr(value)
+
+def render(redis_conn):
+    """All the series, in the prometheus text format"""
+
+    flush(redis_conn, force=True)
+    series = redis_conn.hgetall(METRICS_KEY) if redis_conn is not None else _local
+
+    by_metric = {}
+    for name, value in series.iteritems():
+        base = name.split('{')[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if base.endswith(suffix) and base[:-len(suffix)] in METRICS:
+                base = base[:-len(suffix)]
+        by_metric.setdefault(base, []).append((name, value))
+
+    def order(item):
+        #buckets in le order, for readability
+        name = item[0]
+        if '_bucket{' in name:
+            le = name.split('le="')[1].split('"')[0]
+            return (name.split('le="')[0], float('inf') if le == '+Inf' else float(le))
+        return (name, 0)
+
+    lines = []
+    for base in sorted(by_metric):
+        if base in METRICS:
+            lines.append('# HELP {0} {1}'.format(base, METRICS[base][1]))
+            lines.append('# TYPE {0} {1}'.format(base, METRICS[base][0]))
+        for name, value in sorted(by_metric[base], key=order):
+            lines.append('{0} {1}'.format(name, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+class CountingConnection(redis.Connection):
+    """A redis connection counting the commands and round trips of the
+    current request"""
+
+    def pack_command(self, *args):
+        if ENABLED:
+            _request.commands = getattr(_request, 'commands', 0) + 1
+        return super(CountingConnection, self).pack_command(*args)
+
+    def send_packed_command(self, command):
+        if ENABLED:
+            _request.roundtrips = getattr(_request, 'roundtrips', 0) + 1
+        return super(CountingConnection, self).send_packed_command(command)
+
+class MetricsMiddleware(object):
+    """Times every request and records its redis usage, by endpoint (the
+    name of its view)"""
+
+    def process_request(self, request):
+        if ENABLED:
+            _request.started = time.time()
+            _request.endpoint = None
+            _request.commands = _request.roundtrips = 0
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if ENABLED:
+            _request.endpoint = getattr(view_func, '__name__', None)
+
+    def process_response(self, request, response):
+        started = getattr(_request, 'started', None)
+        if not ENABLED or started is None:
+            return response
+
+        labels = {'endpoint': _request.endpoint or 'none'}
+        observe('geofence_request_seconds', time.time() - started, **labels)
+        observe('geofence_redis_commands_per_request', _request.commands, **labels)
+        observe('geofence_redis_roundtrips_per_request', _request.roundtrips, **labels)
+        _request.started = None
+
+        from geofencing.dispatch.views import store
+        flush(store.redis_conn)
+        return response
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from django.conf import settings
+
+from geofencing.dispatch.scripts import script
+
+__doc__ = """
+        Origin-destination matrix, i.e. trips and fares from zone A to zone B.
+
+        Zones are the geohash cells of OD_PRECISION chars.
+
+        redis schema
+        ============
+        trip_origin:<tripId> => zone the trip began in, until it ends (or for
+            ORIGIN_EXPIRY if the 'end' never comes)
+
+        od:days:YYYY-M-D:<origin zone> => hash of
+        od:weeks:WW:<origin zone>             <destination zone>   => trips
+                                                <destination zone>:f => sum of their fares
+
+        On 'end' a lua script looks up the trip's origin and bumps the
+        origin's hash for each time bucket, in one round trip. Reading a
+        matrix is then one HMGET (or a HGETALL for a whole row) per origin and
+        bucket, all in one pipeline.
+"""
+
+OD_PRECISION = getattr(settings, 'GEOFENCE_OD_PRECISION', 5)
+
+ORIGIN_EXPIRY = 24*60*60
+
+#same as the trips_counter keys
+EXPIRY = 90*24*60*60
+
+#KEYS[1] trip_origin:<tripId>, ARGV: destination, fare, expiry, bucket key prefixes..
+_END_SCRIPT = """
+local origin = redis.call('GET', KEYS[1])
+if origin then
+    for i = 4, #ARGV do
+        local key = ARGV[i] .. ':' .. origin
+        redis.call('HINCRBY', key, ARGV[1], 1)
+        redis.call('HINCRBYFLOAT', key, ARGV[1] .. ':f', ARGV[2])
+        redis.call('EXPIRE', key, ARGV[3])
+    end
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+def record_event(pipe, message, geohash_string, candidate_sub_keys):
+    """Remembers where a trip began and, when it ends, counts it in the matrix
+    of each of the days:<date>/weeks:<week> buckets given. Queued on the
+    pipeline <pipe>, a trip's begin runs before its end in the same one."""
+
+    trip_origin_key = 'trip_origin:{0}'.format(message['tripId'])
+    event = message['event'].lower()
+
+    if event == 'begin':
+        pipe.setex(trip_origin_key, ORIGIN_EXPIRY, geohash_string[:OD_PRECISION])
+    elif event == 'end':
+        script(pipe, _END_SCRIPT)(keys=[trip_origin_key],
+            args=[geohash_string[:OD_PRECISION], float(message['fare']), EXPIRY] +
+                 ['od:{0}'.format(sub_key) for sub_key in candidate_sub_keys],
+            client=pipe)
+
+def matrix(redis_conn, origins, destinations, candidate_sub_keys, deadline=None):
+    """Returns (destinations, trips, fares) where trips[i][j] and fares[i][j]
+    are the trips from origins[i] to destinations[j] and their fares.
+
+    With no <destinations>, every destination any of the origins had a trip
+    to is returned (i.e. whole rows of the matrix). With an admission.Deadline,
+    in one round trip per chunk of origins, checking it before each one.
+    """
+
+    fields = [field for destination in destinations for field in (destination, destination + ':f')]
+
+    results = []
+    for chunk in (deadline.chunks(origins, len(candidate_sub_keys)) if deadline is not None else [origins]):
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for origin in chunk:
+                for sub_key in candidate_sub_keys:
+                    key = 'od:{0}:{1}'.format(sub_key, origin)
+                    if destinations:
+                        pipe.hmget(key, fields)
+                    else:
+                        pipe.hgetall(key)
+            results.extend(pipe.execute())
+
+    if destinations:
+        rows = [dict(zip(fields, values)) for values in results]
+    else:
+        rows = results
+        destinations = sorted(set(field for row in rows for field in row if not field.endswith(':f')))
+
+    trips = []
+    fares = []
+    buckets = len(candidate_sub_keys)
+    for i in range(len(origins)):
+        origin_rows = rows[i * buckets:(i + 1) * buckets]
+        trips.append([sum(int(row.get(destination) or 0) for row in origin_rows)
+                      for destination in destinations])
+        fares.append([sum(float(row.get(destination + ':f') or 0) for row in origin_rows)
+                      for destination in destinations])
+
+    return destinations, trips, fares
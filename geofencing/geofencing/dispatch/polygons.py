@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import json
+
+import numpy
+
+from geofencing.dispatch.geo import cell_bbox, cell_to_int, cover_box, cover_box_count, PRECISION
+
+__doc__ = """
+        Polygon (GeoJSON) queries.
+
+        A polygon is answered the same way as a box, by working out the cells
+        in it and then summing up their time bucketed keys. To keep the cost
+        close to that of the equivalent box, the polygon's bounding box is first
+        covered with at most MAX_COVER_CELLS coarse cells, which are split into:
+
+            interior cells => no polygon edge goes through them and their centre
+                              is inside, so every active cell under them counts.
+            boundary cells => some polygon edge may go through them. Their
+                              active cells are decoded and tested one by one
+                              with a vectorized point-in-polygon test.
+            the rest       => outside, never looked at.
+
+        Both tests are NumPy broadcasts of points (or cells) against all the
+        polygon edges, done in chunks to bound the memory used.
+"""
+
+#upper bound on the coarse cells the polygon's bounding box is covered with
+MAX_COVER_CELLS = 256
+
+#upper bound on the points x edges matrices built at a time
+_CHUNK_ELEMENTS = 1 << 20
+
+def _ring(positions):
+    """(n, 2) array of the [lng, lat] positions of a closed GeoJSON ring"""
+
+    ring = numpy.array(positions, dtype=float)
+    if ring.ndim != 2 or ring.shape[1] < 2:
+        raise ValueError('a ring must be a list of [lng, lat] positions')
+    ring = ring[:, :2]
+    if (ring[0] != ring[-1]).any():
+        ring = numpy.vstack([ring, ring[:1]])
+    if len(ring) < 4:
+        raise ValueError('a ring needs at least 3 positions')
+    return ring
+
+class Polygon(object):
+    """A GeoJSON Polygon or MultiPolygon, holes included.
+
+    Uses the even-odd rule over all the rings, so holes and the parts of a
+    MultiPolygon need no special handling.
+    """
+
+    def __init__(self, rings):
+        points = numpy.vstack(rings)
+        self.bbox = (points[:, 1].min(), points[:, 0].min(),
+                     points[:, 1].max(), points[:, 0].max())
+
+        #one row per edge, x is the longitude, y the latitude
+        starts = numpy.vstack([ring[:-1] for ring in rings])
+        ends = numpy.vstack([ring[1:] for ring in rings])
+        self.x1, self.y1 = starts[:, 0], starts[:, 1]
+        self.x2, self.y2 = ends[:, 0], ends[:, 1]
+
+    def _chunks(self, count):
+        size = max(1, _CHUNK_ELEMENTS // len(self.x1))
+        for start in xrange(0, count, size):
+            yield slice(start, start + size)
+
+    def contains(self, lats, lngs):
+        """Boolean array, True for the points inside the polygon (ray casting)"""
+
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        inside = numpy.zeros(len(lats), dtype=bool)
+
+        for chunk in self._chunks(len(lats)):
+            y = lats[chunk, None]
+            x = lngs[chunk, None]
+            #edges that straddle the point's latitude...
+            straddles = (self.y1 > y) != (self.y2 > y)
+            #...and cross it east of the point. (horizontal edges never straddle,
+            #so the division by zero they cause is masked out)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                crossing_x = self.x1 + (y - self.y1) * (self.x2 - self.x1) / (self.y2 - self.y1)
+            crossings = (straddles & (x < crossing_x)).sum(axis=1)
+            inside[chunk] = crossings % 2 == 1
+
+        return inside
+
+    def cover(self, max_cells=MAX_COVER_CELLS):
+        """Returns (interior cells, boundary cells), see module doc"""
+
+        south, west, north, east = self.bbox
+        #the geohash_prefixes sets only go up to PRECISION - 1 chars
+        for precision in range(PRECISION - 1, 1, -1):
+            if cover_box_count(south, west, north, east, precision) <= max_cells:
+                break
+        else:
+            precision = 1
+
+        return self.classify(cover_box(south, west, north, east, precision))
+
+    def classify(self, cells):
+        """Splits <cells> into (interior cells, boundary cells), dropping the
+        cells that are entirely outside, see module doc"""
+
+        if not cells:
+            return [], []
+        boxes = numpy.array([cell_bbox(cell) for cell in cells])
+
+        #a cell is on the boundary if any edge goes through it, i.e. if the edge's
+        #bounding box overlaps the cell and the cell's corners are not all on
+        #the same side of the edge's line
+        edge_south = numpy.minimum(self.y1, self.y2)
+        edge_north = numpy.maximum(self.y1, self.y2)
+        edge_west = numpy.minimum(self.x1, self.x2)
+        edge_east = numpy.maximum(self.x1, self.x2)
+        dx = self.x2 - self.x1
+        dy = self.y2 - self.y1
+
+        boundary = numpy.zeros(len(cells), dtype=bool)
+        for chunk in self._chunks(len(cells)):
+            cell_south, cell_west, cell_north, cell_east = [boxes[chunk, i, None] for i in range(4)]
+            overlaps = ((edge_south <= cell_north) & (edge_north >= cell_south) &
+                        (edge_west <= cell_east) & (edge_east >= cell_west))
+
+            sides = [dx * (y - self.y1) - dy * (x - self.x1)
+                     for y in (cell_south, cell_north) for x in (cell_west, cell_east)]
+            straddles = (numpy.minimum.reduce(sides) <= 0) & (numpy.maximum.reduce(sides) >= 0)
+
+            boundary[chunk] = (overlaps & straddles).any(axis=1)
+
+        #no edge goes through the other cells, so each one is entirely inside or
+        #entirely outside. its centre tells which
+        centres_inside = self.contains((boxes[:, 0] + boxes[:, 2]) / 2,
+                                       (boxes[:, 1] + boxes[:, 3]) / 2)
+
+        interior = [cell for cell, b, i in zip(cells, boundary, centres_inside) if i and not b]
+        boundary = [cell for cell, b in zip(cells, boundary) if b]
+        return interior, boundary
+
+def from_box(south, west, north, east):
+    """The Polygon of a lat/lng box"""
+
+    return Polygon([_ring([[west, south], [east, south], [east, north], [west, north]])])
+
+def parse_geojson(text):
+    """Builds a Polygon out of a GeoJSON Polygon/MultiPolygon (or a Feature of one).
+
+    Raises ValueError if it is anything else.
+    """
+
+    geometry = json.loads(text)
+    if not isinstance(geometry, dict):
+        raise ValueError('not a GeoJSON object')
+    if geometry.get('type') == 'Feature':
+        geometry = geometry.get('geometry') or {}
+
+    if geometry.get('type') == 'Polygon':
+        polygons = [geometry.get('coordinates')]
+    elif geometry.get('type') == 'MultiPolygon':
+        polygons = geometry.get('coordinates')
+    else:
+        raise ValueError('only Polygon and MultiPolygon geometries are supported')
+
+    try:
+        rings = [_ring(ring) for polygon in polygons for ring in polygon]
+    except TypeError:
+        raise ValueError('malformed coordinates')
+    if not rings:
+        raise ValueError('the polygon has no rings')
+    return Polygon(rings)
+
+def decode_cells(cells):
+    """(lats, lngs) arrays of the centres of full precision geohashes"""
+
+    values = numpy.array([cell_to_int(cell) for cell in cells], dtype=numpy.int64)
+    lat_index = numpy.zeros(len(values), dtype=numpy.int64)
+    lng_index = numpy.zeros(len(values), dtype=numpy.int64)
+
+    bits = 5 * PRECISION
+    for i in range(bits):
+        bit = (values >> (bits - 1 - i)) & 1
+        if i % 2:
+            lat_index = (lat_index << 1) | bit
+        else:
+            lng_index = (lng_index << 1) | bit
+
+    lat_bits, lng_bits = bits // 2, (bits + 1) // 2
+    lats = -90.0 + (lat_index + 0.5) * (180.0 / (1 << lat_bits))
+    lngs = -180.0 + (lng_index + 0.5) * (360.0 / (1 << lng_bits))
+    return lats, lngs
+
+def target_cells(polygon, cells_under):
+    """Returns the active cells inside <polygon>.
+
+    cells_under(prefixes) must return, for every prefix, the list of active
+    cells under it (one batched lookup per call).
+    """
+
+    interior, boundary = polygon.cover()
+
+    targets = []
+    for cells in cells_under(interior):
+        targets.extend(cells)
+
+    candidates = [cell for cells in cells_under(boundary) for cell in cells]
+    if candidates:
+        lats, lngs = decode_cells(candidates)
+        inside = polygon.contains(lats, lngs)
+        targets.extend(cell for cell, i in zip(candidates, inside) if i)
+
+    return targets
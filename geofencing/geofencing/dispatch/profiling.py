@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import os
+import random
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core import signing
+
+__doc__ = """
+        Statistical profiler for the gunicorn workers, in production.
+
+        While a profiled request runs, the worker asks for a SIGPROF every
+        INTERVAL seconds of cpu (setitimer ITIMER_PROF), and each one
+        counts the stack of the view being run, from the view function
+        down. The counts are aggregated per endpoint (view) in the worker,
+        and written to PROFILE_DIR every DUMP_SECONDS (at the end of a
+        profiled request) as collapsed stacks, one '<endpoint>-<pid>.folded'
+        file per endpoint and worker, which the flame graph tools read:
+
+            $ cat var/profile/trips_start_stop-*.folded | flamegraph.pl > trips_start_stop.svg
+
+        (speedscope.app opens them too). The other requests only pay for a
+        header lookup, and a random() while profiling is on.
+
+        Which requests are profiled:
+        - SAMPLE_RATE of them while profiling is on: start gunicorn with
+          GEOFENCE_PROFILE=1 in the environment, or send the workers a
+          SIGUSR2 to turn it on (and another one to turn it off, which also
+          writes out the profiles):
+
+            $ ps -o pid= --ppid <gunicorn master pid> | xargs kill -USR2
+
+          (the workers, not the master: a USR2 makes the master re-exec)
+
+        - any request carrying a valid X-Geofence-Profile header, on or off:
+
+            (venv)$ python manage.py profile_header
+            X-Geofence-Profile: ImdlbyI:1VXV0f:..
+
+          The value is signed with SECRET_KEY, and good for HEADER_MAX_AGE.
+
+        cProfile can't be used for this: it gives the callers and callees of
+        each function, not whole stacks, and it slows down every function
+        call of the request.
+"""
+
+SAMPLE_RATE = getattr(settings, 'GEOFENCE_PROFILE_SAMPLE_RATE', 0.01)
+
+#seconds of cpu between two samples
+INTERVAL = getattr(settings, 'GEOFENCE_PROFILE_INTERVAL', 0.005)
+
+PROFILE_DIR = getattr(settings, 'GEOFENCE_PROFILE_DIR',
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'var', 'profile'))
+
+ENV_VAR = 'GEOFENCE_PROFILE'
+
+HEADER = 'X-Geofence-Profile'
+
+HEADER_MAX_AGE = 24*60*60
+
+TOGGLE_SIGNAL = signal.SIGUSR2
+
+DUMP_SECONDS = 10
+
+_SALT = 'geofencing.dispatch.profiling'
+
+_state = {
+    'on': bool(os.environ.get(ENV_VAR)),
+    #the signal handlers are in place
+    'installed': False,
+    #profiled requests running (greenlets of a gevent worker)
+    'running': 0,
+    'dumped_at': time.time(),
+}
+
+#endpoint => {collapsed stack: samples}
+_stacks = {}
+
+#the endpoint of the current request when it is profiled, per thread (greenlet,
+#under gunicorn's gevent workers)
+_request = threading.local()
+
+def header_value():
+    """A value for the HEADER"""
+
+    return signing.dumps('profile', salt=_SALT)
+
+def _signed(value):
+    try:
+        return signing.loads(value, salt=_SALT, max_age=HEADER_MAX_AGE) == 'profile'
+    except signing.BadSignature:
+        return False
+
+def install():
+    """Sets up the signal handlers, in the worker's main thread. Returns
+    whether profiling is possible in this process."""
+
+    if not _state['installed']:
+        try:
+            signal.signal(TOGGLE_SIGNAL, _toggle)
+            signal.signal(signal.SIGPROF, _sample)
+        except ValueError:
+            #not the main thread (runserver without --nothreading): no profiling
+            return False
+        #a sample must not break the request's socket calls with EINTR
+        signal.siginterrupt(TOGGLE_SIGNAL, False)
+        signal.siginterrupt(signal.SIGPROF, False)
+        _state['installed'] = True
+    return True
+
+def _toggle(signum, frame):
+    _state['on'] = not _state['on']
+    if not _state['on']:
+        dump()
+
+def _sample(signum, frame):
+    endpoint = getattr(_request, 'endpoint', None)
+    if endpoint is None:
+        #another greenlet's turn
+        return
+
+    stack = []
+    while frame is not None and frame.f_code is not _ROOT:
+        stack.append('{0}:{1}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+        frame = frame.f_back
+    if frame is None or not stack:
+        return
+
+    stack = ';'.join(reversed(stack))
+    counts = _stacks.setdefault(endpoint, {})
+    counts[stack] = counts.get(stack, 0) + 1
+
+def _call(endpoint, view_func, request, *args, **kwargs):
+    """Runs the view with the sampler on"""
+
+    _request.endpoint = endpoint
+    _state['running'] += 1
+    if _state['running'] == 1:
+        signal.setitimer(signal.ITIMER_PROF, INTERVAL, INTERVAL)
+    try:
+        return view_func(request, *args, **kwargs)
+    finally:
+        _request.endpoint = None
+        _state['running'] -= 1
+        if not _state['running']:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+#where the stacks stop
+_ROOT = _call.func_code
+
+def dump():
+    """Writes out the profiles gathered so far"""
+
+    _state['dumped_at'] = time.time()
+    if not _stacks:
+        return
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    for endpoint, counts in _stacks.items():
+        path = os.path.join(PROFILE_DIR, '{0}-{1}.folded'.format(endpoint, os.getpid()))
+        with open(path + '.tmp', 'w') as f:
+            for stack, samples in sorted(counts.iteritems()):
+                f.write('{0} {1}\n'.format(stack, samples))
+        os.rename(path + '.tmp', path)
+
+class ProfilingMiddleware(object):
+    """Profiles the views of the sampled requests and of the ones with a
+    signed HEADER. Keep it last: it runs the view itself."""
+
+    def __init__(self):
+        #gunicorn workers already did, in wsgi.py
+        install()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not _state['installed']:
+            return None
+        header = request.META.get('HTTP_' + HEADER.upper().replace('-', '_'))
+        if not (header and _signed(header)) and not (_state['on'] and random.random() < SAMPLE_RATE):
+            return None
+
+        response = _call(getattr(view_func, '__name__', 'none'), view_func, request, *view_args, **view_kwargs)
+        if time.time() - _state['dumped_at'] >= DUMP_SECONDS:
+            dump()
+        return response
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime
+import time
+
+import numpy
+
+from geofencing.dispatch import cellindex, compact
+from geofencing.dispatch.fares import fare_bins
+from geofencing.dispatch.geo import PRECISION, encode_many
+from geofencing.dispatch.heatmap import HEATMAP_PRECISIONS
+from geofencing.dispatch.journal import EVENTS
+from geofencing.dispatch.scripts import script
+
+__doc__ = """
+        Rebuilds the core redis keys of trips() (see the README schema) from a
+        batch of raw events, aggregated in memory with NumPy instead of one
+        event at a time:
+
+            geohash:<gh>:days|weeks:<bucket>:tripids/tot_start_counter/
+                tot_stop_counter/tot_fare_counter/fare_histogram
+            geohash_prefixes:<prefix>
+            heatmap:<precision>:days|weeks:<bucket>[:<cell>]
+            event_times:<date>
+            trips_counter:<epoch>
+
+        The events are a RECORD_DTYPE (see journal.py) array and are bucketed
+        by their own time, not by when they are loaded. commands() turns them
+        into redis commands and write() sends those in big pipelines, at most
+        <budget> commands per second.
+
+        With additive=False the counters are SET, so rebuilding the same
+        buckets twice gives the same result (but every event of a bucket must
+        be in the same batch). With additive=True they are INCRBY'ed instead,
+        for loading a bucket in several batches. The heatmap rollups (see
+        heatmap.py) follow the counters, their trip HyperLogLogs are PFADDed
+        either way.
+
+        With publish=<the cell change feed of the db> (see cellindex.py) each
+        cell is also PUBLISHed on it, as trips() does, so the running workers'
+        cell indexes pick up the new cells.
+
+        Prefix sets keep the latest time a cell was seen whatever order the
+        batches are written in, and the trips_counter/event_times keys expire
+        90 days after the event, same as when trips() writes them (the ones
+        already past that are left out).
+
+        commands() always names the counters by their classic keys, write()
+        moves them to the hashes of the compact layout if that is the one in
+        use (see compact.py).
+"""
+
+EXPIRY = 90*24*60*60
+
+_BEGIN = EVENTS.index('begin')
+_END = EVENTS.index('end')
+
+#members per ZADDMAX call
+_BATCH = 1000
+
+#KEYS[1] sorted set, ARGV score, member, score, member.. only raises scores
+_ZADD_MAX_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i + 1])
+    if not score or tonumber(score) < tonumber(ARGV[i]) then
+        redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+def trips_delta(events):
+    """+1 for each 'begin', -1 for each 'end', 0 for the rest"""
+
+    return (events == _BEGIN).astype(numpy.int64) - (events == _END).astype(numpy.int64)
+
+def _labels(times):
+    """(day index, day labels, week index, week labels) of epoch <times>, as
+    in the days:<date>/weeks:<week> keys"""
+
+    days, day_index = numpy.unique((times // (24*60*60)).astype(numpy.int64), return_inverse=True)
+    moments = [datetime.utcfromtimestamp(day * 24*60*60) for day in days]
+    day_labels = ['{0}-{1}-{2}'.format(moment.year, moment.month, moment.day) for moment in moments]
+
+    weeks, week_of_day = numpy.unique([moment.strftime('%U') for moment in moments], return_inverse=True)
+    return day_index, day_labels, week_of_day[day_index], list(weeks)
+
+def _bucket_commands(cells, buckets, labels, kind, records, additive):
+    """Commands of the geohash:<gh>:<kind>:<bucket>:* keys"""
+
+    def key(cell, bucket, name):
+        return 'geohash:{0}:{1}:{2}:{3}'.format(cell, kind, labels[bucket], name)
+
+    increment, increment_float, set_field = (('INCRBY', 'INCRBYFLOAT', 'HINCRBY') if additive else
+                                             ('SET', 'SET', 'HSET'))
+
+    pairs = numpy.empty(len(records), dtype=[('cell', cells.dtype), ('bucket', '<i8')])
+    pairs['cell'] = cells
+    pairs['bucket'] = buckets
+
+    triples = numpy.empty(len(records), dtype=[('cell', cells.dtype), ('bucket', '<i8'), ('trip', records['trip'].dtype)])
+    triples['cell'] = cells
+    triples['bucket'] = buckets
+    triples['trip'] = records['trip']
+    for cell, bucket, trip in numpy.unique(triples):
+        yield ('ZADD', key(cell, bucket, 'tripids'), 0, trip)
+
+    begins = records['event'] == _BEGIN
+    for (cell, bucket), count in zip(*numpy.unique(pairs[begins], return_counts=True)):
+        yield (increment, key(cell, bucket, 'tot_start_counter'), int(count))
+
+    ends = records['event'] == _END
+    stops, index = numpy.unique(pairs[ends], return_inverse=True)
+    fares = numpy.bincount(index, weights=records['fare'][ends], minlength=len(stops))
+    for (cell, bucket), count, fare in zip(stops, numpy.bincount(index, minlength=len(stops)), fares):
+        yield (increment, key(cell, bucket, 'tot_stop_counter'), int(count))
+        yield (increment_float, key(cell, bucket, 'tot_fare_counter'), repr(float(fare)))
+
+    histogram = numpy.empty(ends.sum(), dtype=[('cell', cells.dtype), ('bucket', '<i8'), ('bin', '<i8')])
+    histogram['cell'] = cells[ends]
+    histogram['bucket'] = buckets[ends]
+    histogram['bin'] = fare_bins(records['fare'][ends])
+    for (cell, bucket, fare_bin), count in zip(*numpy.unique(histogram, return_counts=True)):
+        yield (set_field, key(cell, bucket, 'fare_histogram'), int(fare_bin), int(count))
+
+def _heatmap_commands(cells, buckets, labels, kind, records, additive):
+    """Commands of the heatmap:<precision>:<kind>:<bucket> rollups"""
+
+    set_field, set_float = ('HINCRBY', 'HINCRBYFLOAT') if additive else ('HSET', 'HSET')
+
+    begins = records['event'] == _BEGIN
+    ends = records['event'] == _END
+
+    for precision in HEATMAP_PRECISIONS:
+        def key(bucket):
+            return 'heatmap:{0}:{1}:{2}'.format(precision, kind, labels[bucket])
+
+        coarse = cells.astype('S{0}'.format(precision))
+        pairs = numpy.empty(len(records), dtype=[('cell', coarse.dtype), ('bucket', '<i8')])
+        pairs['cell'] = coarse
+        pairs['bucket'] = buckets
+
+        for (cell, bucket), count in zip(*numpy.unique(pairs[begins], return_counts=True)):
+            yield (set_field, key(bucket), cell + ':s', int(count))
+
+        stops, index = numpy.unique(pairs[ends], return_inverse=True)
+        fares = numpy.bincount(index, weights=records['fare'][ends], minlength=len(stops))
+        for (cell, bucket), count, fare in zip(stops, numpy.bincount(index, minlength=len(stops)), fares):
+            yield (set_field, key(bucket), cell + ':e', int(count))
+            yield (set_float, key(bucket), cell + ':f', repr(float(fare)))
+
+        for bucket in numpy.unique(buckets):
+            yield ('EXPIRE', key(bucket), EXPIRY)
+
+        triples = numpy.empty(len(records), dtype=[('cell', coarse.dtype), ('bucket', '<i8'), ('trip', records['trip'].dtype)])
+        triples['cell'] = coarse
+        triples['bucket'] = buckets
+        triples['trip'] = records['trip']
+        triples = numpy.unique(triples)
+        #sorted, so the trips of a cell and bucket are next to each other
+        starts = numpy.flatnonzero(numpy.r_[True, (triples['cell'][1:] != triples['cell'][:-1]) |
+                                                  (triples['bucket'][1:] != triples['bucket'][:-1])])
+        for start, stop in zip(starts, numpy.r_[starts[1:], len(triples)]):
+            trips_key = '{0}:{1}'.format(key(triples['bucket'][start]), triples['cell'][start])
+            for batch in range(start, stop, _BATCH):
+                yield ('PFADD', trips_key) + tuple(triples['trip'][batch:min(batch + _BATCH, stop)])
+            yield ('EXPIRE', trips_key, EXPIRY)
+
+def _last_seen(cells, times):
+    """(the distinct cells, sorted, the last time each one was seen)"""
+
+    unique_cells, index = numpy.unique(cells, return_inverse=True)
+    last_seen = numpy.zeros(len(unique_cells), dtype=numpy.int64)
+    numpy.maximum.at(last_seen, index, times.astype(numpy.int64))
+    return unique_cells, last_seen
+
+def _prefix_commands(cells, times):
+    """Commands of the geohash_prefixes:* sets, scored by the last time the
+    cell was seen"""
+
+    unique_cells, last_seen = _last_seen(cells, times)
+
+    for length in range(1, PRECISION):
+        prefixes = unique_cells.astype('S{0}'.format(length))
+        #the cells are sorted, so the ones sharing a prefix are next to each other
+        starts = numpy.flatnonzero(numpy.r_[True, prefixes[1:] != prefixes[:-1]])
+        for start, stop in zip(starts, numpy.r_[starts[1:], len(prefixes)]):
+            for batch in range(start, stop, _BATCH):
+                args = []
+                for cell, seen in zip(unique_cells[batch:min(batch + _BATCH, stop)],
+                                      last_seen[batch:min(batch + _BATCH, stop)]):
+                    args.extend((int(seen), cell))
+                yield ('ZADDMAX', 'geohash_prefixes:{0}'.format(prefixes[start])) + tuple(args)
+
+def _feed_commands(cells, times, channel):
+    """PUBLISHes of the cells on the cell change feed <channel>"""
+
+    for cell, seen in zip(*_last_seen(cells, times)):
+        yield ('PUBLISH', channel, cellindex.feed_message(cell, int(seen)))
+
+def _counter_commands(records, day_index, day_labels, trip_counts, now_seconds):
+    """Commands of the event_times:<date> and trips_counter:<epoch> keys"""
+
+    counted = (records['event'] == _BEGIN) | (records['event'] == _END)
+    seconds = records['time'][counted].astype(numpy.int64)
+    days = day_index[counted]
+    trip_counts = trip_counts[counted]
+    alive = seconds + EXPIRY > now_seconds
+
+    for day in numpy.unique(days[alive]):
+        in_day = alive & (days == day)
+        key = 'event_times:{0}'.format(day_labels[day])
+        for second in numpy.unique(seconds[in_day]):
+            yield ('ZADD', key, 0, int(second))
+        yield ('EXPIREAT', key, int(seconds[in_day].max()) + EXPIRY)
+
+    #the count after the last event of each second, as trips() leaves it
+    last = len(seconds) - 1 - numpy.unique(seconds[::-1], return_index=True)[1]
+    for second, count in zip(seconds[last], trip_counts[last]):
+        if second + EXPIRY > now_seconds:
+            key = 'trips_counter:{0}'.format(second)
+            yield ('SET', key, int(count))
+            yield ('EXPIREAT', key, int(second) + EXPIRY)
+
+def commands(records, trip_counts, additive=False, now_seconds=None, publish=None):
+    """Generates the redis commands rebuilding the keys of the <records>.
+
+    <records> is a RECORD_DTYPE array sorted by time, and <trip_counts> the
+    current_trips_counter right after each of them. With <publish>, a cell
+    change feed channel, the cells are announced on it too.
+    """
+
+    if not len(records):
+        return
+
+    if now_seconds is None:
+        now_seconds = time.time()
+
+    cells = encode_many(records['lat'], records['lng'])
+    day_index, day_labels, week_index, week_labels = _labels(records['time'])
+
+    for command in _bucket_commands(cells, day_index, day_labels, 'days', records, additive):
+        yield command
+    for command in _bucket_commands(cells, week_index, week_labels, 'weeks', records, additive):
+        yield command
+    for command in _heatmap_commands(cells, day_index, day_labels, 'days', records, additive):
+        yield command
+    for command in _heatmap_commands(cells, week_index, week_labels, 'weeks', records, additive):
+        yield command
+    for command in _prefix_commands(cells, records['time']):
+        yield command
+    if publish:
+        for command in _feed_commands(cells, records['time'], publish):
+            yield command
+    for command in _counter_commands(records, day_index, day_labels, trip_counts, now_seconds):
+        yield command
+
+def write(redis_conn, commands, pipeline_size=10000, budget=None, layout=None):
+    """Sends the <commands> in pipelines of <pipeline_size>, no faster than
+    <budget> commands per second (if given). Returns how many were sent.
+
+    <layout> is the key layout to write the counters in, GEOFENCE_KEY_LAYOUT
+    by default.
+    """
+
+    zadd_max = script(redis_conn, _ZADD_MAX_SCRIPT)
+    in_hashes = (layout or compact.LAYOUT) == 'compact'
+    started = time.time()
+    sent = 0
+
+    pipe = redis_conn.pipeline(transaction=False)
+    for command in commands:
+        if command[0] == 'ZADDMAX':
+            zadd_max(keys=[command[1]], args=command[2:], client=pipe)
+        elif in_hashes:
+            pipe.execute_command(*compact.translate(command))
+        else:
+            pipe.execute_command(*command)
+        sent += 1
+
+        if not sent % pipeline_size:
+            pipe.execute()
+            if budget:
+                ahead = float(sent) / budget - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    pipe.execute()
+
+    return sent
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import redis
+from redis.client import BasePipeline
+
+__doc__ = """
+        Lua scripts shared by the ingest helpers.
+
+        Scripts are registered on first use, as registering one loads it into
+        redis. Call the returned object with keys=[..], args=[..] and
+        optionally client=<pipeline> to queue it on a pipeline.
+"""
+
+_scripts = {}
+
+def script(redis_conn, source):
+    """Returns the redis-py Script object for the lua <source>. <redis_conn>
+    may be a pipeline (pass it as client= too)."""
+
+    if source not in _scripts:
+        if isinstance(redis_conn, BasePipeline):
+            #registering loads the script right away, which a pipeline would only queue
+            redis_conn = redis.StrictRedis(connection_pool=redis_conn.connection_pool)
+        _scripts[source] = redis_conn.register_script(source)
+    return _scripts[source]
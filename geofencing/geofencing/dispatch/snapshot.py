@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime
+import os
+import shutil
+
+import geohash
+import numpy
+
+from geofencing.dispatch import buckets, compact
+from geofencing.dispatch.geo import PRECISION, cell_to_int, common_prefix, int_to_cell, prefix_range
+from geofencing.dispatch.polygons import target_cells
+
+__doc__ = """
+        Offline snapshots of the per-cell, per-bucket counters, for questions
+        too big for the production redis (a whole year of a district..).
+
+        Layout
+        ======
+        <snapshot>/days/<column>.npy     one row per (cell, day) with data
+        <snapshot>/weeks/<column>.npy    one row per (cell, week) with data
+
+        columns:
+            cell    int64     the cell's geohash as a 60 bit int (see geo.py)
+            bucket  S10       the <date>/<week> part of the keys
+            trips   int64     ZCARD of ..:tripids
+            start   int64     ..:tot_start_counter
+            stop    int64     ..:tot_stop_counter
+            fare    float64   ..:tot_fare_counter
+
+        The counters are read from either key layout (see compact.py).
+
+        Rows are sorted by cell, then time. The columns are plain .npy files
+        opened with mmap, so loading a snapshot reads nothing up front and a
+        query only pages in the rows of its cells.
+
+        Queries take the same arguments as the live views and go through the
+        same cover logic (common prefix of the corners, or the polygon cover),
+        only the cells under a prefix are found by binary search on the cell
+        column instead of in geohash_prefixes:*.
+"""
+
+KINDS = ('days', 'weeks')
+
+COLUMNS = (('cell', numpy.int64), ('bucket', 'S10'), ('trips', numpy.int64),
+           ('start', numpy.int64), ('stop', numpy.int64), ('fare', numpy.float64))
+
+_FIELDS = {'tripids': 'trips', 'tot_start_counter': 'start',
+           'tot_stop_counter': 'stop', 'tot_fare_counter': 'fare'}
+
+def _time_order(kind, label):
+    """Sort key of a bucket label"""
+
+    if kind == 'days':
+        return datetime.strptime(label, '%Y-%m-%d').toordinal()
+    return int(label)
+
+def export(redis_conn, path, scan_count=10000):
+    """Writes a snapshot of the geohash:* counters to the directory <path>.
+
+    Runs a SCAN over the whole keyspace, so point it at a replica rather than
+    the redis taking the live events. Returns the rows written per kind.
+    """
+
+    rows = dict((kind, {}) for kind in KINDS)
+
+    def add(parts, value):
+        prefix, cell, kind, label, field = parts
+        rows[kind].setdefault((cell, label), {})[_FIELDS[field]] = value
+
+    cursor = 0
+    while True:
+        cursor, keys = redis_conn.execute_command('SCAN', cursor, 'MATCH', 'geohash:*', 'COUNT', scan_count)
+        cursor = int(cursor)
+
+        wanted = []
+        for key in keys:
+            parts = key.split(':')
+            if len(parts) == 5 and parts[2] in KINDS and parts[4] in _FIELDS and len(parts[1]) == PRECISION:
+                wanted.append((key, parts))
+
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for key, parts in wanted:
+                if parts[4] == 'tripids':
+                    pipe.zcard(key)
+                else:
+                    pipe.get(key)
+            values = pipe.execute()
+
+        for (key, parts), value in zip(wanted, values):
+            add(parts, value)
+
+        if not cursor:
+            break
+
+    #and the counters kept in the hashes of the compact layout (see compact.py)
+    cursor = 0
+    while True:
+        cursor, keys = redis_conn.execute_command('SCAN', cursor, 'MATCH', compact.PATTERN, 'COUNT', scan_count)
+        cursor = int(cursor)
+
+        keys = [key for key in keys if key.split(':')[1] in KINDS]
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            values = pipe.execute()
+
+        for key, fields in zip(keys, values):
+            for field, value in fields.iteritems():
+                add(compact.classic_key(key, field).split(':'), value)
+
+        if not cursor:
+            break
+
+    #write a new snapshot next to the old one, then swap them
+    building = path.rstrip('/') + '.building'
+    if os.path.exists(building):
+        shutil.rmtree(building)
+
+    counts = {}
+    for kind in KINDS:
+        os.makedirs(os.path.join(building, kind))
+        keys = sorted(rows[kind], key=lambda (cell, label): (cell, _time_order(kind, label)))
+        table = rows[kind]
+
+        columns = {
+            'cell': numpy.array([cell_to_int(cell) for cell, label in keys], dtype=numpy.int64),
+            'bucket': numpy.array([label for cell, label in keys], dtype='S10'),
+        }
+        for name, dtype in COLUMNS[2:]:
+            columns[name] = numpy.array([float(table[key].get(name) or 0) for key in keys]).astype(dtype)
+
+        for name, dtype in COLUMNS:
+            numpy.save(os.path.join(building, kind, name + '.npy'), columns[name])
+        counts[kind] = len(keys)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(building, path)
+
+    return counts
+
+class Snapshot(object):
+    """A snapshot on disk, and the offline versions of the box queries"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        for kind in KINDS:
+            self.tables[kind] = dict((name, numpy.load(os.path.join(path, kind, name + '.npy'), mmap_mode='r'))
+                                     for name, dtype in COLUMNS)
+
+    def _ranges(self, kind, prefixes):
+        """The [lo, hi) row range of the cells under each prefix"""
+
+        cells = self.tables[kind]['cell']
+        bounds = numpy.array([prefix_range(prefix) for prefix in prefixes], dtype=numpy.int64).reshape(-1, 2)
+        return (numpy.searchsorted(cells, bounds[:, 0], side='left'),
+                numpy.searchsorted(cells, bounds[:, 1], side='left'))
+
+    def cells_under(self, kind, prefixes):
+        """Same as the live lookup in geohash_prefixes:<prefix>, for each prefix
+        the cells under it (there are no sets for '' and full cells)"""
+
+        cells = self.tables[kind]['cell']
+        result = []
+        for prefix, lo, hi in zip(prefixes, *self._ranges(kind, prefixes)):
+            if 0 < len(prefix) < PRECISION:
+                result.append([int_to_cell(int(cell)) for cell in numpy.unique(cells[lo:hi])])
+            else:
+                result.append([])
+        return result
+
+    def _rows(self, kind, lat1, lng1, lat2, lng2, polygon):
+        """Indexes of the rows of the cells in the box (or the polygon)"""
+
+        cells = self.tables[kind]['cell']
+
+        if polygon is not None:
+            targets = numpy.array([cell_to_int(cell) for cell in
+                                   target_cells(polygon, lambda prefixes: self.cells_under(kind, prefixes))],
+                                  dtype=numpy.int64)
+            lo = numpy.searchsorted(cells, targets, side='left')
+            hi = numpy.searchsorted(cells, targets, side='right')
+        else:
+            prefix = common_prefix(geohash.encode(float(lat1), float(lng1)),
+                                   geohash.encode(float(lat2), float(lng2)))
+            if not 0 < len(prefix) < PRECISION:
+                return numpy.zeros(0, dtype=numpy.int64)
+            lo, hi = self._ranges(kind, [prefix])
+
+        if not len(lo):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate([numpy.arange(l, h) for l, h in zip(lo, hi)])
+
+    def _select(self, lat1, lng1, lat2, lng2, days_back, now, polygon):
+        """(table, rows) of the area and the time buckets of <days_back>"""
+
+        candidate_sub_keys, since = buckets.sub_keys(days_back, now or datetime.utcnow())
+        kind = candidate_sub_keys[0].split(':')[0]
+        labels = numpy.array([sub_key.split(':')[1] for sub_key in candidate_sub_keys], dtype='S10')
+
+        table = self.tables[kind]
+        rows = self._rows(kind, lat1, lng1, lat2, lng2, polygon)
+        return table, rows[numpy.in1d(table['bucket'][rows], labels)]
+
+    def trips_passed_through(self, lat1, lng1, lat2, lng2, days_back, now=None, polygon=None):
+        """Same count as the trips_passed_through view"""
+
+        table, rows = self._select(lat1, lng1, lat2, lng2, days_back, now, polygon)
+        return int(table['trips'][rows].sum())
+
+    def trips_start_stop(self, lat1, lng1, lat2, lng2, days_back, now=None, polygon=None):
+        """(start count, stop count, fare total), as the trips_start_stop view"""
+
+        table, rows = self._select(lat1, lng1, lat2, lng2, days_back, now, polygon)
+        return int(table['start'][rows].sum()), int(table['stop'][rows].sum()), float(table['fare'][rows].sum())
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left, bisect_right
+import calendar
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import random
+import threading
+import time
+import zlib
+
+from django.conf import settings
+import redis
+
+from geofencing.dispatch import cellindex, compact, metrics
+from geofencing.dispatch.cellindex import CellIndex
+
+__doc__ = """
+        Where the core schema of the README lives: the per-cell counters and
+        tripid sets, the geohash prefix index and the trips counter time
+        series. The views only talk to it through a storage object:
+
+        counters        incr(key, amount), incrbyfloat(key, amount), get(key),
+                        get_many(keys). Values come back as strings, as redis
+                        returns them
+        sorted sets     zadd(key, score, member), zcard_many(keys),
+                        expire(key, seconds)
+        prefix index    index_cell(cell, seen), cells_under(prefixes, since)
+        time series     update_trips(delta, now_seconds, trip_id), current_trips(),
+                        trips_at(seconds)
+        writes          batch(): a context manager giving a writer with the
+                        same write methods, for the events of a batch. The
+                        RedisStorage one sends all the writes in a single
+                        pipeline at the end of the block, and adds the
+                        update_trips deltas up into one update per second
+
+        RedisStorage keeps it all in redis, as described in the README, or
+        with the per-cell counters packed in hashes when GEOFENCE_KEY_LAYOUT
+        is 'compact' (see compact.py). The callers use the classic key names
+        either way.
+
+        current_trips_counter is a single key every begin and end event of the
+        fleet writes to, behind a WATCH. With GEOFENCE_TRIPS_COUNTER_STRIPES
+        set to N, RedisStorage instead INCRBYs one of N stripes
+        (current_trips_counter:<0..N-1>, picked by a crc32 of the tripId),
+        with no WATCH and no read, and the count is current_trips_counter
+        plus the stripes, summed from one MGET. Each worker then writes the
+        count to trips_counter:<epoch> and event_times:<date> every
+        TRIPS_SNAPSHOT_SECONDS while it has updates (from a background
+        thread, see _Snapshotter), so time_t_trip_count keeps answering from
+        the same keys, to the second. To turn striping off again, stop
+        ingest and run 'manage.py fold_trips_counter' first.
+
+        MemoryStorage keeps it in the process, for single box/edge deployments
+        (run a single gunicorn worker, the data is not shared) and tests.
+        Counters are slots of one array of doubles, the prefix index is a
+        CellIndex and the time series two parallel arrays of epochs and
+        counts, all behind one writer lock. Nothing is persisted, use the
+        journal (see journal.py) to rebuild it.
+
+        Both have a <redis_conn> attribute for the redis-only features
+        (heatmap, fences, active trips..), None when there is no redis at
+        all: those features are then turned off.
+
+        Set GEOFENCE_STORAGE to 'redis' (the default) or 'memory'.
+"""
+
+#how long the trips_counter:<epoch> and event_times:<date> keys are kept
+TIME_SERIES_EXPIRY = 90*24*60*60
+
+CURRENT_TRIPS_KEY = 'current_trips_counter'
+
+#stripes of the current trips counter, 0 for the single WATCHed key
+TRIPS_COUNTER_STRIPES = getattr(settings, 'GEOFENCE_TRIPS_COUNTER_STRIPES', 0)
+
+#how often the striped count is written to the time series
+TRIPS_SNAPSHOT_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+def _day(seconds):
+    moment = datetime.utcfromtimestamp(seconds)
+    return '{0}-{1}-{2}'.format(moment.year, moment.month, moment.day)
+
+def stripe_keys(stripes):
+    return ['{0}:{1}'.format(CURRENT_TRIPS_KEY, stripe) for stripe in range(stripes)]
+
+def set_current_trips(redis_conn, count, stripes=None):
+    """Sets the current trips counter to <count>, stripes and all"""
+
+    keys = stripe_keys(TRIPS_COUNTER_STRIPES if stripes is None else stripes)
+    with redis_conn.pipeline() as pipe:
+        pipe.set(CURRENT_TRIPS_KEY, count)
+        if keys:
+            pipe.delete(*keys)
+        pipe.execute()
+
+def get_current_trips(redis_conn, stripes=None):
+    """The current trips count, stripes and all, as redis returns it (None
+    if there is none)"""
+
+    values = [value for value in redis_conn.mget([CURRENT_TRIPS_KEY] +
+              stripe_keys(TRIPS_COUNTER_STRIPES if stripes is None else stripes)) if value is not None]
+    return str(sum(int(value) for value in values)) if values else None
+
+#adds up the stripes into the counter and drops them, atomically
+_FOLD_SCRIPT = """
+local total = tonumber(redis.call('GET', KEYS[1]) or 0)
+for i = 2, #KEYS do
+    total = total + tonumber(redis.call('GET', KEYS[i]) or 0)
+    redis.call('DEL', KEYS[i])
+end
+redis.call('SET', KEYS[1], total)
+return total
+"""
+
+def fold_trips_stripes(redis_conn, stripes):
+    """Moves the counts of <stripes> stripes into the single counter.
+    Returns the count."""
+
+    return redis_conn.eval(_FOLD_SCRIPT, stripes + 1, CURRENT_TRIPS_KEY, *stripe_keys(stripes))
+
+class _Snapshotter(object):
+    """Writes the striped trips count of a RedisStorage to the time series
+    every TRIPS_SNAPSHOT_SECONDS, when it was updated since the last time"""
+
+    def __init__(self, store):
+        self.store = store
+        self.updated = False
+        thread = threading.Thread(target=self._run, name='trips-snapshots')
+        thread.daemon = True
+        thread.start()
+
+    def touch(self):
+        self.updated = True
+
+    def _run(self):
+        while True:
+            time.sleep(TRIPS_SNAPSHOT_SECONDS)
+            if not self.updated:
+                continue
+            self.updated = False
+            try:
+                self.store.snapshot_trips(int(time.time()))
+            except Exception:
+                logger.exception('trips counter snapshot failed')
+                self.updated = True
+
+class RedisStorage(object):
+    """The schema of the README, in redis.
+
+    With cell_index=False no worker-local cell index is kept, for a process
+    that only writes (the ingest server): the cells it sees are still
+    published for the workers' indexes.
+    """
+
+    def __init__(self, redis_conn, layout=None, stripes=None, cell_index=True):
+        self.redis_conn = redis_conn
+        self.keep_cell_index = cell_index
+        #counters in the hashes of compact.py rather than a key each
+        self.compact = (layout or compact.LAYOUT) == 'compact'
+        #stripes of the current trips counter (0: the single WATCHed key)
+        self.stripes = TRIPS_COUNTER_STRIPES if stripes is None else stripes
+        #worker-local index of active cells, built on first use (i.e. after gunicorn forks)
+        self._cell_index = None
+        #started on the first striped update, ditto
+        self._snapshotter = None
+
+    def _get_cell_index(self):
+        """Returns this worker's CellIndex, or None if it is turned off in settings"""
+
+        if not (self.keep_cell_index and getattr(settings, 'GEOFENCE_CELL_INDEX', False)):
+            return None
+        if self._cell_index is None:
+            self._cell_index = cellindex.start(self.redis_conn)
+        return self._cell_index
+
+    #counters
+
+    def _locate(self, key):
+        """(hash, field) of a counter in the compact layout, else None"""
+
+        return compact.locate(key) if self.compact else None
+
+    def incr(self, key, amount=1):
+        located = self._locate(key)
+        if located is not None:
+            return self.redis_conn.hincrby(located[0], located[1], amount)
+        return self.redis_conn.incr(key, amount)
+
+    def incrbyfloat(self, key, amount):
+        located = self._locate(key)
+        if located is not None:
+            return self.redis_conn.hincrbyfloat(located[0], located[1], amount)
+        return self.redis_conn.incrbyfloat(key, amount)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        if not self.compact:
+            return self.redis_conn.mget(keys)
+
+        #one HMGET per hash (neighbouring cells share one) and one MGET for the
+        #rest, in a single round trip
+        plain = []
+        hashes = {}
+        for i, key in enumerate(keys):
+            located = compact.locate(key)
+            if located is None:
+                plain.append(i)
+            else:
+                hashes.setdefault(located[0], []).append((i, located[1]))
+        hashes = hashes.items()
+
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for hash_key, fields in hashes:
+                pipe.hmget(hash_key, [field for i, field in fields])
+            if plain:
+                pipe.mget([keys[i] for i in plain])
+            replies = pipe.execute()
+
+        values = [None] * len(keys)
+        for (hash_key, fields), reply in zip(hashes, replies):
+            for (i, field), value in zip(fields, reply):
+                values[i] = value
+        if plain:
+            for i, value in zip(plain, replies[-1]):
+                values[i] = value
+        return values
+
+    #sorted sets
+
+    def zadd(self, key, score, member):
+        self.redis_conn.zadd(key, score, member)
+
+    def zcard_many(self, keys):
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zcard(key)
+            return pipe.execute()
+
+    def expire(self, key, seconds):
+        self.redis_conn.expire(key, seconds)
+
+    #prefix index
+
+    def index_cell(self, geohash_string, seen):
+        """Records that the cell was seen at epoch <seen>"""
+
+        #the property of geohashes is that if they are close together they will
+        #share the same prefix. So each cell goes in the sorted set of every one
+        #of its prefixes, scored by the time it was last seen (see README)
+        for i in range(1, len(geohash_string)):
+            self.redis_conn.zadd('geohash_prefixes:{0}'.format(geohash_string[:i]), seen, geohash_string)
+
+        #let the workers' local cell indexes know about it. our own index (if we
+        #keep one) is updated right away so this worker's next query already sees the cell
+        if getattr(settings, 'GEOFENCE_CELL_INDEX', False):
+            cell_index = self._get_cell_index()
+            if cell_index is not None:
+                cell_index.touch(geohash_string, seen)
+            self.redis_conn.publish(cellindex.feed_channel(self.redis_conn),
+                                    cellindex.feed_message(geohash_string, seen))
+
+    def cells_under(self, prefixes, since):
+        """Returns, for each prefix, the list of active cells under it (i.e. the
+        members of geohash_prefixes:<prefix>) in one batched lookup.
+
+        <since> is the epoch before which cells are known to be of no interest.
+        """
+
+        cell_index = self._get_cell_index()
+        if cell_index is not None:
+            metrics.inc('geofence_cell_lookups_total', len(prefixes), source='index')
+            return [cell_index.cells_with_prefix(prefix, since) for prefix in prefixes]
+
+        metrics.inc('geofence_cell_lookups_total', len(prefixes), source='redis')
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for prefix in prefixes:
+                pipe.zrange('geohash_prefixes:{0}'.format(prefix), 0, -1)
+            return pipe.execute()
+
+    #time series
+
+    def _incr_stripe(self, delta, trip_id):
+        """Adds <delta> to the stripe of <trip_id>"""
+
+        if trip_id is None:
+            stripe = random.randrange(self.stripes)
+        else:
+            stripe = (zlib.crc32(str(trip_id)) & 0xffffffff) % self.stripes
+        self.redis_conn.incr('{0}:{1}'.format(CURRENT_TRIPS_KEY, stripe), delta)
+
+    def _touch_snapshotter(self):
+        if self._snapshotter is None:
+            self._snapshotter = _Snapshotter(self)
+        self._snapshotter.touch()
+
+    def snapshot_trips(self, now_seconds):
+        """Records the current (striped) trips count as the count at <now_seconds>"""
+
+        count = int(self.current_trips() or 0)
+        trips_counter_key = 'trips_counter:{0}'.format(now_seconds)
+        event_times_key = 'event_times:{0}'.format(_day(now_seconds))
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            pipe.set(trips_counter_key, count)
+            pipe.expire(trips_counter_key, TIME_SERIES_EXPIRY)
+            pipe.zadd(event_times_key, 0, now_seconds)
+            pipe.expire(event_times_key, TIME_SERIES_EXPIRY)
+            pipe.execute()
+        return count
+
+    def update_trips(self, delta, now_seconds, trip_id=None):
+        """
+        Adds <delta> to the current trips counter and records the new value as
+        the count at <now_seconds>. Since two distinct counters are updated, we
+        use a transaction mechanism.
+
+        With stripes, adds <delta> to the stripe of <trip_id> instead, and the
+        count is recorded by the next snapshot.
+
+        Reference: https://github.com/andymccurdy/redis-py [Section on pipelines]
+        """
+
+        if self.stripes:
+            self._incr_stripe(delta, trip_id)
+            self._touch_snapshotter()
+            return None
+
+        current_trips_counter_key = CURRENT_TRIPS_KEY
+        #trips_counter:<epoch time>
+        trips_counter_key = 'trips_counter:{0}'.format(now_seconds)
+
+        with self.redis_conn.pipeline() as pipe:
+            while 1:
+                try:
+                    # put a WATCH on the key that holds our sequence value
+                    pipe.watch(current_trips_counter_key)
+                    # after WATCHing, the pipeline is put into immediate execution
+                    # mode until we tell it to start buffering commands again.
+                    # this allows us to get the current value of our sequence
+                    current_value = pipe.get(current_trips_counter_key)
+                    #current_value could be returned a None
+                    next_value = int(current_value or 0) + delta
+
+                    # now we can put the pipeline back into buffered mode with MULTI
+                    pipe.multi()
+                    pipe.set(current_trips_counter_key, next_value)
+                    pipe.set(trips_counter_key, next_value)
+                    pipe.expire(trips_counter_key, TIME_SERIES_EXPIRY)
+                    # and finally, execute the pipeline (the set command)
+                    pipe.execute()
+                    # if a WatchError wasn't raised during execution, everything
+                    # we just did happened atomically.
+                    break
+                except redis.WatchError:
+                    # another client must have changed 'OUR-SEQUENCE-KEY' between
+                    # the time we started WATCHing it and the pipeline's execution.
+                    # our best bet is to just retry.
+                    metrics.inc('geofence_redis_watch_retries_total')
+                    continue
+
+        #add the timestamp to a sorted set. This is used in case a query comes
+        #in for a timestamp for which we don't have an exact key at
+        #trips_counter:<timestamp>. So we will then choose the first value from
+        #this sorted set which is sligthly lesser than <timestamp> as that is the
+        #last recorded value we have closest to <timestamp>
+        event_times_key = 'event_times:{0}'.format(_day(now_seconds))
+        self.redis_conn.zadd(event_times_key, 0, now_seconds)
+
+        #set it's expiry to 90 days since when it was last accessed
+        self.redis_conn.expire(event_times_key, TIME_SERIES_EXPIRY)
+
+        return next_value
+
+    #writes
+
+    @contextmanager
+    def batch(self):
+        writer = _RedisBatch(self)
+        yield writer
+        writer.flush()
+
+    def current_trips(self):
+        if self.stripes:
+            return get_current_trips(self.redis_conn, self.stripes)
+        return self.redis_conn.get(CURRENT_TRIPS_KEY)
+
+    def trips_at(self, seconds):
+        """The trips count at epoch <seconds>, or None if there is no info for
+        that day"""
+
+        #first lets see if there is a key called trips_counter:<timestamp>
+        count = self.redis_conn.get('trips_counter:{0}'.format(seconds))
+        if count:
+            return count
+
+        #ok, so this key is not there. so we have to search the appropriate bucket
+        #for the closest timestamp
+        event_times_key = 'event_times:{0}'.format(_day(seconds))
+
+        if not self.redis_conn.exists(event_times_key):
+            #so the event_times_key sorted set does not even exist. Since the
+            #requirements state that there are an average of 500 trips hapenning
+            #at any given time, the only explanation for a day bucket not being
+            #present is that it is aged out (i.e. expired). Maybe it has passed
+            #90 days or something...
+            return None
+
+        #so now we have to find the closest timestamp in the sorted set
+        #but iterating over the set in a O(n) operation. Also, if the set
+        #is large it can hold up redis while it is returning the set
+
+        #here's a quick hack to find the closest element...
+
+        #first add the time you are looking for into the sorted set
+        self.redis_conn.zadd(event_times_key, 0, seconds) #O(log(n))
+        #since it is a sorted set we know that what we added went into the right position
+        #so get it's index
+        rank = int(self.redis_conn.zrank(event_times_key, seconds)) #O(log(n))
+
+        #now we have the rank, just get the previous index
+        required_time_key = self.redis_conn.zrange(event_times_key, rank-1, rank-1)[0] #O(log(N)+1)
+        #thus required_time_key is the key we are looking for and we can get the
+        #final trip count by GETing trips_counter:<required_time_key>
+
+        count = self.redis_conn.get('trips_counter:{0}'.format(required_time_key))
+
+        #cleanup event_times_key sorted set
+        self.redis_conn.zrem(event_times_key, seconds) #O(1*log(N))
+
+        return count
+
+class _RedisBatch(RedisStorage):
+    """The write methods of a RedisStorage, buffered in one pipeline until
+    flush(). Don't read through it."""
+
+    def __init__(self, store):
+        super(_RedisBatch, self).__init__(store.redis_conn.pipeline(transaction=False), stripes=store.stripes)
+        self.compact = store.compact
+        self.store = store
+        #epoch => trips delta
+        self.trips = {}
+        self.striped = False
+
+    def _get_cell_index(self):
+        return self.store._get_cell_index()
+
+    def update_trips(self, delta, now_seconds, trip_id=None):
+        if self.stripes:
+            #no read, so it can go in the pipeline
+            self._incr_stripe(delta, trip_id)
+            self.striped = True
+            return
+        self.trips[now_seconds] = self.trips.get(now_seconds, 0) + delta
+
+    def flush(self):
+        """Sends the writes, then the trips counter updates"""
+
+        try:
+            self.redis_conn.execute()
+        finally:
+            self.redis_conn.reset()
+        if self.striped:
+            self.store._touch_snapshotter()
+        for now_seconds in sorted(self.trips):
+            if self.trips[now_seconds]:
+                self.store.update_trips(self.trips[now_seconds], now_seconds)
+        self.trips = {}
+
+def _format(value):
+    """A number as redis would return it"""
+
+    return str(int(value)) if value == int(value) else repr(value)
+
+class MemoryStorage(object):
+    """The same schema, in this process. See module doc."""
+
+    def __init__(self, redis_conn=None):
+        self.redis_conn = redis_conn
+
+        #single writer: readers only ever see whole updates
+        self.lock = threading.Lock()
+
+        #counter key => slot in values
+        self.slots = {}
+        self.values = array('d')
+
+        self.sorted_sets = {}
+        self.expiry = {}
+
+        self.cells = CellIndex()
+
+        #trips counter time series, in time order
+        self.current = None
+        self.times = array('l')
+        self.counts = array('l')
+
+    def _expired(self, key):
+        """Drops <key> if its expiry has passed. Call with the lock held."""
+
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.time():
+            del self.expiry[key]
+            self.sorted_sets.pop(key, None)
+            if key in self.slots:
+                self.values[self.slots.pop(key)] = 0
+            return True
+        return False
+
+    #counters
+
+    def _add(self, key, amount):
+        with self.lock:
+            self._expired(key)
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = len(self.values)
+                self.values.append(0)
+            self.values[slot] += amount
+            return self.values[slot]
+
+    def incr(self, key, amount=1):
+        return int(self._add(key, amount))
+
+    def incrbyfloat(self, key, amount):
+        return self._add(key, float(amount))
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        result = []
+        with self.lock:
+            for key in keys:
+                slot = None if self._expired(key) else self.slots.get(key)
+                result.append(None if slot is None else _format(self.values[slot]))
+        return result
+
+    #sorted sets
+
+    def zadd(self, key, score, member):
+        with self.lock:
+            self._expired(key)
+            self.sorted_sets.setdefault(key, {})[str(member)] = score
+
+    def zcard_many(self, keys):
+        with self.lock:
+            return [0 if self._expired(key) else len(self.sorted_sets.get(key, ())) for key in keys]
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if key in self.slots or key in self.sorted_sets:
+                self.expiry[key] = time.time() + seconds
+
+    #prefix index
+
+    def index_cell(self, geohash_string, seen):
+        self.cells.touch(geohash_string, seen)
+
+    def cells_under(self, prefixes, since):
+        return [self.cells.cells_with_prefix(prefix, since) for prefix in prefixes]
+
+    #time series
+
+    def update_trips(self, delta, now_seconds, trip_id=None):
+        with self.lock:
+            self.current = (self.current or 0) + delta
+
+            #same second as the last update: like trips_counter:<epoch>, the
+            #latest count wins
+            if self.times and self.times[-1] == now_seconds:
+                self.counts[-1] = self.current
+            else:
+                self.times.append(now_seconds)
+                self.counts.append(self.current)
+
+            #age out the counts older than redis would keep them
+            if self.times[0] <= now_seconds - TIME_SERIES_EXPIRY:
+                keep = bisect_right(self.times, now_seconds - TIME_SERIES_EXPIRY)
+                del self.times[:keep]
+                del self.counts[:keep]
+
+            return self.current
+
+    #writes
+
+    @contextmanager
+    def batch(self):
+        #in memory already, nothing to buffer
+        yield self
+
+    def current_trips(self):
+        return None if self.current is None else str(self.current)
+
+    def trips_at(self, seconds):
+        """The trips count at epoch <seconds>, i.e. after the last update at or
+        before it, or None if there was no update at all that day"""
+
+        day_start = calendar.timegm(datetime.utcfromtimestamp(seconds).date().timetuple())
+
+        with self.lock:
+            if bisect_left(self.times, day_start) == bisect_left(self.times, day_start + 24*60*60):
+                return None
+            i = bisect_right(self.times, seconds)
+            return str(self.counts[i - 1]) if i else None
+
+def get_storage(redis_conn):
+    """The storage of GEOFENCE_STORAGE, <redis_conn> being the connection of
+    the redis one"""
+
+    if getattr(settings, 'GEOFENCE_STORAGE', 'redis') == 'memory':
+        return MemoryStorage()
+    return RedisStorage(redis_conn)
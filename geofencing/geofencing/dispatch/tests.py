@@ -1,13 +1,31 @@
 #!/usr/bin/env python
 #! -*- coding: utf-8 -*-
 
+import calendar
 from datetime import datetime
+from itertools import islice
+from StringIO import StringIO
 import json
+import logging
 import os
+import shutil
+import tempfile
+import time
+from unittest import skip
 
+from django.core.management import call_command
 from django.test import Client, TestCase
+from django.test.client import RequestFactory
+import numpy
 import redis
 
+from geofencing.dispatch.cellindex import CellIndex
+from geofencing.dispatch.fences import FenceIndex
+from geofencing.dispatch import admission, cellindex, heatmap as heatmaps, journal, metrics, profiling, storage, tracing, wire
+from geofencing.dispatch.heatmap import RECORD_DTYPE
+from geofencing.dispatch.polygons import parse_geojson
+from geofencing.dispatch.snapshot import Snapshot
+
 __doc__ = """
 
     You need to have redis running locally to have these working.
@@ -58,6 +76,46 @@ class GeoFenceTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['count'], '1')
 
+    def test_trips_batch(self):
+        """a json array of events is taken in one request, or not at all if one is malformed"""
+        batch = [{"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":1001},
+                 {"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":1002},
+                 {"event":"end", "lat":37.800619, "lng":-122.401782, "tripId":1001}]
+        response = self.client.post('/trips/', json.dumps(batch), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fare missing', response.content)
+
+        batch[-1]['fare'] = 12
+        response = self.client.post('/trips/', json.dumps(batch), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/query/trip_count_right_now/')
+        self.assertEqual(response.context['count'], '2')
+        response = self.client.post('/query/trips_start_stop/', {'lat1': self.bounding_box1_lat1,
+            'lng1': self.bounding_box1_lng1, 'lat2': self.bounding_box1_lat2, 'lng2': self.bounding_box1_lng2,
+            'days_back': '0d'})
+        self.assertEqual(response.context['start_count'], 4)
+        self.assertEqual(response.context['stop_count'], 2)
+        self.assertEqual(response.context['fare_count'], 32)
+
+    def test_trips_packed(self):
+        """packed binary events are taken like their json"""
+        body = wire.pack([{"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":1001},
+                          {"event":"end", "lat":37.800619, "lng":-122.401782, "tripId":1001, "fare":12.5}])
+        self.assertEqual(len(body), 2 * 33)
+
+        response = self.client.post('/trips/', body[:-1], content_type=wire.CONTENT_TYPE)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/trips/', body, content_type=wire.CONTENT_TYPE)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/query/trips_start_stop/', {'lat1': self.bounding_box1_lat1,
+            'lng1': self.bounding_box1_lng1, 'lat2': self.bounding_box1_lat2, 'lng2': self.bounding_box1_lng2,
+            'days_back': '0d'})
+        self.assertEqual(response.context['start_count'], 3)
+        self.assertEqual(response.context['stop_count'], 2)
+        self.assertEqual(response.context['fare_count'], 32.5)
+
     def test_time_t_trip_count(self):
         """There would be 1 trip at time self.trip_2_approx_start_time"""
         response = self.client.post('/query/trip_count_at_time_t/', {'time_instant': self.trip_2_approx_start_time.strftime('%Y-%m-%d %H:%M:%S')})
@@ -101,6 +159,129 @@ class GeoFenceTest(TestCase):
         self.assertEqual(response.context['stop_count'], 1)
         self.assertEqual(response.context['fare_count'], 40)
 
+    def test_metrics(self):
+        """/metrics has the requests, their redis use and the cells/buckets queried"""
+        self.client.post('/query/trips_passed_through/', {'lat1': self.bounding_box1_lat1, 'lng1': self.bounding_box1_lng1,
+            'lat2': self.bounding_box1_lat2, 'lng2': self.bounding_box1_lng2, 'days_back': '2d'})
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        samples = dict(line.rsplit(' ', 1) for line in response.content.splitlines() if not line.startswith('#'))
+
+        self.assertGreaterEqual(float(samples['geofence_request_seconds_count{endpoint="trips"}']), 5)
+        self.assertIn('geofence_redis_roundtrips_per_request_bucket{endpoint="trips",le="+Inf"}', samples)
+        self.assertGreaterEqual(float(samples['geofence_query_buckets_sum{endpoint="trips_passed_through"}']), 2)
+        #the counters too
+        self.assertIn('geofence_query_admission_total{endpoint="trips_passed_through",outcome="admitted"}', samples)
+        self.assertIn('# TYPE geofence_request_seconds histogram', response.content)
+
+    def test_slow_trace(self):
+        """a traced slow request logs its redis commands by key pattern"""
+        from geofencing.dispatch import views
+
+        traced = redis.StrictRedis(connection_pool=redis.ConnectionPool(connection_class=tracing.TracingConnection,
+                                   host='127.0.0.1', port=7878, db=int(os.environ['REDIS_DB_NUM'])))
+        lines = []
+        handler = logging.Handler()
+        handler.emit = lambda record: lines.append(json.loads(record.getMessage()))
+        tracing.logger.addHandler(handler)
+        live = (views.store, tracing.ENABLED, tracing.SAMPLE_RATE, tracing.SLOW_MS)
+        views.store = storage.RedisStorage(traced)
+        tracing.ENABLED, tracing.SAMPLE_RATE, tracing.SLOW_MS = True, 1.0, 0
+        try:
+            self.client.post('/query/trips_start_stop/', {'lat1': self.bounding_box2_lat1, 'lng1': self.bounding_box2_lng1,
+                'lat2': self.bounding_box2_lat2, 'lng2': self.bounding_box2_lng2, 'days_back': '1w'})
+        finally:
+            views.store, tracing.ENABLED, tracing.SAMPLE_RATE, tracing.SLOW_MS = live
+            tracing.logger.removeHandler(handler)
+
+        self.assertEqual(len(lines), 1)
+        trace = lines[0]
+        self.assertEqual(trace['endpoint'], 'trips_start_stop')
+        self.assertEqual(trace['params']['days_back'], '1w')
+        self.assertEqual(trace['notes']['buckets'], 1)
+        self.assertEqual(trace['commands'], len(trace['timeline']))
+        #the counters of the week bucket, in either key layout
+        self.assertTrue([pattern for pattern in trace['by_pattern'] if ':weeks:*' in pattern])
+        self.assertEqual(tracing.key_pattern('geohash:9q8zn9dzd0u0:weeks:35:tot_start_counter'),
+                         'geohash:*:weeks:*:tot_start_counter')
+        self.assertEqual(tracing.key_pattern('cells:days:2013-9-1:9q8zn9dz'), 'cells:days:*:*')
+
+    def test_admission(self):
+        """queries over budget are answered coarse or turned down, heavy ones are capped and cancelled"""
+        box = {'lat1': self.bounding_box1_lat1, 'lng1': self.bounding_box1_lng1,
+               'lat2': self.bounding_box1_lat2, 'lng2': self.bounding_box1_lng2, 'days_back': '0d'}
+        live = (admission.BUDGET, admission.OVER_BUDGET, admission.HEAVY_COST, admission.HEAVY_PER_WORKER, admission.DEADLINE)
+        try:
+            admission.BUDGET = 1
+            response = self.client.post('/query/trips_start_stop/', box)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.context['approximate'])
+            self.assertGreaterEqual(response.context['start_count'], 2)
+            self.assertEqual(response.context['fare_median'], None)
+
+            #a heavy coarse answer has a deadline too
+            admission.HEAVY_COST, admission.DEADLINE = 0, -1
+            response = self.client.post('/query/trips_passed_through/', box)
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('cancelled', response.context['error'])
+            admission.HEAVY_COST, admission.DEADLINE = live[2], live[4]
+
+            admission.OVER_BUDGET = 'reject'
+            response = self.client.post('/query/trips_passed_through/', box)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('time buckets', response.context['error'])
+
+            admission.BUDGET, admission.HEAVY_COST, admission.HEAVY_PER_WORKER = 1000, 0, 0
+            response = self.client.post('/query/trips_passed_through/', box)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+
+            admission.HEAVY_PER_WORKER, admission.DEADLINE = 1, -1
+            response = self.client.post('/query/trips_start_stop/', box)
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('cancelled', response.context['error'])
+            #the slot was given back
+            self.assertEqual(admission._state['heavy'], 0)
+        finally:
+            admission.BUDGET, admission.OVER_BUDGET, admission.HEAVY_COST, admission.HEAVY_PER_WORKER, admission.DEADLINE = live
+
+        response = self.client.post('/query/trips_start_stop/', box)
+        self.assertFalse(response.context['approximate'])
+        self.assertEqual(response.context['start_count'], 2)
+
+    def test_snapshot(self):
+        """an offline snapshot gives the same answers as redis"""
+        snapshot_dir = os.path.join(tempfile.mkdtemp(), 'snapshot')
+        call_command('export_snapshot', snapshot_dir, stdout=StringIO())
+        engine = Snapshot(snapshot_dir)
+
+        self.assertEqual(engine.trips_passed_through(self.bounding_box1_lat1, self.bounding_box1_lng1,
+            self.bounding_box1_lat2, self.bounding_box1_lng2, '0d'), 3)
+        self.assertEqual(engine.trips_start_stop(self.bounding_box2_lat1, self.bounding_box2_lng1,
+            self.bounding_box2_lat2, self.bounding_box2_lng2, '1w'), (1, 1, 40))
+
+        polygon = parse_geojson(json.dumps({"type": "Polygon", "coordinates": [
+            [[-122.44, 37.784], [-122.43, 37.784], [-122.43, 37.792], [-122.44, 37.792], [-122.44, 37.784]],
+            ]}))
+        self.assertEqual(engine.trips_start_stop(None, None, None, None, '0d', polygon=polygon), (1, 1, 40))
+        shutil.rmtree(os.path.dirname(snapshot_dir))
+
+    def test_trips_start_stop_fare_percentiles(self):
+        """the fare percentiles of trips 1/3 are within 1% of their fares"""
+        self.client.post('/trips/', json.dumps({"event":"end", "lat":37.80164, "lng":-122.402244, "tripId":456, "fare":10}), content_type='application/json')
+
+        response = self.client.post('/query/trips_start_stop/', {'lat1': 37.81,
+            'lng1': -122.44,
+            'lat2': 37.78,
+            'lng2': -122.40,
+            'days_back': '0d', #today
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['fare_count'], 70)
+        self.assertAlmostEqual(response.context['fare_median'], 20, delta=0.2)
+        self.assertAlmostEqual(response.context['fare_p95'], 40, delta=0.4)
+
     def test_trips_passed_through2(self):
         """the bounding box 2 contains only trip 3"""
         response = self.client.post('/query/trips_passed_through/', {'lat1': self.bounding_box2_lat1,
@@ -112,11 +293,807 @@ class GeoFenceTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['count'], 2)
 
+    def test_trips_start_stop_polygon(self):
+        """a GeoJSON polygon around cpmc and mt zion contains only trip 3"""
+        polygon = {"type": "Polygon", "coordinates": [[
+            [-122.4400, 37.7920], [-122.4300, 37.7920], [-122.4300, 37.7840], [-122.4400, 37.7840],
+            ]]}
+        response = self.client.post('/query/trips_start_stop/', {'polygon': json.dumps(polygon),
+            'days_back': '0d', #today
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['start_count'], 1)
+        self.assertEqual(response.context['stop_count'], 1)
+        self.assertEqual(response.context['fare_count'], 40)
+
+    def test_trips_passed_through_polygon(self):
+        """a trapezoid with coit tower and levi strauss in it, but not piperade"""
+        polygon = {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[
+            [-122.4070, 37.8040], [-122.4000, 37.8040], [-122.4000, 37.8012], [-122.4070, 37.8020],
+            ]]}}
+        response = self.client.post('/query/trips_passed_through/', {'polygon': json.dumps(polygon),
+            'days_back': '0d', #today
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['count'], 2)
+
+    def test_active_trips(self):
+        """only trip 2 is still going, it started at levi strauss"""
+        response = self.client.get('/query/active_trips/', {'lat1': 37.8040,
+            'lng1': -122.4070,
+            'lat2': 37.8010,
+            'lng2': -122.4000,
+            })
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['count'], 1)
+        self.assertEqual(result['trip_ids'], ['456'])
+
+        response = self.client.get('/query/active_trips/', {'lat1': self.bounding_box2_lat1,
+            'lng1': self.bounding_box2_lng1,
+            'lat2': self.bounding_box2_lat2,
+            'lng2': self.bounding_box2_lng2,
+            })
+        self.assertEqual(json.loads(response.content)['count'], 0)
+
+    def test_nearest_trips(self):
+        """the nearest active trip to coit tower is trip 2, ~400m away"""
+        self.client.post('/trips/', json.dumps({"event":"begin", "lat":37.7749, "lng":-122.4194, "tripId":999}), content_type='application/json')
+
+        response = self.client.get('/query/nearest_trips/', {'lat': 37.8025, 'lng': -122.4058, 'k': 1})
+        self.assertEqual(response.status_code, 200)
+        trips = json.loads(response.content)['trips']
+        self.assertEqual([trip['tripId'] for trip in trips], ['456'])
+        self.assertTrue(300 < trips[0]['distance'] < 500)
+
+        response = self.client.get('/query/nearest_trips/', {'lat': 37.8025, 'lng': -122.4058, 'k': 10})
+        self.assertEqual([trip['tripId'] for trip in json.loads(response.content)['trips']], ['456', '999'])
+
+    def test_heatmap(self):
+        """the 9q8zn tile has trips 1/2 in it, the 9q8yv tile has trip 3"""
+        response = self.client.get('/query/heatmap/', {'tile': '9q8z', 'precision': 5, 'days_back': '0d'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Cache-Control'))
+        result = json.loads(response.content)
+        self.assertEqual(result['cells'], ['9q8zn'])
+        self.assertEqual((result['start'], result['stop'], result['fare'], result['trips']), ([2], [1], [20], [2]))
+
+        response = self.client.get('/query/heatmap/', {'lat1': 37.79, 'lng1': -122.45, 'lat2': 37.77, 'lng2': -122.435,
+            'precision': 5, 'days_back': '1d', 'format': 'bin'})
+        self.assertEqual(response.status_code, 200)
+        records = numpy.frombuffer(response.content, dtype=RECORD_DTYPE)
+        self.assertEqual(records['cell'].tolist(), ['9q8yv'])
+        self.assertEqual(records['trips'].tolist(), [1])
+
+        #no further back than the keys are kept, and within the query budget
+        response = self.client.get('/query/heatmap/', {'tile': '9q8z', 'precision': 5, 'days_back': '9999w'})
+        self.assertEqual(response.status_code, 400)
+        live = admission.BUDGET
+        admission.BUDGET = 10
+        try:
+            response = self.client.get('/query/heatmap/', {'tile': '9q8z', 'precision': 6, 'days_back': '0d'})
+        finally:
+            admission.BUDGET = live
+        self.assertEqual(response.status_code, 400)
+
+    def test_hotspots(self):
+        """9q8zn saw 3 events and 2 trips begin in it, 9q8yv 2 events and 1 begin"""
+        response = self.client.get('/query/hotspots/', {'precision': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['cells'], [{'cell': '9q8zn', 'count': 3}, {'cell': '9q8yv', 'count': 2}])
+
+        response = self.client.get('/query/hotspots/', {'precision': 5, 'metric': 'starts', 'hours_back': 3, 'k': 1})
+        self.assertEqual(json.loads(response.content)['cells'], [{'cell': '9q8zn', 'count': 2}])
+
+    def test_od_matrix(self):
+        """trip 1 went from 9q8zn to 9q8zn for $20, trip 3 from 9q8yv to 9q8yv for $40"""
+        response = self.client.get('/query/od_matrix/', {'origins': '9q8zn,9q8yv', 'destinations': '9q8zn,9q8yv'})
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(result['trips'], [[1, 0], [0, 1]])
+        self.assertEqual(result['fares'], [[20, 0], [0, 40]])
+
+        response = self.client.get('/query/od_matrix/', {'origins': '9q8yv', 'days_back': '1w'})
+        result = json.loads(response.content)
+        self.assertEqual((result['destinations'], result['trips']), (['9q8yv'], [[1]]))
+
     def tearDown(self):
         """cleanup redis so subsequent test runs will also work !!!"""
         self.redis_conn.flushall()
 
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        profiling.PROFILE_DIR = self.profile_dir
+        profiling.install()
+
+    def tearDown(self):
+        profiling._stacks.clear()
+        shutil.rmtree(self.profile_dir)
+
+    def test_signed_header(self):
+        """only requests with a valid signed header are profiled while profiling is off"""
+        def busy_view(request):
+            started = time.clock()
+            while time.clock() - started < 0.1:
+                pass
+            return 'response'
+
+        middleware = profiling.ProfilingMiddleware()
+        request = RequestFactory().get('/', HTTP_X_GEOFENCE_PROFILE='forged')
+        self.assertIsNone(middleware.process_view(request, busy_view, (), {}))
+
+        request = RequestFactory().get('/', HTTP_X_GEOFENCE_PROFILE=profiling.header_value())
+        self.assertEqual(middleware.process_view(request, busy_view, (), {}), 'response')
+        profiling.dump()
+
+        with open(os.path.join(self.profile_dir, 'busy_view-{0}.folded'.format(os.getpid()))) as f:
+            stacks = dict(line.rsplit(' ', 1) for line in f)
+        #every stack starts at the view
+        self.assertTrue(all(stack.startswith('tests.py:busy_view') for stack in stacks))
+        self.assertGreater(sum(int(samples) for samples in stacks.values()), 5)
+
+    def test_toggle(self):
+        """the toggle signal turns profiling on and off"""
+        on = profiling._state['on']
+        os.kill(os.getpid(), profiling.TOGGLE_SIGNAL)
+        self.assertEqual(profiling._state['on'], not on)
+        os.kill(os.getpid(), profiling.TOGGLE_SIGNAL)
+        self.assertEqual(profiling._state['on'], on)
 
+class CellIndexTest(TestCase):
 
+    def test_cells_with_prefix(self):
+        """only cells under the prefix and seen recently enough are returned"""
+        index = CellIndex()
+        index.load([('9q8znb7w0u2k', 100), ('9q8zzzzzzzzz', 200), ('9q9000000000', 300)])
+        index.touch('9q8b00000000', 400)
 
+        self.assertEqual(index.cells_with_prefix('9q8'), ['9q8b00000000', '9q8znb7w0u2k', '9q8zzzzzzzzz'])
+        self.assertEqual(index.cells_with_prefix('9q8', 150), ['9q8b00000000', '9q8zzzzzzzzz'])
+        #same as the geohash_prefixes sets, there is no set for the empty prefix
+        self.assertEqual(index.cells_with_prefix(''), [])
 
+    def test_feed_per_db(self):
+        """cells published for another db don't reach the index"""
+        db = int(os.environ['REDIS_DB_NUM'])
+        redis_conn = redis.StrictRedis(host='127.0.0.1', port=7878, db=db)
+        other = redis.StrictRedis(host='127.0.0.1', port=7878, db=(db + 1) % 16)
+        self.assertEqual(cellindex.feed_channel(redis_conn), 'geohash_cells:{0}'.format(db))
+
+        index = cellindex.start(redis_conn)
+        now = int(time.time())
+        #the listener subscribes in the background
+        for i in range(50):
+            other.publish(cellindex.feed_channel(other), cellindex.feed_message('9q8yy0000000', now))
+            redis_conn.publish(cellindex.feed_channel(redis_conn), cellindex.feed_message('9q8yy1111111', now))
+            if index.cells_with_prefix('9q8yy'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(index.cells_with_prefix('9q8yy'), ['9q8yy1111111'])
+
+class FenceTest(TestCase):
+
+    def setUp(self):
+        self.redis_conn = redis.StrictRedis(host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM']))
+        self.client = Client()
+
+    def test_fence_index(self):
+        """a point only matches the fences it is inside of"""
+        index = FenceIndex()
+        index.add('north_beach', (37.7952, -122.409196, 37.808374, -122.4028))
+        index.add('sf', (37.70, -122.52, 37.82, -122.35))
+
+        #coit tower
+        self.assertEqual(index.containing(37.8025, -122.4058, '9q8zn9dzd0u0'), set(['north_beach', 'sf']))
+        #ucsf mt zion
+        self.assertEqual(index.containing(37.785057, -122.437992, '9q8yvye3uj0h'), set(['sf']))
+
+        index.remove('sf')
+        self.assertEqual(index.containing(37.785057, -122.437992, '9q8yvye3uj0h'), set())
+
+        index.load({'sf': (37.70, -122.52, 37.82, -122.35)})
+        self.assertEqual(index.containing(37.8025, -122.4058, '9q8zn9dzd0u0'), set(['sf']))
+
+    def test_enter_exit(self):
+        """a trip going in and out of a fence publishes an enter and an exit"""
+        pubsub = self.redis_conn.pubsub()
+        pubsub.subscribe('fence_events:north_beach')
+
+        response = self.client.post('/fences/', json.dumps({"name": "north_beach",
+            "lat1": 37.808374, "lng1": -122.409196, "lat2": 37.7952, "lng2": -122.4028}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        #starts at coit tower, goes to cpmc
+        self.client.post('/trips/', json.dumps({"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":123}), content_type='application/json')
+        self.client.post('/trips/', json.dumps({"event":"update", "lat":37.790789, "lng":-122.431812, "tripId":123}), content_type='application/json')
+
+        subscribed, entered, exited = islice(pubsub.listen(), 3)
+        self.assertEqual(json.loads(entered['data'])['transition'], 'enter')
+        self.assertEqual(json.loads(exited['data'])['transition'], 'exit')
+
+        response = self.client.delete('/fences/north_beach/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_deleted_fence(self):
+        """a fence deleted while a trip is inside it publishes no exit"""
+        from geofencing.dispatch import fences
+
+        pubsub = self.redis_conn.pubsub()
+        pubsub.subscribe('fence_events:north_beach')
+        index = FenceIndex()
+        index.add('north_beach', (37.7952, -122.409196, 37.808374, -122.4028))
+
+        begin = {"event": "begin", "lat": 37.8025, "lng": -122.4058, "tripId": 123}
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            fences.match_events(self.redis_conn, pipe, index, [(begin, '9q8zn9dzd0u0')], 100)
+            pipe.execute()
+        index.remove('north_beach')
+        update = {"event": "update", "lat": 37.790789, "lng": -122.431812, "tripId": 123}
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            fences.match_events(self.redis_conn, pipe, index, [(update, '9q8yvu')], 101)
+            pipe.execute()
+        self.redis_conn.publish('fence_events:north_beach', 'done')
+
+        subscribed, entered, done = islice(pubsub.listen(), 3)
+        self.assertEqual(json.loads(entered['data'])['transition'], 'enter')
+        self.assertEqual(done['data'], 'done')
+        self.assertEqual(self.redis_conn.smembers('trip_fences:123'), set())
+
+    def tearDown(self):
+        self.redis_conn.flushall()
+
+class IngestServerTest(TestCase):
+
+    def setUp(self):
+        #next to manage.py
+        import ingest_server
+
+        #counting the round trips (see metrics.py)
+        self.redis_conn = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+                               connection_class=metrics.CountingConnection,
+                               host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM'])))
+        self.app = ingest_server.Ingest(storage.RedisStorage(self.redis_conn, cell_index=False))
+
+    def _call(self, body, method='POST', path='/trips/', content_type='application/json'):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'CONTENT_TYPE': content_type,
+                   'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO(body)}
+        responses = []
+        body = ''.join(self.app(environ, lambda status, headers: responses.append(status)))
+        return int(responses[0].split()[0]), body
+
+    def test_statuses(self):
+        """the ingest server answers as the trips() view"""
+        self.assertEqual(self._call(json.dumps({"event": "begin", "lat": 37.8025, "lng": -122.4058, "tripId": 123}))[0], 200)
+        self.assertEqual(self._call(json.dumps({"event": "end", "lat": 37.8025, "lng": -122.4058, "tripId": 123}))[0], 400)
+        #json takes these, nothing is written
+        for fare in ('NaN', 'Infinity', '"twenty"'):
+            body = '{"event": "end", "lat": 37.8025, "lng": -122.4058, "tripId": 123, "fare": %s}' % fare
+            self.assertEqual(self._call(body)[0], 400)
+        self.assertEqual(self.redis_conn.keys('geohash:*:tot_stop_counter'), [])
+        self.assertEqual(self._call('', method='GET')[0], 405)
+        self.assertEqual(self._call('not json')[0], 500)
+        self.assertEqual(self._call('', path='/query/')[0], 404)
+        self.assertEqual(self.redis_conn.get('current_trips_counter'), '1')
+
+    def test_batch(self):
+        """a json array is written in a few round trips, with the redis-only features"""
+        events = [{"event": "begin", "lat": 37.8025, "lng": -122.4058, "tripId": 1},
+                  {"event": "begin", "lat": 37.80164, "lng": -122.402244, "tripId": 2},
+                  {"event": "update", "lat": 37.790789, "lng": -122.431812, "tripId": 1},
+                  {"event": "end", "lat": 37.785057, "lng": -122.437992, "tripId": 1, "fare": 40}]
+        self.assertEqual(self._call(json.dumps(events))[0], 200)
+
+        now = datetime.utcnow()
+        day = 'days:{0}-{1}-{2}'.format(now.year, now.month, now.day)
+        self.assertEqual(self.redis_conn.get('current_trips_counter'), '1')
+        self.assertEqual(self.redis_conn.zcard('active_cell:9q8zn9'), 1)
+        self.assertEqual(self.redis_conn.hget('od:{0}:9q8zn'.format(day), '9q8yv'), '1')
+        self.assertEqual(self.redis_conn.hvals('geohash:9q8yvye3uj0h:{0}:fare_histogram'.format(day)), ['1'])
+        self.assertEqual(self.redis_conn.hget('heatmap:5:{0}'.format(day), '9q8zn:s'), '2')
+
+        #as many round trips for 10 times the events
+        roundtrips = []
+        for n in (1, 10):
+            metrics._request.roundtrips = 0
+            self._call(json.dumps([dict(event, tripId=event['tripId'] + 10 * i) for i in range(n) for event in events]))
+            roundtrips.append(metrics._request.roundtrips)
+        self.assertEqual(roundtrips[0], roundtrips[1])
+
+    def _core_keys(self):
+        """the core schema keys, with their values"""
+        dump = {}
+        for key in self.redis_conn.keys('geohash*'):
+            if self.redis_conn.type(key) == 'zset':
+                dump[key] = self.redis_conn.zrange(key, 0, -1)
+            elif self.redis_conn.type(key) == 'string':
+                dump[key] = float(self.redis_conn.get(key))
+        dump['current_trips_counter'] = self.redis_conn.get('current_trips_counter')
+        return dump
+
+    def test_packed(self):
+        """packed events write what their json does, bad coordinates are turned down"""
+        events = [{"event": "begin", "lat": 37.8025, "lng": -122.4058, "tripId": 1},
+                  {"event": "begin", "lat": 37.8025, "lng": -122.4058, "tripId": 2},
+                  {"event": "update", "lat": 37.790789, "lng": -122.431812, "tripId": 1},
+                  {"event": "end", "lat": 37.790789, "lng": -122.431812, "tripId": 1, "fare": 40},
+                  {"event": "end", "lat": 37.790789, "lng": -122.431812, "tripId": 2, "fare": 12.5}]
+        self.assertEqual(self._call(json.dumps(events))[0], 200)
+        expected = self._core_keys()
+        self.redis_conn.flushdb()
+
+        self.assertEqual(self._call(wire.pack(events), content_type=wire.CONTENT_TYPE)[0], 200)
+        self.assertEqual(self._core_keys(), expected)
+
+        for lat, lng in ((float('nan'), -122.4058), (37.8025, float('inf')), (95.0, -122.4058), (37.8025, -190.0)):
+            body = wire.pack([{"event": "begin", "lat": lat, "lng": lng, "tripId": 3}])
+            status, message = self._call(body, content_type=wire.CONTENT_TYPE)
+            self.assertEqual(status, 400)
+            self.assertIn('lat/lng', message)
+
+    def test_heatmap_updates(self):
+        """updates only add to the heatmap when the trip moves into a new coarse cell"""
+        self._call(json.dumps({"event": "begin", "lat": 37.8025, "lng": -122.4058, "tripId": 7}))
+        commands = []
+        #coit tower again, then cpmc
+        for lat, lng in ((37.8026, -122.4059), (37.790789, -122.431812)):
+            metrics._request.commands = 0
+            self._call(json.dumps({"event": "update", "lat": lat, "lng": lng, "tripId": 7}))
+            commands.append(metrics._request.commands)
+        self.assertEqual(commands[0], commands[1])
+
+        now = datetime.utcnow()
+        day = 'days:{0}-{1}-{2}'.format(now.year, now.month, now.day)
+        self.assertEqual(self.redis_conn.execute_command('PFCOUNT', 'heatmap:5:{0}:9q8yv'.format(day)), 1)
+        self.assertEqual(self.redis_conn.execute_command('PFCOUNT', 'heatmap:5:{0}:9q8zn'.format(day)), 1)
+        self.assertTrue(0 < self.redis_conn.ttl('heatmap:5:{0}:9q8yv'.format(day)) <= heatmaps.EXPIRY)
+        self.assertEqual(self.redis_conn.hgetall('heatmap:5:{0}'.format(day)), {'9q8zn:s': '1'})
+
+    def tearDown(self):
+        self.redis_conn.flushall()
+
+class PolygonTest(TestCase):
+
+    def test_contains_with_hole(self):
+        """points in the hole of a polygon are not inside it"""
+        polygon = parse_geojson(json.dumps({"type": "Polygon", "coordinates": [
+            [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+            [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]],
+            ]}))
+        self.assertEqual(list(polygon.contains([1, 5, 5, 11], [1, 5, 9, 5])), [True, False, True, False])
+
+    def test_cover(self):
+        """no cell of the cover is both interior and boundary"""
+        polygon = parse_geojson(json.dumps({"type": "Polygon", "coordinates": [
+            [[-122.44, 37.78], [-122.40, 37.78], [-122.42, 37.81], [-122.44, 37.78]],
+            ]}))
+        interior, boundary = polygon.cover()
+        self.assertTrue(interior)
+        self.assertTrue(boundary)
+        self.assertFalse(set(interior) & set(boundary))
+
+class JournalTest(TestCase):
+
+    def setUp(self):
+        self.redis_conn = redis.StrictRedis(host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM']))
+        self.client = Client()
+        self.journal_dir = tempfile.mkdtemp()
+        journal.JOURNAL_DIR = self.journal_dir
+
+    def test_journal(self):
+        """accepted events are journaled and read back as records"""
+        self.client.post('/trips/', json.dumps({"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":123}), content_type='application/json')
+        self.client.post('/trips/', json.dumps({"event":"end", "lat":37.790789, "lng":-122.431812, "tripId":123, "fare":20}), content_type='application/json')
+        #not accepted, so not journaled either
+        self.client.post('/trips/', json.dumps({"event":"end", "lat":37.790789, "lng":-122.431812, "tripId":456}), content_type='application/json')
+        journal.flush()
+
+        records = numpy.concatenate([journal.read_segment(path) for path in journal.segments(self.journal_dir)])
+        self.assertEqual(list(records['trip']), ['123', '123'])
+        self.assertEqual(list(records['event']), [journal.EVENTS.index('begin'), journal.EVENTS.index('end')])
+        self.assertEqual(list(records['fare']), [0, 20])
+        self.assertAlmostEqual(records['lat'][1], 37.790789)
+
+    def _dump(self):
+        """the keys replay_journal rebuilds, with their values"""
+        dump = {}
+        for pattern in ('geohash:*', 'geohash_prefixes:*', 'heatmap:*', 'trips_counter:*', 'event_times:*'):
+            for key in self.redis_conn.keys(pattern):
+                key_type = self.redis_conn.type(key)
+                if key_type == 'zset':
+                    dump[key] = self.redis_conn.zrange(key, 0, -1, withscores=True)
+                elif key_type == 'hash' and key.startswith('heatmap:'):
+                    dump[key] = dict((field, float(value)) for field, value in self.redis_conn.hgetall(key).iteritems())
+                elif key_type == 'hash':
+                    dump[key] = self.redis_conn.hgetall(key)
+                elif key.startswith('heatmap:'):
+                    #the trips HyperLogLogs
+                    dump[key] = self.redis_conn.execute_command('PFCOUNT', key)
+                else:
+                    dump[key] = float(self.redis_conn.get(key))
+        return dump
+
+    def test_replay(self):
+        """replaying the journal into an empty redis rebuilds the same keys"""
+        self.client.post('/trips/', json.dumps({"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":123}), content_type='application/json')
+        self.client.post('/trips/', json.dumps({"event":"begin", "lat":37.801654, "lng":-122.402248, "tripId":456}), content_type='application/json')
+        self.client.post('/trips/', json.dumps({"event":"update", "lat":37.795, "lng":-122.41, "tripId":123}), content_type='application/json')
+        self.client.post('/trips/', json.dumps({"event":"end", "lat":37.790789, "lng":-122.431812, "tripId":123, "fare":20}), content_type='application/json')
+        journal.flush()
+        expected = self._dump()
+
+        self.redis_conn.flushall()
+        call_command('replay_journal', journal_dir=self.journal_dir, processes=1, fresh=True, stdout=StringIO())
+        self.assertEqual(self._dump(), expected)
+
+    def _segment(self, records):
+        """Writes (time, trip, event) <records> into the segment of the first one's hour"""
+        segment = numpy.zeros(len(records), dtype=journal.RECORD_DTYPE)
+        for i, (seconds, trip, event) in enumerate(records):
+            segment[i] = (seconds, trip, 37.8025, -122.4058, journal.EVENTS.index(event), 0)
+        hour = datetime.utcfromtimestamp(records[0][0]).strftime(journal.SEGMENT_HOUR_FORMAT)
+        segment.tofile(os.path.join(self.journal_dir, 'events-{0}-1.bin'.format(hour)))
+
+    def test_replay_partitions(self):
+        """partitions are whole weeks of a year, trips under way before --start are counted"""
+        #week 52 of two years
+        self._segment([(calendar.timegm((2013, 12, 31, 10, 0, 0)), '1', 'begin')])
+        self._segment([(calendar.timegm((2014, 12, 30, 10, 0, 0)), '2', 'begin')])
+        out = StringIO()
+        call_command('replay_journal', journal_dir=self.journal_dir, processes=1, fresh=True, stdout=out)
+        self.assertIn('2 partitions to replay', out.getvalue())
+        with open(os.path.join(self.journal_dir, 'replay.checkpoint')) as f:
+            self.assertEqual(json.load(f)['done'], ['2013-52', '2014-52'])
+        shutil.rmtree(self.journal_dir)
+        os.mkdir(self.journal_dir)
+        self.redis_conn.flushall()
+
+        #the sunday a week ago (so the week is over, and within the keys' expiry)
+        today = int(time.time()) // (24*60*60) * (24*60*60)
+        sunday = today - (int(datetime.utcfromtimestamp(today).strftime('%w')) + 7) * 24*60*60
+        self._segment([(sunday - 24*60*60 + 10*60*60, 'under way', 'begin')])
+        self._segment([(sunday + 24*60*60 + 10*60*60, 'monday', 'begin')])
+        wednesday = sunday + 3*24*60*60 + 10*60*60
+        self._segment([(wednesday, 'wednesday', 'begin')])
+
+        out = StringIO()
+        call_command('replay_journal', journal_dir=self.journal_dir, processes=1, fresh=True, stdout=out,
+                     start=datetime.utcfromtimestamp(wednesday).strftime('%Y-%m-%d 00'))
+        self.assertIn('replaying whole weeks', out.getvalue())
+        week = datetime.utcfromtimestamp(sunday).strftime('%U')
+        self.assertEqual(self.redis_conn.get('geohash:9q8zn9dzd0u0:weeks:{0}:tot_start_counter'.format(week)), '2')
+        self.assertEqual(self.redis_conn.get('trips_counter:{0}'.format(wednesday)), '3')
+        #the week before was not replayed
+        self.assertEqual(len(self.redis_conn.keys('geohash:*:tot_start_counter')), 3)
+
+    def tearDown(self):
+        journal.JOURNAL_DIR = None
+        if journal._journal is not None:
+            journal._journal.close()
+        journal._journal = None
+        shutil.rmtree(self.journal_dir)
+        self.redis_conn.flushall()
+
+class LoadEventsTest(TestCase):
+
+    def setUp(self):
+        self.redis_conn = redis.StrictRedis(host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM']))
+
+    def test_load_csv(self):
+        """events are counted in the buckets of their own time"""
+        f = tempfile.NamedTemporaryFile(suffix='.csv')
+        f.write('time,event,tripId,lat,lng,fare\n'
+                '2013-09-01 00:00:04,begin,123,37.8025,-122.4058,\n'
+                '2013-09-01 00:17:41,end,123,37.790789,-122.431812,20\n'
+                #no fare, skipped
+                '2013-09-01 00:19:00,end,456,37.790789,-122.431812,\n'
+                '1378000000,begin,456,37.8025,-122.4058,\n')
+        f.flush()
+        call_command('load_events', f.name, stdout=StringIO())
+
+        #coit tower, cpmc
+        self.assertEqual(self.redis_conn.get('geohash:9q8zn9dzd0u0:days:2013-9-1:tot_start_counter'), '2')
+        self.assertEqual(self.redis_conn.zrange('geohash:9q8zn9dzd0u0:weeks:35:tripids', 0, -1), ['123', '456'])
+        self.assertEqual(float(self.redis_conn.get('geohash:9q8yvzxgk18j:days:2013-9-1:tot_fare_counter')), 20)
+        self.assertEqual(self.redis_conn.zrange('geohash_prefixes:9q8y', 0, -1), ['9q8yvzxgk18j'])
+        self.assertEqual(self.redis_conn.get('current_trips_counter'), '1')
+
+    def test_load_bad_rows(self):
+        """rows that don't convert are skipped and counted, not the end of the load"""
+        f = tempfile.NamedTemporaryFile(suffix='.csv')
+        f.write('time,event,tripId,lat,lng,fare\n'
+                '2013-09-01 00:00:04,begin,123,37.8025,-122.4058,\n'
+                '2013-09-01 00:00:05,begin,456,37.8025,-122.4058,\n'
+                'yesterday,begin,789,37.8025,-122.4058,\n'
+                '2013-09-01 00:17:41,end,123,north,-122.431812,20\n'
+                '2013-09-01 00:17:42,end,456,37.790789,-122.431812,NaN\n'
+                '2013-09-01 00:17:43,end,123,37.790789,-122.431812,20\n')
+        f.flush()
+        out = StringIO()
+        call_command('load_events', f.name, chunk=2, stdout=out)
+
+        self.assertIn('3 events loaded, 3 skipped', out.getvalue())
+        self.assertEqual(self.redis_conn.get('geohash:9q8zn9dzd0u0:days:2013-9-1:tot_start_counter'), '2')
+        self.assertEqual(self.redis_conn.get('geohash:9q8yvzxgk18j:days:2013-9-1:tot_stop_counter'), '1')
+
+    def test_load_coarse(self):
+        """loaded events are in the rollups the coarse answers come from"""
+        now = int(time.time())
+        f = tempfile.NamedTemporaryFile(suffix='.csv')
+        f.write('time,event,tripId,lat,lng,fare\n'
+                '{0},begin,123,37.7694,-122.4862,\n'
+                '{0},end,123,37.7700,-122.4850,20\n'.format(now))
+        f.flush()
+        call_command('load_events', f.name, stdout=StringIO())
+
+        #golden gate park, one 9q8y cell coarse
+        box = {'lat1': 37.772, 'lng1': -122.488, 'lat2': 37.767, 'lng2': -122.483, 'days_back': '1d'}
+        live = admission.BUDGET
+        try:
+            admission.BUDGET = 1
+            response = Client().post('/query/trips_start_stop/', box)
+        finally:
+            admission.BUDGET = live
+        self.assertTrue(response.context['approximate'])
+        self.assertEqual(response.context['start_count'], 1)
+        self.assertEqual(response.context['stop_count'], 1)
+        self.assertEqual(response.context['fare_count'], 20)
+
+    def test_load_live_index(self):
+        """a running worker's cell index sees the loaded cells"""
+        from geofencing.dispatch import views
+
+        cell_index = views.store._get_cell_index()
+        if cell_index is None:
+            self.skipTest('GEOFENCE_CELL_INDEX is off')
+
+        now = int(time.time())
+        f = tempfile.NamedTemporaryFile(suffix='.csv')
+        f.write('time,event,tripId,lat,lng,fare\n'
+                '{0},begin,9001,37.7601,-122.4701,\n'.format(now))
+        f.flush()
+        call_command('load_events', f.name, stdout=StringIO())
+
+        #the feed is followed in the background
+        for i in range(50):
+            if '9q8yv45bxbfd' in cell_index.cells_with_prefix('9q8yv4'):
+                break
+            time.sleep(0.05)
+
+        #inner sunset, where no other test goes
+        response = Client().post('/query/trips_start_stop/', {'lat1': 37.762, 'lng1': -122.472,
+            'lat2': 37.758, 'lng2': -122.468, 'days_back': '1d'})
+        self.assertEqual(response.context['start_count'], 1)
+
+    def tearDown(self):
+        self.redis_conn.flushall()
+
+class StorageTests(object):
+    """What every storage must do, see storage.py"""
+
+    def test_counters(self):
+        self.store.incr('counter')
+        self.store.incr('counter')
+        self.store.incrbyfloat('fare', 20)
+        self.store.incrbyfloat('fare', 0.5)
+        self.assertEqual(self.store.get_many(['counter', 'fare', 'missing']), ['2', '20.5', None])
+
+    def test_sorted_sets(self):
+        self.store.zadd('tripids', 0, 123)
+        self.store.zadd('tripids', 0, 123)
+        self.store.zadd('tripids', 0, 456)
+        self.assertEqual(self.store.zcard_many(['tripids', 'missing']), [2, 0])
+
+    def test_prefix_index(self):
+        self.store.index_cell('9q8zn9dzd0u0', 100)
+        self.store.index_cell('9q8yvzxgk18j', 200)
+        cells = self.store.cells_under(['9q8', '9q8zn', '9q8zn9dzd0u0'], 0)
+        self.assertEqual([sorted(c) for c in cells], [['9q8yvzxgk18j', '9q8zn9dzd0u0'], ['9q8zn9dzd0u0'], []])
+
+    def test_time_series(self):
+        noon = calendar.timegm(datetime.utcnow().replace(hour=12, minute=0, second=0).timetuple())
+        self.store.update_trips(1, noon)
+        self.store.update_trips(1, noon + 10)
+        self.store.update_trips(-1, noon + 20)
+
+        self.assertEqual(self.store.current_trips(), '1')
+        self.assertEqual(self.store.trips_at(noon), '1')
+        self.assertEqual(self.store.trips_at(noon + 15), '2')
+        #nothing that day
+        self.assertEqual(self.store.trips_at(noon - 7*24*60*60), None)
+
+class RedisStorageTest(StorageTests, TestCase):
+
+    def setUp(self):
+        self.redis_conn = redis.StrictRedis(host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM']))
+        self.store = storage.RedisStorage(self.redis_conn)
+
+    def tearDown(self):
+        self.redis_conn.flushall()
+
+class StripedTripsCounterTest(TestCase):
+
+    def setUp(self):
+        self.redis_conn = redis.StrictRedis(host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM']))
+        self.store = storage.RedisStorage(self.redis_conn, stripes=4)
+
+    def tearDown(self):
+        #no snapshot into the next test's db
+        if self.store._snapshotter is not None:
+            self.store._snapshotter.updated = False
+        self.redis_conn.flushall()
+
+    def test_striped_counts(self):
+        noon = calendar.timegm(datetime.utcnow().replace(hour=12, minute=0, second=0).timetuple())
+        self.redis_conn.set('current_trips_counter', 10)
+        for trip_id in range(20):
+            self.store.update_trips(1, noon, trip_id)
+        with self.store.batch() as writer:
+            for trip_id in range(5):
+                writer.update_trips(-1, noon, trip_id)
+
+        #no single key written to, and the stripes add up
+        self.assertEqual(self.redis_conn.get('current_trips_counter'), '10')
+        self.assertTrue(len(self.redis_conn.keys('current_trips_counter:*')) > 1)
+        self.assertEqual(self.store.current_trips(), '25')
+
+        #the snapshots keep the point in time counts
+        self.assertEqual(self.store.snapshot_trips(noon), 25)
+        self.assertEqual(self.store.trips_at(noon + 5), '25')
+
+        self.assertEqual(storage.fold_trips_stripes(self.redis_conn, 4), 25)
+        self.assertEqual(self.redis_conn.keys('current_trips_counter:*'), [])
+        self.assertEqual(storage.RedisStorage(self.redis_conn, stripes=0).current_trips(), '25')
+
+class MemoryStorageTest(StorageTests, TestCase):
+
+    def setUp(self):
+        self.store = storage.MemoryStorage()
+
+class MemoryStorageGeoFenceTest(GeoFenceTest):
+    """The view tests again, with the core schema in the process"""
+
+    def setUp(self):
+        #not imported at the top, it has to see REDIS_DB_NUM
+        from geofencing.dispatch import views
+
+        self.views = views
+        self.redis_store = views.store
+        views.store = storage.MemoryStorage(self.redis_store.redis_conn)
+        super(MemoryStorageGeoFenceTest, self).setUp()
+
+    @skip('snapshots are exported from redis')
+    def test_snapshot(self):
+        pass
+
+    @skip('the core schema is not in redis')
+    def test_slow_trace(self):
+        pass
+
+    def test_without_redis(self):
+        """with no redis at all, the core queries work and the rest are turned off"""
+        self.views.store = storage.MemoryStorage()
+        response = self.client.post('/trips/', json.dumps({"event":"begin", "lat":37.8025, "lng":-122.4058, "tripId":1}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/query/trip_count_right_now/')
+        self.assertEqual(response.context['count'], '1')
+        response = self.client.get('/query/hotspots/', {'precision': 6})
+        self.assertEqual(response.status_code, 501)
+
+    def tearDown(self):
+        self.views.store = self.redis_store
+        super(MemoryStorageGeoFenceTest, self).tearDown()
+
+class CompactLayoutGeoFenceTest(GeoFenceTest):
+    """The view tests again, with the counters in the compact layout"""
+
+    def setUp(self):
+        from geofencing.dispatch import views
+
+        self.views = views
+        self.classic_store = views.store
+        views.store = storage.RedisStorage(self.classic_store.redis_conn, layout='compact')
+        super(CompactLayoutGeoFenceTest, self).setUp()
+
+    def test_compact_keys(self):
+        """the counters are hash fields, the tripids sets are left alone"""
+        now = datetime.utcnow()
+        day_key = 'cells:days:{0}-{1}-{2}:9q8zn9dz'.format(now.year, now.month, now.day)
+        self.assertEqual(self.redis_conn.hget(day_key, 'd0u0:s'), '1')
+        self.assertFalse(self.redis_conn.keys('geohash:*:tot_start_counter'))
+        self.assertTrue(self.redis_conn.keys('geohash:*:tripids'))
+
+    def test_migrate(self):
+        """the counters move over to the other layout and back, unchanged"""
+        from geofencing.dispatch import compact
+
+        counters = sorted(self.redis_conn.keys('cells:*'))
+        values = [self.redis_conn.hgetall(key) for key in counters]
+
+        layout = compact.LAYOUT
+        try:
+            compact.LAYOUT = 'classic'
+            call_command('migrate_layout', to='classic', stdout=StringIO())
+            self.assertFalse(self.redis_conn.keys('cells:*'))
+            self.assertEqual(self.redis_conn.get('geohash:9q8yvye3uj0h:days:{0}:tot_fare_counter'.format(
+                '{0.year}-{0.month}-{0.day}'.format(datetime.utcnow()))), '40')
+
+            compact.LAYOUT = 'compact'
+            call_command('migrate_layout', to='compact', stdout=StringIO())
+        finally:
+            compact.LAYOUT = layout
+
+        self.assertFalse(self.redis_conn.keys('geohash:*:tot_*'))
+        self.assertEqual([self.redis_conn.hgetall(key) for key in sorted(self.redis_conn.keys('cells:*'))], values)
+
+    def tearDown(self):
+        self.views.store = self.classic_store
+        super(CompactLayoutGeoFenceTest, self).tearDown()
+
+class BenchmarkTest(TestCase):
+
+    def test_benchmark(self):
+        """a tiny run, on the in process storage, gives a result per combination"""
+        from geofencing.dispatch import fleet
+
+        self.assertEqual(list(islice(fleet.events(10, seed=1), 50)), list(islice(fleet.events(10, seed=1), 50)))
+
+        output = tempfile.NamedTemporaryFile(suffix='.json')
+        call_command('benchmark', storage='memory', events='50', boxes='1000', days_back='0d,1w',
+                     concurrency='2', requests=4, output=output.name, stdout=StringIO())
+
+        results = json.load(open(output.name))
+        self.assertEqual([run['benchmark'] for run in results['runs']],
+                         ['trips'] + ['trips_passed_through', 'trips_start_stop'] * 2 + ['time_t_trip_count'])
+        self.assertEqual(results['runs'][0]['requests'], 50)
+        self.assertFalse(any(run['errors'] for run in results['runs']))
+
+class FleetTest(TestCase):
+
+    def setUp(self):
+        self.redis_conn = redis.StrictRedis(host='127.0.0.1',
+                               port=7878,
+                               db=int(os.environ['REDIS_DB_NUM']))
+
+    def test_trajectories(self):
+        """updates of a trip move a few meters at a time"""
+        from geofencing.dispatch import fleet
+
+        vehicles = fleet.Fleet(50, seed=3, start=1378000000)
+        last = {}
+        for i in range(600):
+            for event in vehicles.tick():
+                if event['event'] and event['trip'] in last:
+                    lat, lng = last[event['trip']]
+                    self.assertLess(abs(event['lat'] - lat) + abs(event['lng'] - lng), 0.001)
+                last[event['trip']] = (event['lat'], event['lng'])
+        self.assertTrue(vehicles.driving.any())
+
+    def test_bulk_load(self):
+        """a generated file loads, with the trips still under way counted"""
+        from geofencing.dispatch import fleet
+
+        f = tempfile.NamedTemporaryFile(suffix='.csv')
+        call_command('generate_fleet', f.name, vehicles=20, seed=3, start='2013-09-01 00', hours=0.25, stdout=StringIO())
+        call_command('load_events', f.name, stdout=StringIO())
+
+        vehicles = fleet.Fleet(20, seed=3, start=1377993600)
+        for i in range(15*60):
+            vehicles.tick()
+        self.assertEqual(self.redis_conn.get('current_trips_counter'), str(vehicles.driving.sum()))
+
+    def tearDown(self):
+        self.redis_conn.flushall()
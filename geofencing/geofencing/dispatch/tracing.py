@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+from datetime import datetime
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from geofencing.dispatch import metrics
+
+__doc__ = """
+        Sampling slow request tracer: records every redis command a request
+        sends, and writes the requests slower than SLOW_MS to the
+        'geofencing.slow' logger (a rotating var/log/slow.log, see LOGGING in
+        settings.py), one JSON object per line:
+
+            {"at": "2013-09-01 10:00:02", "endpoint": "trips_start_stop",
+             "path": "/query/trips_start_stop/", "params": {"lat1": .., "days_back": "12w"},
+             "status": 200, "ms": 3012.4, "redis_ms": 2890.1, "roundtrips": 3,
+             "commands": 14406, "notes": {"cells": 1200, "buckets": 12},
+             "by_pattern": {"HMGET cells:weeks:*:*": [9600, 2410.2], ..},
+             "timeline": [[0.4, 1.2, "SMEMBERS", "geohash_prefixes:*"], ..]}
+
+        so a slow query shows whether it was the size of the cover (notes),
+        the number of commands it took (by_pattern) or redis being slow to
+        answer them (timeline). Each timeline entry is [ms into the request,
+        ms, command, key pattern]: the key with everything but the schema's
+        own words replaced by '*'. The time of a pipelined command is the
+        time since the previous reply on its connection, so the commands of
+        a round trip add up to the whole round trip.
+
+        A request is traced with probability SAMPLE_RATE
+        (GEOFENCE_TRACE_SAMPLE_RATE, 0 by default, which turns the tracer
+        off). When it is off the views' redis connections are plain
+        metrics.CountingConnection ones, so there is nothing to pay for it.
+"""
+
+SAMPLE_RATE = getattr(settings, 'GEOFENCE_TRACE_SAMPLE_RATE', 0.0)
+
+SLOW_MS = getattr(settings, 'GEOFENCE_TRACE_SLOW_MS', 500)
+
+ENABLED = SAMPLE_RATE > 0
+
+#commands kept in the timeline of a request (the by_pattern totals count them all)
+MAX_TIMELINE = 2000
+
+#the key segments that are part of the schema, not data (see the README)
+KEY_WORDS = frozenset(['days', 'weeks', 'tripids', 'tot_start_counter', 'tot_stop_counter', 'tot_fare_counter',
+                       'fare_histogram', 'merged', 'starts', 'events'])
+
+#commands whose first argument is not a key
+_NO_KEY = frozenset(['MULTI', 'EXEC', 'DISCARD', 'UNWATCH', 'PING', 'INFO', 'DBSIZE', 'SCRIPT', 'SCAN', 'SELECT'])
+
+logger = logging.getLogger('geofencing.slow')
+
+#the trace of the current request, per thread (greenlet, under gunicorn's gevent workers)
+_trace = threading.local()
+
+def key_pattern(key):
+    """<key> with its data segments replaced by '*'"""
+
+    segments = key.split(':')
+    return ':'.join([segments[0]] + [segment if segment in KEY_WORDS else '*' for segment in segments[1:]])
+
+def _command(args):
+    """(command name, key pattern) of a packed command"""
+
+    name = str(args[0]).upper()
+    if name in _NO_KEY or len(args) < 2:
+        return name, ''
+    if name in ('EVAL', 'EVALSHA'):
+        #script, numkeys, keys..
+        return name, key_pattern(str(args[3])) if len(args) > 3 and str(args[2]) != '0' else ''
+    return name, key_pattern(str(args[1]))
+
+def note(**values):
+    """Adds <values> (cells=.., buckets=..) to the trace of the current request"""
+
+    if ENABLED and getattr(_trace, 'started', None) is not None:
+        _trace.notes.update(values)
+
+class TracingConnection(metrics.CountingConnection):
+    """A redis connection recording the commands of traced requests"""
+
+    def pack_command(self, *args):
+        if getattr(_trace, 'started', None) is not None:
+            self.__dict__.setdefault('_packed', []).append(_command(args))
+        return super(TracingConnection, self).pack_command(*args)
+
+    def send_packed_command(self, command):
+        #the replies come back in the order the commands went out
+        self._in_flight = self.__dict__.pop('_packed', None)
+        if self._in_flight and getattr(_trace, 'started', None) is not None:
+            self._mark = time.time()
+            _trace.roundtrips += 1
+        return super(TracingConnection, self).send_packed_command(command)
+
+    def read_response(self):
+        response = super(TracingConnection, self).read_response()
+        in_flight = self.__dict__.get('_in_flight')
+        if in_flight and getattr(_trace, 'started', None) is not None:
+            now = time.time()
+            name, pattern = in_flight.pop(0)
+            _record(self._mark, now, name, pattern)
+            self._mark = now
+        return response
+
+def _record(sent, replied, name, pattern):
+    seconds = replied - sent
+    _trace.redis_seconds += seconds
+    totals = _trace.by_pattern.setdefault(name + (' ' + pattern if pattern else ''), [0, 0.0])
+    totals[0] += 1
+    totals[1] += seconds * 1000
+    if len(_trace.timeline) < MAX_TIMELINE:
+        _trace.timeline.append([round((sent - _trace.started) * 1000, 2), round(seconds * 1000, 3), name, pattern])
+
+class TraceMiddleware(object):
+    """Traces a sample of the requests, and logs the slow ones"""
+
+    def process_request(self, request):
+        _trace.started = None
+        if ENABLED and random.random() < SAMPLE_RATE:
+            _trace.started = time.time()
+            _trace.endpoint = None
+            _trace.notes = {}
+            _trace.by_pattern = {}
+            _trace.timeline = []
+            _trace.redis_seconds = 0.0
+            _trace.roundtrips = 0
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(_trace, 'started', None) is not None:
+            _trace.endpoint = getattr(view_func, '__name__', None)
+
+    def process_response(self, request, response):
+        started = getattr(_trace, 'started', None)
+        if started is None:
+            return response
+        _trace.started = None
+
+        ms = (time.time() - started) * 1000
+        if ms >= SLOW_MS:
+            logger.info(json.dumps({
+                'at': datetime.utcfromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S'),
+                'endpoint': _trace.endpoint,
+                'method': request.method,
+                'path': request.path,
+                #the form and query string fields (not the /trips/ json body)
+                'params': dict(request.POST.items() + request.GET.items()),
+                'status': response.status_code,
+                'ms': round(ms, 2),
+                'redis_ms': round(_trace.redis_seconds * 1000, 2),
+                'roundtrips': _trace.roundtrips,
+                'commands': sum(count for count, total in _trace.by_pattern.itervalues()),
+                'notes': _trace.notes,
+                'by_pattern': dict((pattern, [count, round(total, 2)]) for pattern, (count, total) in _trace.by_pattern.iteritems()),
+                'timeline': _trace.timeline,
+            }, sort_keys=True))
+        return response
@@ -2,19 +2,22 @@
 #! -*- coding: utf-8 -*-
 
 import calendar
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
 import json
 import traceback
 
-from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseNotFound
 from django.shortcuts import render_to_response
+from django.utils.cache import patch_response_headers
 from django.utils.timezone import utc
 import geohash
 import redis
 import requests
 
+from geofencing.dispatch import active, admission, buckets, fares, fences as geofences, geo, heatmap as heatmaps, ingest, leaderboard, metrics, od, polygons, storage, tracing
+
 __doc__ = """
         This is the view code that gets executed when users visit the url on the website.
 """
@@ -28,9 +31,41 @@ try:
 except:
     redis_db_num = 0
 
-redis_conn = redis.StrictRedis(host='127.0.0.1',
+#the connections count the commands of each request (see metrics.py), and
+#record them for the slow request tracer when it is on (see tracing.py)
+redis_conn = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+                               connection_class=tracing.TracingConnection if tracing.ENABLED else metrics.CountingConnection,
+                               host='127.0.0.1',
                                port=7878,
-                               db=redis_db_num)
+                               db=redis_db_num))
+
+#where the counters, prefix index and trips time series live (see storage.py).
+#store.redis_conn is None when there is no redis for the redis-only features
+store = storage.get_storage(redis_conn)
+
+def _needs_redis(view):
+    """Decorator for the views of the redis-only features"""
+
+    def wrapper(request, *args, **kwargs):
+        if store.redis_conn is None:
+            return HttpResponse('Not available with the {0} storage'.format(store.__class__.__name__),
+                                status=501)
+        return view(request, *args, **kwargs)
+    wrapper.__doc__ = view.__doc__
+    wrapper.__name__ = view.__name__
+    return wrapper
+
+#worker-local index of the registered geofences, also built on first use
+_fence_index = None
+
+def _get_fence_index():
+    """Returns this worker's FenceIndex"""
+
+    global _fence_index
+
+    if _fence_index is None:
+        _fence_index = geofences.start(store.redis_conn)
+    return _fence_index
 
 def index(request):
     """Main page with all the questions."""
@@ -38,58 +73,13 @@ def index(request):
     if request.method == 'GET':
         return render_to_response('index.html')
 
-def _update_counters(current_trips_counter_key, trips_counter_key, increment_flag=True):
-    """
-    Helper function to update counters when an evet arrives. Since two distinct
-    counters are updated, we use a transaction mechanism.
-
-    Reference: https://github.com/andymccurdy/redis-py [Section on pipelines]
-    """
-    with redis_conn.pipeline() as pipe:
-        while 1:
-            try:
-                # put a WATCH on the key that holds our sequence value
-                pipe.watch(current_trips_counter_key)
-                # after WATCHing, the pipeline is put into immediate execution
-                # mode until we tell it to start buffering commands again.
-                # this allows us to get the current value of our sequence
-                current_value = pipe.get(current_trips_counter_key)
-                if increment_flag:
-                    #this is a 'begin' event
-                    if current_value:
-                        next_value = int(current_value) + 1
-                    else:
-                        #current_value could be returned a None
-                        next_value = 1
-                else:
-                    #this is a 'end' event
-                    if current_value:
-                        next_value = int(current_value) - 1
-                    else:
-                        next_value = -1
-
-                # now we can put the pipeline back into buffered mode with MULTI
-                pipe.multi()
-                pipe.set(current_trips_counter_key, next_value)
-                pipe.set(trips_counter_key, next_value)
-                pipe.expire(trips_counter_key, 90*24*60*60)
-                # and finally, execute the pipeline (the set command)
-                pipe.execute()
-                # if a WatchError wasn't raised during execution, everything
-                # we just did happened atomically.
-                break
-            except redis.WatchError:
-                # another client must have changed 'OUR-SEQUENCE-KEY' between
-                # the time we started WATCHing it and the pipeline's execution.
-                # our best bet is to just retry.
-                continue
-
 def trips(request):
     """
     This is the endpoint that acts as the subscriber for messages in the pub/sub channel.
 
     When messages arrive here, they are inserted into redis as per the schema
-    described in the README.
+    described in the README (see ingest.py). The body is one event, a json
+    array of them, or packed binary events (see wire.py).
     """
 
     if request.method == 'POST':
@@ -97,99 +87,13 @@ def trips(request):
             #get the current timestamp as we assume this is the timestamp of the message
             #see 'assumptions' section in README
             now = datetime.utcnow()
-            now_seconds = calendar.timegm(now.timetuple())
-
-            message = json.loads(request.raw_post_data)
-
-            #basic sanity checking...
-            if not (message.has_key('event') and message.has_key('tripId') and
-               message.has_key('lat') and message.has_key('lng')):
-                return HttpResponseBadRequest('Input json is not in correct format')
-            if message['event'] == 'end' and not message.has_key('fare'):
-                return HttpResponseBadRequest('Input json is not in correct format (fare missing in "end" event)')
-
-            geohash_string = geohash.encode(message['lat'], message['lng'])
-
-            #extract the date this timestamp corresponds to
-            current_date = '{0}-{1}-{2}'.format(now.year, now.month, now.day)
-            current_week = now.strftime('%U')
-
-            #keys for counters for the geohash, by day
-            geohash_day_tripset_key = 'geohash:{0}:days:{1}:tripids'.format(geohash_string, current_date)
-            geohash_day_startcounter_key = 'geohash:{0}:days:{1}:tot_start_counter'.format(geohash_string, current_date)
-            geohash_day_stopcounter_key = 'geohash:{0}:days:{1}:tot_stop_counter'.format(geohash_string, current_date)
-            geohash_day_farecounter_key = 'geohash:{0}:days:{1}:tot_fare_counter'.format(geohash_string, current_date)
-
-            #keys for counters for the geohash, by week
-            geohash_week_tripset_key = 'geohash:{0}:weeks:{1}:tripids'.format(geohash_string, current_week)
-            geohash_week_startcounter_key = 'geohash:{0}:weeks:{1}:tot_start_counter'.format(geohash_string, current_week)
-            geohash_week_stopcounter_key = 'geohash:{0}:weeks:{1}:tot_stop_counter'.format(geohash_string, current_week)
-            geohash_week_farecounter_key = 'geohash:{0}:weeks:{1}:tot_fare_counter'.format(geohash_string, current_week)
-
-            #we are passing thorugh this geohash, so update the sorted set
-            #NOTE that it should be a set so that if there are multiple updates
-            #within a geohash, only one tripid is added into the set.
-            redis_conn.zadd(geohash_day_tripset_key, 0, message['tripId'])
-            redis_conn.zadd(geohash_week_tripset_key, 0, message['tripId'])
-
-            #are we an event that impacts start/stop counts?
-            if message['event'].lower() in ['begin', 'end']:
-
-                #build out the redis keys
-                current_trips_counter_key = 'current_trips_counter'
-                #trips_counter:<epoch time>
-                trips_counter_key = 'trips_counter:{0}'.format(calendar.timegm(now.timetuple()))
-
-                event_times_key = 'event_times:{0}'.format(current_date)
-
-                if message['event'].lower() == 'begin':
-
-                    _update_counters(current_trips_counter_key, trips_counter_key)
-
-                    #begin event within a geohash, update it's counter
-                    redis_conn.incr(geohash_day_startcounter_key)
-                    redis_conn.incr(geohash_week_startcounter_key)
-
-                elif message['event'].lower() == 'end':
-
-                    _update_counters(current_trips_counter_key, trips_counter_key, False)
-
-                    #end event within a geohash, update it's counter
-                    redis_conn.incr(geohash_day_stopcounter_key)
-                    redis_conn.incr(geohash_week_stopcounter_key)
-                    redis_conn.incrbyfloat(geohash_day_farecounter_key, float(message['fare']))
-                    redis_conn.incrbyfloat(geohash_week_farecounter_key, float(message['fare']))
-
-                #add the timestamp to a sorted set. This is used in case a query comes
-                #in for a timestamp for which we don't have an exact key at
-                #trips_counter:<timestamp>. So we will then choose the first value from
-                #this sorted set which is sligthly lesser than <timestamp> as that is the
-                #last recorded value we have closest to <timestamp>
-                redis_conn.zadd(event_times_key, 0, calendar.timegm(now.timetuple()))
-
-                #set it's expiry to 90 days since when it was last accessed
-                redis_conn.expire(event_times_key, 90*24*60*60)
-
-            #we now have to store the geohash_string for this lat/lng in such a
-            #way, so that it is quickly retrivable during search. But the user
-            #can type in any bounding box. The property of geohashes is that if
-            #they are close together they will share the same prefix. Also as you
-            #move left in the geohash, you loose accuracy i.e. the bounding box becomes bigger.
-            #Thus we need an efficient way, once given the bounding box, find the common
-            #prefix of the two edges and then use this common prefix for all the
-            #geohashes that share the same prefix. Here's a solution using
-            #sorted sets
-
-
-            for i in range(1, len(geohash_string)):
-                #the score is the timestamp, value is the actual geohash
-                #done it this way caus we can then expire elements after a period
-                #of time. I'm not going to implement that here, but using this pattern you
-                #can. See https://groups.google.com/forum/#!topic/redis-db/rXXMCLNkNSs
-                redis_conn.zadd('geohash_prefixes:{0}'.format(geohash_string[:i]),
-                                now_seconds, #score
-                                geohash_string)
 
+            try:
+                messages = ingest.parse(request.raw_post_data, request.META.get('CONTENT_TYPE'))
+            except ingest.InvalidEvent, e:
+                return HttpResponseBadRequest(str(e))
+
+            ingest.record(store, messages, now, _get_fence_index() if store.redis_conn is not None else None)
             return HttpResponse()
 
         except Exception, e:
@@ -206,7 +110,7 @@ def current_trip_count(request):
 
     if request.method == 'GET':
         t1 = datetime.utcnow()
-        count = redis_conn.get('current_trips_counter')
+        count = store.current_trips()
         t2 = datetime.utcnow()
         query_time = t2 - t1
         return render_to_response('current_trip_count.html', {'count': count,
@@ -233,70 +137,19 @@ def time_t_trip_count(request):
 
         time_instant_seconds = calendar.timegm(time_instant_datetime.timetuple())
 
-        #first lets see if there is a key called trips_counter:<timestamp>
         t1 = datetime.utcnow()
-
-        count = redis_conn.get('trips_counter:{0}'.format(time_instant_seconds))
+        count = store.trips_at(time_instant_seconds)
         t2 = datetime.utcnow()
 
-        if count:
-            query_time = t2 - t1
-            return render_to_response('time_t_trip_count.html', {'count': count,
-                'query_time': query_time, 't': str(time_instant_datetime)
+        if count is None:
+            #no info at all for that day, see storage.py
+            return render_to_response('time_t_trip_count.html', {'count': 0,
+                'query_time': None, 'error': 'No info available for this time'
             })
-        else:
-            #ok, so this key is not there. so we have to search the appropriate bucket
-            #for the closest timestamp
-            current_date = '{0}-{1}-{2}'.format(time_instant_datetime.year,
-                                                time_instant_datetime.month,
-                                                time_instant_datetime.day)
-
-            event_times_key = 'event_times:{0}'.format(current_date)
-
-            if redis_conn.exists(event_times_key):
-                #so now we have to find the closest timestamp in the sorted set
-                #but iterating over the set in a O(n) operation. Also, if the set
-                #is large it can hold up redis while it is returning the set
-
-                #here's a quick hack to find the closest element...
 
-                t1 = datetime.utcnow()
-                #first add the time you are looking for into the sorted set
-                redis_conn.zadd(event_times_key, 0, time_instant_seconds) #O(log(n))
-                #since it is a sorted set we know that what we added went into the right position
-                #so get it's index
-                rank = int(redis_conn.zrank(event_times_key, time_instant_seconds)) #O(log(n))
-
-                #now we have the rank, just get the previous index
-                required_time_key = redis_conn.zrange(event_times_key, rank-1, rank-1)[0] #O(log(N)+1)
-                #thus required_time_key is the key we are looking for and we can get the
-                #final trip count by GETing trips_counter:<required_time_key>
-
-                count = redis_conn.get('trips_counter:{0}'.format(required_time_key))
-
-                #cleanup event_times_key sorted set
-                redis_conn.zrem(event_times_key, time_instant_seconds) #O(1*log(N))
-
-                t2 = datetime.utcnow()
-
-                return render_to_response('time_t_trip_count.html', {'count': count,
-                    'query_time': t2 - t1, 't': str(time_instant_datetime)
-                })
-
-            else:
-                #so the event_times_key sorted set does not even exist. Since the
-                #requirements state that there are an average of 500 trips hapenning
-                #at any given time, the only explanation for a day bucket not being
-                #present is that it is aged out (i.e. expired). Maybe it has passed
-                #90 days or something...
-                #rather than complicate the logic and go backwards and see if there is
-                #a previous day bucket etc, based on the problem statement, this is
-                #a simplifying assumption
-                return render_to_response('time_t_trip_count.html', {'count': 0,
-                    'query_time': None, 'error': 'No info available for this time'
-                })
-
-        return HttpResponse()
+        return render_to_response('time_t_trip_count.html', {'count': count,
+            'query_time': t2 - t1, 't': str(time_instant_datetime)
+        })
 
 def _valiate_input(request):
     """Helper function to validate input fields like bounding box co-ordinates etc"""
@@ -309,81 +162,100 @@ def _valiate_input(request):
     lat2 = request.POST.get('lat2', None)
     lng2 = request.POST.get('lng2', None)
 
+    #a GeoJSON polygon can be given instead of the two corners
+    polygon_geojson = request.POST.get('polygon', None)
+    polygon = None
+
     days_back = request.POST.get('days_back', None)
 
+    upper_left_geohash_string = ''
+    lower_right_geohash_string = ''
+
+    if polygon_geojson:
+        try:
+            polygon = polygons.parse_geojson(polygon_geojson)
+        except ValueError:
+            did_not_validate = 1
+            err_msg = 'Please enter a valid GeoJSON Polygon or MultiPolygon'
+
+    else:
+        if not (lat1 and lng1 and lat2 and lng2):
+            did_not_validate = 1
+            err_msg = 'Please enter all lat/lng values'
+
+        try:
+            upper_left_geohash_string = geohash.encode(float(lat1), float(lng1))
+        except Exception:
+            did_not_validate = 1
+            err_msg = 'Please enter correct values for top left lat/lng'
+
+        try:
+            lower_right_geohash_string = geohash.encode(float(lat2), float(lng2))
+        except Exception:
+            did_not_validate = 1
+            err_msg = 'Please enter correct values for bottom right lat/lng'
+
     if not days_back:
         did_not_validate = 1
         err_msg = 'Please enter how far back do you want to look into'
 
-    if not (lat1 and lng1 and lat2 and lng2):
-        did_not_validate = 1
-        err_msg = 'Please enter all lat/lng values'
+    return (did_not_validate, err_msg, lat1, lng1, lat2, lng2, days_back, upper_left_geohash_string, lower_right_geohash_string, polygon)
 
-    try:
-        upper_left_geohash_string = geohash.encode(float(lat1), float(lng1))
-    except Exception:
-        upper_left_geohash_string = ''
-        did_not_validate = 1
-        err_msg = 'Please enter correct values for top left lat/lng'
+def _helper_cells_under(prefixes, since):
+    """Returns, for each prefix, the list of active cells under it (i.e. the
+    members of geohash_prefixes:<prefix>) in one batched lookup.
 
-    try:
-        lower_right_geohash_string = geohash.encode(float(lat2), float(lng2))
-    except Exception:
-        lower_right_geohash_string = ''
-        did_not_validate = 1
-        err_msg = 'Please enter correct values for bottom right lat/lng'
+    <since> is the epoch before which cells are known to be of no interest.
+    """
 
-    return (did_not_validate, err_msg, lat1, lng1, lat2, lng2, days_back, upper_left_geohash_string, lower_right_geohash_string)
+    return store.cells_under(prefixes, since)
 
-def _helper_get_target_geohashes(days_back, upper_left_geohash_string, lower_right_geohash_string):
-    """Helper function to calculate the geohashes that lie within the bounding box
-    and that had trips within the specified timeframe.
+def _helper_get_sub_keys(days_back):
+    """Helper function to work out the time buckets a query has to look at.
+
+    Returns (candidate_sub_keys, since), see buckets.sub_keys()
     """
 
-    common_prefix = ''
-    #see assumptions section in README
-    for i in range(min(len(upper_left_geohash_string), len(lower_right_geohash_string))):
-        if upper_left_geohash_string[i] != lower_right_geohash_string[i]:
-            common_prefix = upper_left_geohash_string[:i]
-            break
-    else:
-        common_prefix = upper_left_geohash_string
+    return buckets.sub_keys(days_back, datetime.utcnow())
 
-    #so now we have to get all geocodes which have the prefix <common_prefix>
-    #as all those geocodes will be contained in the bounding box
-    target_geohashes = redis_conn.zrange('geohash_prefixes:{0}'.format(common_prefix), 0, -1)
+def _helper_get_target_geohashes(days_back, upper_left_geohash_string, lower_right_geohash_string, polygon=None):
+    """Helper function to calculate the geohashes that lie within the bounding box
+    (or the polygon, if one is given) and that had trips within the specified timeframe.
+    """
 
-    candidate_sub_keys = []
+    candidate_sub_keys, since = _helper_get_sub_keys(days_back)
 
-    #we need to know how far back in time we need to go
-    now = datetime.utcnow()
-    current_date = '{0}-{1}-{2}'.format(now.year, now.month, now.day)
-    current_week = now.strftime('%U')
+    if polygon is not None:
+        target_geohashes = polygons.target_cells(polygon,
+            lambda prefixes: _helper_cells_under(prefixes, since))
 
-    duration = int(days_back[:-1])
+    else:
+        #see assumptions section in README
+        common_prefix = geo.common_prefix(upper_left_geohash_string, lower_right_geohash_string)
 
-    if days_back.endswith('d'):
-        if not duration:
-            candidate_sub_keys.append('days:{0}'.format(current_date))
-        else:
-            #accumulate the info from now until the 'days_back'
-            for i in range(duration):
-                new_date = now - timedelta(days=i)
-                new_date_str = '{0}-{1}-{2}'.format(new_date.year, new_date.month, new_date.day)
-                candidate_sub_keys.append('days:{0}'.format(new_date_str))
-
-    elif days_back.endswith('w'):
-        if not duration:
-            candidate_sub_keys.append('weeks:{0}'.format(current_week))
-        else:
-            #accumulate the info from now until the 'weeks_back'
-            for i in range(duration):
-                new_date = now - timedelta(days=i*7)
-                new_week_str = new_date.strftime('%U')
-                candidate_sub_keys.append('weeks:{0}'.format(new_week_str))
+        #so now we have to get all geocodes which have the prefix <common_prefix>
+        #as all those geocodes will be contained in the bounding box
+        target_geohashes = _helper_cells_under([common_prefix], since)[0]
+
+    metrics.observe('geofence_query_cells', len(target_geohashes))
+    metrics.observe('geofence_query_buckets', len(candidate_sub_keys))
+    tracing.note(cells=len(target_geohashes), buckets=len(candidate_sub_keys))
 
     return (target_geohashes, candidate_sub_keys)
 
+def _rejected(rejected, template=None):
+    """The answer to a query admission control turned down (see admission.py):
+    the <template> page with the error, or the bare error"""
+
+    if template is None:
+        response = HttpResponse(str(rejected), status=rejected.status)
+    else:
+        response = render_to_response(template, {'error': str(rejected)})
+        response.status_code = rejected.status
+    if rejected.status == 503:
+        response['Retry-After'] = str(admission.RETRY_AFTER)
+    return response
+
 def trips_passed_through(request):
     """Calculates the number of trips through a geo-rect, within a specified time-frame.
 
@@ -401,23 +273,39 @@ def trips_passed_through(request):
 
         t1 = datetime.utcnow()
 
-        did_not_validate, err_msg, lat1, lng1, lat2, lng2, days_back, upper_left_geohash_string, lower_right_geohash_string = _valiate_input(request)
+        did_not_validate, err_msg, lat1, lng1, lat2, lng2, days_back, upper_left_geohash_string, lower_right_geohash_string, polygon = _valiate_input(request)
 
         if did_not_validate:
             return render_to_response('trips_passed_through.html', {'error': err_msg})
 
-        target_geohashes, candidate_sub_keys = _helper_get_target_geohashes(days_back, upper_left_geohash_string, lower_right_geohash_string)
+        target_geohashes, candidate_sub_keys = _helper_get_target_geohashes(days_back, upper_left_geohash_string, lower_right_geohash_string, polygon)
 
-        count = 0
-        #now iterate through all the geohashes in the geo-rect and extract the
-        #values from the appripriate time bucketed keys
-        for target in target_geohashes:
-            for candidate_sub_key in candidate_sub_keys:
-                count += redis_conn.zcard('geohash:{0}:{1}:tripids'.format(target, candidate_sub_key))
+        try:
+            #over budget, it is answered from the heatmap rollups
+            coarse = admission.check(target_geohashes, candidate_sub_keys, rollups=store.redis_conn is not None)
+
+            if coarse is not None:
+                precision, cells = coarse
+                with admission.running(admission.cost(cells, candidate_sub_keys)) as deadline:
+                    count = int(heatmaps.grid(store.redis_conn, cells, precision, candidate_sub_keys,
+                                              deadline)['trips'].sum())
+
+            else:
+                with admission.running(admission.cost(target_geohashes, candidate_sub_keys)) as deadline:
+                    #now iterate through all the geohashes in the geo-rect and extract the
+                    #values from the appripriate time bucketed keys
+                    count = sum(admission.read_many(store.zcard_many,
+                                                    ['geohash:{0}:{1}:tripids'.format(target, candidate_sub_key)
+                                                     for target in target_geohashes
+                                                     for candidate_sub_key in candidate_sub_keys], deadline))
+
+        except admission.Rejected, e:
+            return _rejected(e, 'trips_passed_through.html')
 
         t2 = datetime.utcnow()
 
         return render_to_response('trips_passed_through.html', {'count': count,
+            'approximate': coarse is not None,
             'query_time': t2 - t1,
             'lat1': lat1,
             'lng1': lng1,
@@ -434,44 +322,58 @@ def trips_start_stop(request):
     elif request.method == 'POST':
         t1 = datetime.utcnow()
 
-        did_not_validate, err_msg, lat1, lng1, lat2, lng2, days_back, upper_left_geohash_string, lower_right_geohash_string = _valiate_input(request)
+        did_not_validate, err_msg, lat1, lng1, lat2, lng2, days_back, upper_left_geohash_string, lower_right_geohash_string, polygon = _valiate_input(request)
 
         if did_not_validate:
             return render_to_response('trips_passed_through.html', {'error': err_msg})
 
-        target_geohashes, candidate_sub_keys = _helper_get_target_geohashes(days_back, upper_left_geohash_string, lower_right_geohash_string)
-
-        start_count = 0
-        stop_count = 0
-        fare_count = 0
-
-        #now iterate through all the geohashes in the geo-rect and extract the
-        #values from the appripriate time bucketed keys
-        for target in target_geohashes:
-            for candidate_sub_key in candidate_sub_keys:
-                try:
-                    start_count += int(redis_conn.get('geohash:{0}:{1}:tot_start_counter'.format(target, candidate_sub_key)))
-                except TypeError:
-                    #got None or something, probably caus this key is not there
-                    pass
-
-                try:
-                    stop_count += int(redis_conn.get('geohash:{0}:{1}:tot_stop_counter'.format(target, candidate_sub_key)))
-                except TypeError:
-                    #got None or something, probably caus this key is not there
-                    pass
-
-                try:
-                    fare_count += float(redis_conn.get('geohash:{0}:{1}:tot_fare_counter'.format(target, candidate_sub_key)))
-                except TypeError:
-                    #got None or something, probably caus this key is not there
-                    pass
+        target_geohashes, candidate_sub_keys = _helper_get_target_geohashes(days_back, upper_left_geohash_string, lower_right_geohash_string, polygon)
+
+        fare_median = fare_p95 = None
+
+        try:
+            #over budget, it is answered from the heatmap rollups (without the percentiles)
+            coarse = admission.check(target_geohashes, candidate_sub_keys, rollups=store.redis_conn is not None)
+
+            if coarse is not None:
+                precision, cells = coarse
+                with admission.running(admission.cost(cells, candidate_sub_keys)) as deadline:
+                    records = heatmaps.grid(store.redis_conn, cells, precision, candidate_sub_keys, deadline)
+                start_count = int(records['start'].sum())
+                stop_count = int(records['stop'].sum())
+                fare_count = float(records['fare'].sum())
+
+            else:
+                with admission.running(admission.cost(target_geohashes, candidate_sub_keys)) as deadline:
+                    #now iterate through all the geohashes in the geo-rect and extract the
+                    #values from the appripriate time bucketed keys. (a key that is not there
+                    #comes back as None)
+                    sub_keys = ['geohash:{0}:{1}'.format(target, candidate_sub_key)
+                                for target in target_geohashes for candidate_sub_key in candidate_sub_keys]
+
+                    start_count = sum(int(value) for value in admission.read_many(store.get_many,
+                                      [sub_key + ':tot_start_counter' for sub_key in sub_keys], deadline) if value)
+                    stop_count = sum(int(value) for value in admission.read_many(store.get_many,
+                                     [sub_key + ':tot_stop_counter' for sub_key in sub_keys], deadline) if value)
+                    fare_count = sum(float(value) for value in admission.read_many(store.get_many,
+                                     [sub_key + ':tot_fare_counter' for sub_key in sub_keys], deadline) if value)
+
+                    #median and 95th percentile fare, out of the merged fare distributions
+                    if store.redis_conn is not None:
+                        fare_median, fare_p95 = fares.percentiles(store.redis_conn,
+                            [sub_key + ':fare_histogram' for sub_key in sub_keys], [50, 95], deadline)
+
+        except admission.Rejected, e:
+            return _rejected(e, 'trips_start_stop.html')
 
         t2 = datetime.utcnow()
 
         return render_to_response('trips_start_stop.html', {'start_count': start_count,
+            'approximate': coarse is not None,
             'stop_count': stop_count,
             'fare_count': fare_count,
+            'fare_median': fare_median,
+            'fare_p95': fare_p95,
             'query_time': t2 - t1,
             'lat1': lat1,
             'lng1': lng1,
@@ -479,15 +381,284 @@ def trips_start_stop(request):
             'lng2': lng2
             })
 
+@_needs_redis
+def fences(request, name=None):
+    """Registers/lists/removes the named rectangular geofences.
+
+    GET    /fences/         => json {name: [south, west, north, east]} of all fences
+    POST   /fences/         => json {"name": .., "lat1": .., "lng1": .., "lat2": .., "lng2": ..}
+                               adds the fence (or replaces the one with that name)
+    GET    /fences/<name>/  => json [south, west, north, east] of that fence
+    DELETE /fences/<name>/  => removes the fence
+
+    Enter/exit transitions are published on the fence_events:<name> channels,
+    see dispatch/fences.py
+    """
+
+    if request.method == 'GET':
+        registered = geofences.get_fences(store.redis_conn)
+        if name is None:
+            payload = registered
+        elif name in registered:
+            payload = registered[name]
+        else:
+            return HttpResponseNotFound()
+        return HttpResponse(json.dumps(payload), content_type='application/json')
+
+    elif request.method == 'POST' and name is None:
+        try:
+            fence = json.loads(request.raw_post_data)
+            box = geofences.make_box(float(fence['lat1']), float(fence['lng1']),
+                                     float(fence['lat2']), float(fence['lng2']))
+            fence_name = unicode(fence['name'])
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest('Input json is not in correct format')
+
+        if not fence_name or ':' in fence_name:
+            return HttpResponseBadRequest('Please enter a fence name without a ":"')
+
+        geofences.save_fence(store.redis_conn, fence_name, box)
+        #our own index is updated right away, the other workers follow the feed
+        _get_fence_index().add(fence_name, box)
+        return HttpResponse()
+
+    elif request.method == 'DELETE' and name is not None:
+        if not geofences.delete_fence(store.redis_conn, name):
+            return HttpResponseNotFound()
+        _get_fence_index().remove(name)
+        return HttpResponse()
+
+    else:
+        return HttpResponseNotAllowed(['GET', 'POST', 'DELETE'])
+
+def _helper_get_area(params):
+    """Helper function to read the area of a query, either the two corners
+    lat1/lng1/lat2/lng2 or a GeoJSON 'polygon'.
+
+    Returns (err_msg, polygon), the box is turned into a polygon too.
+    """
+
+    if params.get('polygon'):
+        try:
+            return '', polygons.parse_geojson(params['polygon'])
+        except ValueError:
+            return 'Please enter a valid GeoJSON Polygon or MultiPolygon', None
+
+    try:
+        lat1, lng1, lat2, lng2 = [float(params[name]) for name in ('lat1', 'lng1', 'lat2', 'lng2')]
+    except (KeyError, ValueError):
+        return 'Please enter all lat/lng values', None
 
+    return '', polygons.from_box(min(lat1, lat2), min(lng1, lng2), max(lat1, lat2), max(lng1, lng2))
 
+@_needs_redis
+def active_trips(request):
+    """Returns the active trips inside a box/polygon right now.
 
+    GET /query/active_trips/?lat1=..&lng1=..&lat2=..&lng2=..   (or ?polygon=<GeoJSON>)
+        => json {"count": .., "trip_ids": [..], "query_time": <seconds>}
+    """
 
+    if request.method == 'GET':
+        t1 = datetime.utcnow()
 
+        err_msg, polygon = _helper_get_area(request.GET)
+        if err_msg:
+            return HttpResponseBadRequest(err_msg)
 
+        try:
+            trip_ids = active.trips_in(store.redis_conn, polygon, calendar.timegm(t1.timetuple()))
+        except ValueError:
+            return HttpResponseBadRequest('Please enter a smaller area')
 
+        t2 = datetime.utcnow()
 
+        return HttpResponse(json.dumps({'count': len(trip_ids),
+            'trip_ids': trip_ids,
+            'query_time': (t2 - t1).total_seconds(),
+            }), content_type='application/json')
 
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+@_needs_redis
+def nearest_trips(request):
+    """Returns the k active trips nearest to a point, nearest first.
+
+    GET /query/nearest_trips/?lat=..&lng=..&k=10
+        => json {"trips": [{"tripId": .., "lat": .., "lng": .., "distance": <meters>}, ..],
+                 "query_time": <seconds>}
+    """
+
+    if request.method == 'GET':
+        t1 = datetime.utcnow()
+
+        try:
+            lat = float(request.GET['lat'])
+            lng = float(request.GET['lng'])
+            k = int(request.GET.get('k', 10))
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest('Please enter a lat/lng and a number of trips')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180 and k > 0):
+            return HttpResponseBadRequest('Please enter a lat/lng and a number of trips')
+
+        nearest = active.nearest_trips(store.redis_conn, lat, lng, k, calendar.timegm(t1.timetuple()))
+
+        t2 = datetime.utcnow()
+
+        return HttpResponse(json.dumps({'trips': [{'tripId': trip_id, 'lat': trip_lat, 'lng': trip_lng, 'distance': distance}
+                for trip_id, trip_lat, trip_lng, distance in nearest],
+            'query_time': (t2 - t1).total_seconds(),
+            }), content_type='application/json')
+
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+@_needs_redis
+def heatmap(request):
+    """Returns the per-cell trip density of a map tile or viewport.
+
+    GET /query/heatmap/?tile=<geohash prefix>&precision=..&days_back=..
+    GET /query/heatmap/?lat1=..&lng1=..&lat2=..&lng2=..&precision=..&days_back=..
+
+        => json {"precision": .., "cells": [..], "start": [..], "stop": [..],
+                 "fare": [..], "trips": [..]}, one entry per non-empty cell.
+           with &format=bin, the cells as packed little endian records instead
+           (see heatmap.RECORD_DTYPE)
+
+    Tiles are the cells under a geohash prefix, so the same tile is always the
+    same url and the responses can be cached by the browser/nginx.
+    """
 
+    if request.method == 'GET':
+        try:
+            precision = int(request.GET['precision'])
+        except (KeyError, ValueError):
+            precision = None
+        if precision not in heatmaps.HEATMAP_PRECISIONS:
+            return HttpResponseBadRequest('Please enter one of the precisions {0}'.format(
+                ', '.join(str(p) for p in heatmaps.HEATMAP_PRECISIONS)))
+
+        days_back = request.GET.get('days_back', '0d')
+        if not buckets.valid(days_back):
+            return HttpResponseBadRequest('Please enter how far back do you want to look into, up to {0} days'.format(
+                buckets.MAX_DAYS_BACK))
+
+        try:
+            if request.GET.get('tile'):
+                cells = heatmaps.tile_cells(request.GET['tile'], precision)
+            else:
+                lat1, lng1, lat2, lng2 = [float(request.GET[name]) for name in ('lat1', 'lng1', 'lat2', 'lng2')]
+                cells = heatmaps.viewport_cells(min(lat1, lat2), min(lng1, lng2),
+                                                max(lat1, lat2), max(lng1, lng2), precision)
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest('Please enter a tile or a smaller viewport')
+
+        candidate_sub_keys, since = _helper_get_sub_keys(days_back)
+        try:
+            admission.check(cells, candidate_sub_keys, rollups=False)
+            with admission.running(admission.cost(cells, candidate_sub_keys)) as deadline:
+                records = heatmaps.grid(store.redis_conn, cells, precision, candidate_sub_keys, deadline)
+        except admission.Rejected, e:
+            return _rejected(e)
+
+        if request.GET.get('format') == 'bin':
+            response = HttpResponse(records.tostring(), content_type='application/octet-stream')
+        else:
+            response = HttpResponse(json.dumps({'precision': precision,
+                'cells': records['cell'].tolist(),
+                'start': records['start'].tolist(),
+                'stop': records['stop'].tolist(),
+                'fare': records['fare'].tolist(),
+                'trips': records['trips'].tolist(),
+                }, separators=(',', ':')), content_type='application/json')
+
+        patch_response_headers(response, heatmaps.MAX_AGE)
+        return response
+
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+@_needs_redis
+def hotspots(request):
+    """Returns the busiest cells over the last few hours.
+
+    GET /query/hotspots/?precision=6&metric=events|starts&hours_back=1&k=10
+        => json {"cells": [{"cell": .., "count": ..}, ..], "query_time": <seconds>}
+    """
+
+    if request.method == 'GET':
+        t1 = datetime.utcnow()
+
+        try:
+            precision = int(request.GET['precision'])
+            hours_back = int(request.GET.get('hours_back', 1))
+            k = int(request.GET.get('k', 10))
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest('Please enter a precision, hours_back and k')
+
+        metric = request.GET.get('metric', 'events')
+
+        if precision not in leaderboard.LEADERBOARD_PRECISIONS or metric not in leaderboard.METRICS:
+            return HttpResponseBadRequest('Please enter one of the precisions {0} and metrics {1}'.format(
+                ', '.join(str(p) for p in leaderboard.LEADERBOARD_PRECISIONS), ', '.join(leaderboard.METRICS)))
+        if not (0 < hours_back <= leaderboard.RETENTION_HOURS and 0 < k <= leaderboard.LEADERBOARD_SIZE):
+            return HttpResponseBadRequest('Please enter up to {0} hours_back and up to {1} cells'.format(
+                leaderboard.RETENTION_HOURS, leaderboard.LEADERBOARD_SIZE))
+
+        top = leaderboard.top_cells(store.redis_conn, precision, metric, t1, hours_back, k)
+
+        t2 = datetime.utcnow()
+
+        return HttpResponse(json.dumps({'cells': [{'cell': cell, 'count': count} for cell, count in top],
+            'query_time': (t2 - t1).total_seconds(),
+            }), content_type='application/json')
+
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+@_needs_redis
+def od_matrix(request):
+    """Returns the trips and fares between zones (geohash cells of od.OD_PRECISION chars).
+
+    GET /query/od_matrix/?origins=9q8zn,9q8yv&destinations=9q8zn,9q8yy&days_back=0d
+        => json {"origins": [..], "destinations": [..], "trips": [[..], ..], "fares": [[..], ..]}
+           trips[i][j] is the number of trips from origins[i] to destinations[j]
+
+    Leave out destinations to get the whole rows of the origins.
+    """
+
+    if request.method == 'GET':
+        origins = [zone for zone in request.GET.get('origins', '').split(',') if zone]
+        destinations = [zone for zone in request.GET.get('destinations', '').split(',') if zone]
+        days_back = request.GET.get('days_back', '0d')
+
+        if not origins or any(len(zone) != od.OD_PRECISION for zone in origins + destinations):
+            return HttpResponseBadRequest('Please enter the origin (and destination) zones as {0} char geohashes'.format(od.OD_PRECISION))
+        if not buckets.valid(days_back):
+            return HttpResponseBadRequest('Please enter how far back do you want to look into, up to {0} days'.format(
+                buckets.MAX_DAYS_BACK))
+
+        candidate_sub_keys, since = _helper_get_sub_keys(days_back)
+        try:
+            #a HMGET/HGETALL per origin and bucket
+            admission.check(origins, candidate_sub_keys, rollups=False)
+            with admission.running(admission.cost(origins, candidate_sub_keys)) as deadline:
+                destinations, trips, fares = od.matrix(store.redis_conn, origins, destinations, candidate_sub_keys,
+                                                       deadline)
+        except admission.Rejected, e:
+            return _rejected(e)
+
+        return HttpResponse(json.dumps({'origins': origins,
+            'destinations': destinations,
+            'trips': trips,
+            'fares': fares,
+            }), content_type='application/json')
+
+    else:
+        return HttpResponseNotAllowed(['GET'])
 
+def metrics_endpoint(request):
+    """The metrics of all the workers, for prometheus to scrape (see metrics.py)"""
 
+    return HttpResponse(metrics.render(store.redis_conn), content_type='text/plain; version=0.0.4')
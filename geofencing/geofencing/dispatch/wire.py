@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+import numpy
+
+__doc__ = """
+        The packed binary encoding of /trips/ events, for publishers that
+        send a lot of them: a body of fixed width records, with the
+        Content-Type CONTENT_TYPE instead of json.
+
+            tripId  int64
+            lat     float64
+            lng     float64
+            event   uint8    0 begin, 1 update, 2 end (as EVENTS)
+            fare    float64  NaN unless event is 'end'
+
+        little endian, no padding: 33 bytes an event against ~75 for the
+        json object, and a whole batch decodes with one numpy.frombuffer and
+        is checked column by column. The records go on to ingest as they are.
+        The tripIds are integers, as the publisher's.
+
+        No django in here, client/publisher.py uses it too.
+"""
+
+CONTENT_TYPE = 'application/x-geofence-events'
+
+EVENTS = ('begin', 'update', 'end')
+
+WIRE_DTYPE = numpy.dtype([('trip', '<i8'), ('lat', '<f8'), ('lng', '<f8'), ('event', 'u1'), ('fare', '<f8')])
+
+class WireError(ValueError):
+    """A body that is not packed events, the message says why"""
+
+def pack(messages):
+    """The body carrying the /trips/ payloads <messages>"""
+
+    records = numpy.zeros(len(messages), dtype=WIRE_DTYPE)
+    records['trip'] = [message['tripId'] for message in messages]
+    records['lat'] = [message['lat'] for message in messages]
+    records['lng'] = [message['lng'] for message in messages]
+    records['event'] = [EVENTS.index(message['event']) for message in messages]
+    records['fare'] = [message['fare'] if message['event'] == 'end' else numpy.nan for message in messages]
+    return records.tostring()
+
+def unpack(body):
+    """The WIRE_DTYPE records of a body. Raises WireError if it isn't one."""
+
+    if not body or len(body) % WIRE_DTYPE.itemsize:
+        raise WireError('Input is not in correct format (packed events are {0} bytes)'.format(WIRE_DTYPE.itemsize))
+
+    records = numpy.frombuffer(body, dtype=WIRE_DTYPE)
+    if (records['event'] >= len(EVENTS)).any():
+        raise WireError('Input is not in correct format (unknown event)')
+    if not (numpy.isfinite(records['lat']).all() and numpy.isfinite(records['lng']).all()):
+        raise WireError('Input is not in correct format (lat/lng is not a number)')
+    if (numpy.abs(records['lat']) > 90).any() or (numpy.abs(records['lng']) > 180).any():
+        raise WireError('Input is not in correct format (lat/lng out of range)')
+    if not numpy.isfinite(records['fare'][records['event'] == 2]).all():
+        raise WireError('Input is not in correct format (fare missing in "end" event)')
+    return records
+
+def messages(records):
+    """The /trips/ payloads of unpacked <records>, as the json ones"""
+
+    messages = []
+    for trip, lat, lng, event, fare in records.tolist():
+        message = {'event': EVENTS[event], 'tripId': trip, 'lat': lat, 'lng': lng}
+        if event == 2:
+            message['fare'] = fare
+        messages.append(message)
+    return messages
@@ -93,6 +93,9 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    #first, so it times the whole request (see dispatch/metrics.py)
+    'geofencing.dispatch.metrics.MetricsMiddleware',
+    'geofencing.dispatch.tracing.TraceMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     #'django.middleware.csrf.CsrfViewMiddleware',
@@ -100,6 +103,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    #last, it runs the views of the profiled requests (see dispatch/profiling.py)
+    'geofencing.dispatch.profiling.ProfilingMiddleware',
 )
 
 ROOT_URLCONF = 'geofencing.urls'
@@ -152,6 +157,9 @@ LOGGING = {
         'simple': {
             'format': '%(levelname)s %(message)s'
         },
+        'trace': {
+            'format': '%(message)s'
+        },
     },
     'handlers': {
         'mail_admins': {
@@ -165,6 +173,14 @@ LOGGING = {
             'filename': os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..','var', 'log', 'django.log'),
             'formatter': 'debug',
         },
+        'slowlog': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..','var', 'log', 'slow.log'),
+            'maxBytes': 10*1024*1024,
+            'backupCount': 5,
+            'formatter': 'trace',
+        },
     },
     'loggers': {
         'django.request': {
@@ -177,11 +193,86 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': False,
         },
+        #the slow request traces (see dispatch/tracing.py)
+        'geofencing.slow': {
+            'handlers': ['slowlog'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 
 USE_TZ = True
 
+#
+# geofencing app settings
+#
+
+#keep a worker-local index of the active geohash cells (see dispatch/cellindex.py)
+#instead of asking redis for them on every box query
+GEOFENCE_CELL_INDEX = True
+
+#a trip with no event for this many seconds no longer counts as active
+GEOFENCE_ACTIVE_TRIP_TTL = 5*60
+
+#geohash precisions ingest rolls the events up into for the heatmap (see
+#dispatch/heatmap.py), and how long a heatmap response may be cached for
+GEOFENCE_HEATMAP_PRECISIONS = (4, 5, 6, 7)
+GEOFENCE_HEATMAP_MAX_AGE = 60
+
+#geohash precisions ingest keeps hourly busiest cells leaderboards for (see
+#dispatch/leaderboard.py)
+GEOFENCE_LEADERBOARD_PRECISIONS = (5, 6, 7)
+
+#geohash precision of the zones of the origin-destination matrix (see dispatch/od.py)
+GEOFENCE_OD_PRECISION = 5
+
+#directory to journal the raw events to (see dispatch/journal.py), None turns
+#the journal off
+GEOFENCE_JOURNAL_DIR = None
+#GEOFENCE_JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'var', 'journal')
+
+#redis commands per second replay_journal may send, over all its processes
+#(0 for no limit)
+GEOFENCE_REPLAY_WRITE_BUDGET = 50000
+
+#where the counters, prefix index and trips time series live: 'redis', or
+#'memory' for a single worker box without redis (see dispatch/storage.py)
+GEOFENCE_STORAGE = 'redis'
+
+#how the per-cell counters are laid out in redis: 'classic' (a key per counter,
+#as in the README) or 'compact' (small hashes of neighbouring cells, see
+#dispatch/compact.py), and the geohash prefix length the hashes group cells by
+GEOFENCE_KEY_LAYOUT = 'classic'
+GEOFENCE_COMPACT_CELL_PREFIX = 8
+
+#record request/redis metrics and serve them on /metrics (see dispatch/metrics.py)
+GEOFENCE_METRICS = True
+
+#trace this share of the requests' redis commands (0 turns the tracer off), and
+#log the traced requests slower than GEOFENCE_TRACE_SLOW_MS to var/log/slow.log
+#(see dispatch/tracing.py)
+GEOFENCE_TRACE_SAMPLE_RATE = 0
+GEOFENCE_TRACE_SLOW_MS = 500
 
+#share of the requests the profiler samples while it is on (GEOFENCE_PROFILE=1 in
+#the environment, or a SIGUSR2 to the worker), and the cpu seconds between two
+#stack samples (see dispatch/profiling.py)
+GEOFENCE_PROFILE_SAMPLE_RATE = 0.01
+GEOFENCE_PROFILE_INTERVAL = 0.005
 
+#split current_trips_counter into this many stripes, so that begin/end events
+#don't all contend for one WATCHed key (0: a single key; see dispatch/storage.py,
+#and run 'manage.py fold_trips_counter' after turning it off)
+GEOFENCE_TRIPS_COUNTER_STRIPES = 0
 
+#box queries reading more than GEOFENCE_QUERY_BUDGET cells x time buckets are
+#answered from the heatmap rollups ('coarse') or turned down ('reject'); a
+#worker runs at most GEOFENCE_QUERY_HEAVY_PER_WORKER queries of
+#GEOFENCE_QUERY_HEAVY_COST or more at a time, cancelled after
+#GEOFENCE_QUERY_DEADLINE seconds (see dispatch/admission.py)
+GEOFENCE_QUERY_BUDGET = 200000
+GEOFENCE_QUERY_OVER_BUDGET = 'coarse'
+GEOFENCE_QUERY_HEAVY_COST = 20000
+GEOFENCE_QUERY_HEAVY_PER_WORKER = 2
+GEOFENCE_QUERY_DEADLINE = 10.0
@@ -20,4 +20,12 @@ urlpatterns = patterns('',
     url(r'^query/trip_count_at_time_t/', 'geofencing.dispatch.views.time_t_trip_count'),
     url(r'^query/trips_passed_through/', 'geofencing.dispatch.views.trips_passed_through'),
     url(r'^query/trips_start_stop/', 'geofencing.dispatch.views.trips_start_stop'),
+    url(r'^query/active_trips/', 'geofencing.dispatch.views.active_trips'),
+    url(r'^query/nearest_trips/', 'geofencing.dispatch.views.nearest_trips'),
+    url(r'^query/heatmap/', 'geofencing.dispatch.views.heatmap'),
+    url(r'^query/hotspots/', 'geofencing.dispatch.views.hotspots'),
+    url(r'^query/od_matrix/', 'geofencing.dispatch.views.od_matrix'),
+    url(r'^metrics$', 'geofencing.dispatch.views.metrics_endpoint'),
+    url(r'^fences/$', 'geofencing.dispatch.views.fences'),
+    url(r'^fences/(?P<name>[^/]+)/$', 'geofencing.dispatch.views.fences'),
 ) + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
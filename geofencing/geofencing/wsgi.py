@@ -23,6 +23,12 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geofencing.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+#gunicorn loads this in each worker, after setting up its own signal handlers,
+#so the profiler's go in now rather than at the first request (see
+#dispatch/profiling.py)
+from geofencing.dispatch import profiling
+profiling.install()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
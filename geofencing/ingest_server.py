@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+if __name__ == '__main__':
+    #cooperative sockets for redis, before anything opens one. (only when run:
+    #the tests import the app)
+    from gevent import monkey
+    monkey.patch_all()
+
+from datetime import datetime
+import logging
+from optparse import OptionParser
+import os
+import traceback
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geofencing.settings")
+
+from django.conf import settings
+from gevent.pywsgi import WSGIServer
+import redis
+
+from geofencing.dispatch import fences as geofences, ingest, storage
+
+__doc__ = """
+        A standalone server for /trips/ alone, without django's request
+        handling (middleware, url resolving, HttpRequest/HttpResponse): one
+        gevent WSGI function around the same code as the trips() view (see
+        dispatch/ingest.py), so it answers and writes exactly the same, one
+        event, a json array of them or packed binary events per request.
+
+            (venv)$ python ingest_server.py --port 6790
+
+        It uses the settings of the django project (GEOFENCE_*, the journal,
+        LOGGING) and the same redis, and only works with the 'redis' storage.
+        Run one per core (see conf/supervisord.conf) and route /trips/ to
+        them in nginx (see conf/nginx.conf); the queries stay on gunicorn.
+        The requests it answers are not in /metrics. It never queries cells,
+        so it keeps no cell index of its own (nor follows the cell feed),
+        it only publishes the cells it sees for the gunicorn workers.
+"""
+
+logger = logging.getLogger('geofencing.ingest_server')
+
+HEADERS = [('Content-Type', 'text/html; charset=utf-8')]
+
+def _respond(start_response, status, body='', headers=()):
+    start_response(status, HEADERS + [('Content-Length', str(len(body)))] + list(headers))
+    return [body]
+
+class Ingest(object):
+    """The WSGI application"""
+
+    def __init__(self, store):
+        self.store = store
+        self.fence_index = None
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] != '/trips/':
+            return _respond(start_response, '404 NOT FOUND')
+        if environ['REQUEST_METHOD'] != 'POST':
+            #as the view answers
+            return _respond(start_response, '405 METHOD NOT ALLOWED', headers=[('Allow', 'GET, DELETE, PUT')])
+
+        try:
+            #get the current timestamp as we assume this is the timestamp of the message
+            #see 'assumptions' section in README
+            now = datetime.utcnow()
+
+            body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+            try:
+                messages = ingest.parse(body, environ.get('CONTENT_TYPE'))
+            except ingest.InvalidEvent, e:
+                return _respond(start_response, '400 BAD REQUEST', str(e))
+
+            if self.fence_index is None:
+                self.fence_index = geofences.start(self.store.redis_conn)
+            ingest.record(self.store, messages, now, self.fence_index)
+            return _respond(start_response, '200 OK')
+
+        except Exception:
+            logger.error(traceback.format_exc())
+            return _respond(start_response, '500 INTERNAL SERVER ERROR')
+
+def main():
+    parser = OptionParser(usage='%prog [--host 127.0.0.1] [--port 6790]')
+    parser.add_option('--host', dest='host', default='127.0.0.1',
+        help='address to listen on')
+    parser.add_option('--port', dest='port', type='int', default=6790,
+        help='port to listen on')
+    parser.add_option('--redis-db', dest='redis_db', type='int', default=int(os.environ.get('REDIS_DB_NUM', 0)),
+        help='redis db (default: REDIS_DB_NUM, or 0, as the views)')
+    parser.add_option('--backlog', dest='backlog', type='int', default=2048,
+        help='maximum number of pending connections')
+    options, args = parser.parse_args()
+
+    if getattr(settings, 'GEOFENCE_STORAGE', 'redis') != 'redis':
+        parser.error('the ingest server needs GEOFENCE_STORAGE = "redis"')
+
+    redis_conn = redis.StrictRedis(host='127.0.0.1', port=7878, db=options.redis_db)
+    server = WSGIServer((options.host, options.port), Ingest(storage.RedisStorage(redis_conn, cell_index=False)),
+                        backlog=options.backlog, log=None)
+    logger.info('ingest server on {0}:{1}'.format(options.host, options.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()